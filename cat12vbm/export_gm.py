@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import json
+import nibabel
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.volumes import (  # noqa: E402
+    open_volume, masked_values, flat_indices, nonzero_counts, list_images)
+from tools.nifti_cache import cache_key  # noqa: E402
+from tools.participants import load_participants  # noqa: E402
+from cat12vbm.gm_summary import parse_bids  # noqa: E402
+
+
+DATA_FILE = "gm.dat"
+META_FILE = "meta.json"
+MASK_FILE = "mask.nii.gz"
+INDEX_FILE = "index.tsv"
+
+
+def load(dataset_dir, mmap_mode="r"):
+    """ Open a packed GM dataset.
+
+    Parameters
+    ----------
+    dataset_dir: str
+        the dataset folder generated by export.
+    mmap_mode: str, default 'r'
+        the numpy.memmap mode.
+
+    Returns
+    -------
+    data: numpy.memmap
+        the (subjects, in-mask voxels) GM values.
+    index: pandas.DataFrame
+        the participant, session, run and site of each row.
+    mask: nibabel.Nifti1Image
+        the mask of the voxels (in Fortran order, see tools.volumes).
+    """
+    with open(os.path.join(dataset_dir, META_FILE), "rt") as of:
+        meta = json.load(of)
+    data = np.memmap(os.path.join(dataset_dir, DATA_FILE),
+                     dtype=meta["dtype"], mode=mmap_mode,
+                     shape=(meta["n_rows"], meta["n_voxels"]))
+    index = pd.read_csv(os.path.join(dataset_dir, INDEX_FILE), sep="\t",
+                        dtype={"run": str})
+    mask = nibabel.load(os.path.join(dataset_dir, MASK_FILE))
+    return data, index, mask
+
+
+def unmask(values, mask):
+    """ Put the in-mask values of a row back in a 3d volume.
+    """
+    mask_data = np.asarray(mask.dataobj) > 0
+    arr = np.zeros(mask_data.size, dtype=values.dtype)
+    arr[flat_indices(mask_data)] = values
+    return arr.reshape(mask_data.shape, order="F")
+
+
+def is_longitudinal(path):
+    """ Check if a GM map is generated by the longitudinal pipeline.
+    """
+    return os.path.basename(path).startswith("mwp1r")
+
+
+def ident(sub, ses, run, longitudinal):
+    """ Get the identifier of a row of the dataset: the participant, session,
+    run and pipeline of a map (the path of a map may change, e.g. when it is
+    recompressed).
+    """
+    if run is None or (isinstance(run, float) and np.isnan(run)):
+        run = ""
+    return str(sub), str(ses), str(run), bool(longitudinal)
+
+
+def export(cat12dir, outdir, participant_file=None, mask_file=None,
+           dtype="float32", mask_frac=0.5, njobs=10, size=16):
+    """ Pack the modulated GM maps of the cohort in one masked
+    memory-mapped (subjects, in-mask voxels) array.
+
+    The dataset folder contains the raw array (gm.dat), its dtype and shape
+    (meta.json), the mask (mask.nii.gz) and the index of the rows
+    (index.tsv). When the dataset already exists, only the new maps are
+    appended, the modified or moved maps are rewritten in place and the
+    rows of the removed maps are dropped: the mask is never changed. The
+    rows are identified by participant, session, run and pipeline.
+
+    Parameters
+    ----------
+    cat12dir: str
+        path to the BIDS cat12 derivatives directory.
+    outdir: str
+        path to the dataset folder.
+    participant_file: str, default None
+        optionnaly, path to the participants.tsv file (in order to get the
+        site of each session in the index).
+    mask_file: str, default None
+        path to the mask used when the dataset is created, by default the
+        voxels that are non zero in at least 'mask_frac' of the maps.
+    dtype: str, default 'float32'
+        the array dtype, 'float32' or 'float16', used when the dataset is
+        created.
+    mask_frac: float, default 0.5
+        the fraction of non zero maps to select a voxel in the mask.
+    njobs: int, default 10
+        the number of parallel readers.
+    size: int, default 16
+        the number of slices read at a time when building the mask.
+    """
+    files = sorted(
+        list_images(os.path.join(cat12dir, "sub-*", "ses-*", "mri",
+                                 "mwp1usub*_T1w")) +
+        list_images(os.path.join(cat12dir, "sub-*", "ses-*", "mri",
+                                 "mwp1rusub*_T1w")))
+    if len(files) == 0:
+        raise RuntimeError("No data to process!")
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    meta_file = os.path.join(outdir, META_FILE)
+    index_file = os.path.join(outdir, INDEX_FILE)
+    data_file = os.path.join(outdir, DATA_FILE)
+
+    if os.path.isfile(meta_file):
+        with open(meta_file, "rt") as of:
+            meta = json.load(of)
+        index = pd.read_csv(index_file, sep="\t", dtype={"run": str})
+        mask = np.asarray(
+            nibabel.load(os.path.join(outdir, MASK_FILE)).dataobj) > 0
+    else:
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"unsupported dtype '{dtype}'")
+        if mask_file is None:
+            chunks = [files[idx::njobs] for idx in range(njobs)]
+            with ThreadPoolExecutor(max_workers=njobs) as executor:
+                counts = list(executor.map(
+                    lambda chunk: nonzero_counts(chunk, size=size),
+                    [chunk for chunk in chunks if len(chunk) > 0]))
+            mask = sum(counts) >= mask_frac * len(files)
+            del counts
+        else:
+            mask = np.asarray(nibabel.load(mask_file).dataobj) > 0
+        affine = open_volume(files[0])[1]
+        nibabel.save(nibabel.Nifti1Image(mask.astype(np.uint8), affine),
+                     os.path.join(outdir, MASK_FILE))
+        meta = {"dtype": dtype, "n_rows": 0, "n_voxels": int(mask.sum()),
+                "shape": list(mask.shape)}
+        index = pd.DataFrame(columns=[
+            "participant_id", "session", "run", "longitudinal", "site",
+            "path", "key"])
+    indices = flat_indices(mask)
+    print(f"number of voxels: {len(indices)}")
+
+    current = dict((ident(*parse_bids(path), is_longitudinal(path)), path)
+                   for path in files)
+    keys = dict((path, cache_key(path)) for path in current.values())
+    rows = dict((ident(*row), idx) for idx, row in zip(index.index, index[[
+        "participant_id", "session", "run", "longitudinal"]].values))
+    dropped = [key for key in rows if key not in current]
+    updated = [key for key in rows if key in current and (
+        index.at[rows[key], "path"] != current[key] or
+        index.at[rows[key], "key"] != keys[current[key]])]
+    added = [key for key in current if key not in rows]
+    print(f"number of maps: {len(current)} ({len(added)} new, "
+          f"{len(updated)} modified, {len(dropped)} removed)")
+    if len(added) + len(updated) + len(dropped) == 0:
+        return
+
+    row_bytes = len(indices) * np.dtype(meta["dtype"]).itemsize
+    with open(data_file, "ab") as of:
+        of.truncate(meta["n_rows"] * row_bytes)
+    if len(dropped) > 0:
+        removed = set(rows[key] for key in dropped)
+        kept = [idx for idx in index.index if idx not in removed]
+        data = np.memmap(data_file, dtype=meta["dtype"], mode="r",
+                         shape=(meta["n_rows"], len(indices)))
+        tmp = f"{data_file}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as of:
+            for start in range(0, len(kept), 4 * njobs):
+                of.write(np.ascontiguousarray(
+                    data[kept[start: start + 4 * njobs]]).tobytes())
+        del data
+        os.replace(tmp, data_file)
+        index = index.loc[kept].reset_index(drop=True)
+        meta["n_rows"] = len(index)
+        rows = dict((ident(*row), idx) for idx, row in zip(
+            index.index, index[["participant_id", "session", "run",
+                                "longitudinal"]].values))
+
+    info = None
+    if participant_file is not None:
+        info = load_participants(participant_file)
+    records = []
+    for key in added:
+        sub, ses, run, longitudinal = key
+        records.append({
+            "participant_id": sub, "session": ses, "run": run or None,
+            "longitudinal": longitudinal,
+            "site": (info.site(sub, ses, default=None)
+                     if info is not None else None),
+            "path": current[key], "key": keys[current[key]]})
+
+    def _read(path):
+        data, _, _ = open_volume(path)
+        if tuple(data.shape[:3]) != tuple(meta["shape"]):
+            raise ValueError(f"{path}: shape {data.shape} does not match the "
+                             f"mask shape {meta['shape']}")
+        return masked_values(path, indices).astype(meta["dtype"])
+
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        for start in range(0, len(added), 4 * njobs):
+            chunk = [current[key] for key in added[start: start + 4 * njobs]]
+            with open(data_file, "ab") as of:
+                for values in executor.map(_read, chunk):
+                    of.write(values.tobytes())
+        if len(updated) > 0:
+            data = np.memmap(data_file, dtype=meta["dtype"], mode="r+",
+                             shape=(meta["n_rows"], len(indices)))
+            paths = [current[key] for key in updated]
+            for key, values in zip(updated, executor.map(_read, paths)):
+                data[rows[key]] = values
+                index.at[rows[key], "path"] = current[key]
+                index.at[rows[key], "key"] = keys[current[key]]
+            data.flush()
+            del data
+    index = pd.concat([index, pd.DataFrame.from_records(records)],
+                      ignore_index=True)
+    meta["n_rows"] = len(index)
+    for path, content in ((index_file, index), (meta_file, meta)):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        if isinstance(content, dict):
+            with open(tmp, "wt") as of:
+                json.dump(content, of, indent=4)
+        else:
+            content.to_csv(tmp, sep="\t", index=False)
+        os.replace(tmp, path)
+    print(f"number of rows: {meta['n_rows']}")
+    print(outdir)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(export)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.volumes import (  # noqa: E402
+    open_volume, iter_slabs, list_images)
+
+
+def parse_bids(path):
+    """ Get the subject, session and run of a CAT12 output.
+    """
+    sub, ses = path.split(os.sep)[-4: -2]
+    basename = os.path.basename(path)
+    run = basename.split("run-")[1].split("_")[0] if "run-" in basename \
+        else None
+    return sub, ses, run
+
+
+def gm_stats(path, size=16, thr=0.):
+    """ Compute the GM summary of a modulated GM map slab by slab.
+    """
+    data, affine, _ = open_volume(path)
+    voxel_volume = abs(np.linalg.det(affine[:3, :3]))
+    total, count, maximum = 0., 0, 0.
+    for _, slab in iter_slabs(path, size=size):
+        values = slab[slab > thr]
+        total += float(values.sum(dtype=np.float64))
+        count += values.size
+        maximum = max(maximum, float(values.max(initial=0.)))
+    sub, ses, run = parse_bids(path)
+    return {
+        "participant_id": sub, "session": ses,
+        "run": run, "gm_volume": total * voxel_volume, "gm_voxels": count,
+        "gm_mean": total / count if count > 0 else 0., "gm_max": maximum,
+        "shape": data.shape, "dtype": data.dtype.name}
+
+
+def summary(cat12dir, outdir, njobs=10, size=16, zthr=3.):
+    """ Compute the GM volume of each modulated GM map of the cohort in
+    constant memory.
+
+    The uncompressed CAT12 outputs are memory mapped and read slab by slab
+    in their native dtype (recompressed outputs are read from the
+    decompression cache when it is enabled). Subjects with a GM volume too
+    far from the cohort mean are flagged.
+
+    Parameters
+    ----------
+    cat12dir: str
+        path to the BIDS cat12 derivatives directory.
+    outdir: str
+        path to the output directory.
+    njobs: int, default 10
+        the number of parallel readers.
+    size: int, default 16
+        the number of slices read at a time.
+    zthr: float, default 3
+        the absolute z-score above which a GM volume is flagged.
+    """
+    files = sorted(
+        list_images(os.path.join(cat12dir, "sub-*", "ses-*", "mri",
+                                 "mwp1usub*_T1w")) +
+        list_images(os.path.join(cat12dir, "sub-*", "ses-*", "mri",
+                                 "mwp1rusub*_T1w")))
+    if len(files) == 0:
+        raise RuntimeError("No data to process!")
+    print(f"number of maps: {len(files)}")
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        records = list(executor.map(
+            lambda path: gm_stats(path, size=size), files))
+    df = pd.DataFrame.from_records(records)
+    df["longitudinal"] = [
+        os.path.basename(path).startswith("mwp1r") for path in files]
+    std = df["gm_volume"].std()
+    df["gm_zscore"] = (df["gm_volume"] - df["gm_volume"].mean()) / (
+        std if std > 0 else 1.)
+    df["qc"] = (df["gm_zscore"].abs() <= zthr).astype(int)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    outfile = os.path.join(outdir, "gm_summary.tsv")
+    df.to_csv(outfile, sep="\t", index=False)
+    print(df[df["qc"] == 0])
+    print(outfile)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(summary)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import re
+import sys
+import glob
+import pickle
+import pandas as pd
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.nifti_cache import cache_key  # noqa: E402
+from cat12vbm.gm_summary import parse_bids  # noqa: E402
+
+
+# The version of the parsed records in the cache: the records of another
+# version are parsed again.
+CACHE_VERSION = 2
+
+
+def parse_values(text):
+    """ Parse a CAT12 scalar or MATLAB-like array ('[1.2 3.4;5.6]').
+    """
+    values = []
+    for item in re.split(r"[\s;,\[\]]+", (text or "").strip()):
+        if item == "":
+            continue
+        try:
+            values.append(float(item))
+        except ValueError:
+            return []
+    return values
+
+
+def parse_report(path, sections=("qualityratings", "qualitymeasures",
+                                 "subjectmeasures")):
+    """ Parse the quality ratings and subject measures of a CAT12 report with
+    an incremental parser: the columns are prefixed by their section since
+    some tags are repeated (e.g. 'qualityratings_NCR' and
+    'qualitymeasures_NCR').
+    """
+    record, stack = {}, []
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            stack.append(elem.tag)
+            continue
+        stack.pop()
+        if len(stack) == 2 and stack[1] in sections:
+            values = parse_values(elem.text)
+            name = f"{stack[1]}_{elem.tag}"
+            if len(values) == 1:
+                record[name] = values[0]
+            elif len(values) > 1 and stack[1] == "subjectmeasures":
+                for idx, value in enumerate(values):
+                    record[f"{name}_{idx}"] = value
+        if len(stack) <= 2:
+            elem.clear()
+    return record
+
+
+def parse_roi(path, atlas="neuromorphometrics", measures=("Vgm", )):
+    """ Parse the ROI measures of an atlas in a CAT12 label file with an
+    incremental parser.
+    """
+    names, data, stack = [], {}, []
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            stack.append(elem.tag)
+            continue
+        stack.pop()
+        if len(stack) < 2 or stack[1] != atlas:
+            if len(stack) <= 1:
+                elem.clear()
+            continue
+        if stack[2:] == ["names"] and elem.tag == "item":
+            names.append(elem.text.strip())
+        elif stack[2:] == ["data"] and elem.tag in measures:
+            data[elem.tag] = parse_values(elem.text)
+    record = {}
+    for measure, values in data.items():
+        if len(values) != len(names):
+            raise ValueError(f"{path}: {len(values)} '{measure}' values for "
+                             f"{len(names)} ROIs")
+        for name, value in zip(names, values):
+            record[f"{measure}_{name}"] = value
+    return record
+
+
+def parse_file(path, atlas="neuromorphometrics", measures=("Vgm", )):
+    """ Parse a CAT12 report or label file.
+    """
+    basename = os.path.basename(path)
+    if basename.startswith("catROI_"):
+        record = parse_roi(path, atlas=atlas, measures=measures)
+        key = basename[len("catROI_"):]
+    else:
+        record = parse_report(path)
+        key = basename[len("cat_"):]
+    sub, ses, run = parse_bids(path)
+    record.update({
+        "participant_id": sub, "session": ses, "run": run,
+        "longitudinal": key.startswith("r"), "key": key})
+    return record
+
+
+def report(cat12dir, outdir, atlas="neuromorphometrics", measures=("Vgm", ),
+           njobs=10, fmt="tsv"):
+    """ Gather the CAT12 quality ratings and ROI volumes of all the sessions
+    in one table.
+
+    The XML files are parsed in parallel with an incremental parser. The
+    parsed records are cached with the path, mtime and size of each file:
+    only the new or modified files are parsed again.
+
+    Parameters
+    ----------
+    cat12dir: str
+        path to the BIDS cat12 derivatives directory.
+    outdir: str
+        path to the output directory.
+    atlas: str, default 'neuromorphometrics'
+        the atlas of the ROI measures.
+    measures: list of str, default ('Vgm', )
+        the ROI measures to extract.
+    njobs: int, default 10
+        the number of parallel parsers.
+    fmt: str, default 'tsv'
+        the output table format, 'tsv' or 'parquet' (requires pyarrow).
+    """
+    if fmt not in ("tsv", "parquet"):
+        raise ValueError(f"unsupported format '{fmt}'")
+    if isinstance(measures, str):
+        measures = [measures]
+    measures = tuple(measures)
+    files = sorted(
+        glob.glob(os.path.join(cat12dir, "sub-*", "ses-*", "report",
+                               "cat_*sub-*_T1w.xml")) +
+        glob.glob(os.path.join(cat12dir, "sub-*", "ses-*", "label",
+                               "catROI_*sub-*_T1w.xml")))
+    if len(files) == 0:
+        raise RuntimeError("No data to process!")
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    cache_file = os.path.join(outdir, f"cat12vbm_report_{atlas}.pkl")
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file, "rb") as of:
+            cache = pickle.load(of)
+        if (cache.get("measures") != measures or
+                cache.get("version") != CACHE_VERSION):
+            cache = {}
+    records = cache.get("records", {})
+    keys = dict((path, cache_key(path)) for path in files)
+    todo = [path for path in files
+            if path not in records or records[path][0] != keys[path]]
+    print(f"number of files: {len(files)} ({len(todo)} to parse)")
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        parsed = list(executor.map(
+            lambda path: parse_file(path, atlas=atlas, measures=measures),
+            todo))
+    records = dict((path, records[path]) for path in files
+                   if path in records)
+    records.update(
+        (path, (keys[path], record)) for path, record in zip(todo, parsed))
+    tmp = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as of:
+        pickle.dump({"measures": measures, "version": CACHE_VERSION,
+                     "records": records}, of)
+    os.replace(tmp, cache_file)
+
+    rows = {}
+    for path in files:
+        record = records[path][1]
+        rows.setdefault(record["key"], {}).update(record)
+    df = pd.DataFrame.from_records(list(rows.values()))
+    columns = ["participant_id", "session", "run", "longitudinal"]
+    df = df[columns + [col for col in df.columns
+                       if col not in columns + ["key"]]]
+    df = df.sort_values(columns).reset_index(drop=True)
+    outfile = os.path.join(outdir, f"cat12vbm_report_{atlas}.{fmt}")
+    if fmt == "parquet":
+        df.to_parquet(outfile, index=False)
+    else:
+        df.to_csv(outfile, sep="\t", index=False)
+    print(df.shape)
+    print(outfile)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(report)
@@ -10,10 +10,15 @@
 
 # Imports
 import os
+import sys
 import fire
 import glob
 import datetime
 from hopla.converter import hopla
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.batch import run_batches  # noqa: E402
+from tools.preflight import select_valid  # noqa: E402
+from tools.sharding import select_shard  # noqa: E402
 
 
 def get_best_anat(files):
@@ -30,7 +35,8 @@ def get_best_anat(files):
 
 
 def run(datadir, outdir, simg_file, cmd=None, name="deface", process=False,
-        njobs=10, use_pbs=False, test=False):
+        njobs=10, use_pbs=False, test=False, preflight=True, batch_size=1,
+        shard_index=0, shard_count=1, cost_file=None):
     """ Parse data and execute the processing with hopla.
 
     Parameters
@@ -53,6 +59,22 @@ def run(datadir, outdir, simg_file, cmd=None, name="deface", process=False,
         optionnaly use PBSPRO batch submission system.
     test: bool, default False
         optionnaly, select only one subject.
+    preflight: bool, default True
+        optionnaly, check the input images headers before processing and
+        exclude the runs with invalid inputs.
+    batch_size: int, default 1
+        optionnaly, group the subjects by batches that are processed in a
+        single container invocation, with per subject logs and exit status.
+    shard_index: int, default 0
+        optionnaly, the index of the shard of runs processed by this call
+        (see shard_count).
+    shard_count: int, default 1
+        optionnaly, split the runs in this number of disjoint shards
+        balanced by predicted cost (see tools.sharding.select_shard), so
+        that several machines can process the same cohort.
+    cost_file: str, default None
+        optionnaly, a .tsv table with the 'path' (the run input) and 'cost'
+        (e.g. a past runtime) columns used to balance the shards.
     """
     anat_files, deface_anat_files, deface_roots = [], [], []
     for subject in os.listdir(datadir):
@@ -81,6 +103,23 @@ def run(datadir, outdir, simg_file, cmd=None, name="deface", process=False,
             root = os.path.join(
                 _outdir, basename.replace("_T1w.nii.gz", "_defacemask"))
             deface_roots.append(root)
+    if preflight:
+        keep = select_valid(
+            [",".join(item) for item in zip(anat_files, deface_anat_files)],
+            outfile=os.path.join(outdir, (
+                f"{name}-qc_preflight.tsv" if shard_count == 1 else
+                f"{name}-qc_preflight_shard-{shard_index:03d}.tsv")),
+            njobs=njobs)
+        anat_files, deface_anat_files, deface_roots = [
+            [item[idx] for idx in keep]
+            for item in (anat_files, deface_anat_files, deface_roots)]
+    if shard_count > 1:
+        keep = select_shard(
+            [",".join(item) for item in zip(anat_files, deface_anat_files)],
+            shard_index, shard_count, cost_file=cost_file)
+        anat_files, deface_anat_files, deface_roots = [
+            [item[idx] for idx in keep]
+            for item in (anat_files, deface_anat_files, deface_roots)]
     if len(anat_files) == 0:
         raise RuntimeError("No data to process!")
     if test:
@@ -116,22 +155,35 @@ def run(datadir, outdir, simg_file, cmd=None, name="deface", process=False,
         if cmd is None:
             cmd = (f"singularity run --bind {os.path.dirname(datadir)} "
                    f"--cleanenv {simg_file} brainprep deface-qc")
-        status, exitcodes = hopla(
-            cmd,
-            anatomical=anat_files,
-            anatomical_deface=deface_anat_files,
-            deface_root=deface_roots,
-            thr_mask=0.6,
-            hopla_name_replace=True,
-            hopla_iterative_kwargs=["anatomical", "anatomical-deface",
-                                    "deface-root"],
-            hopla_optional=["anatomical", "anatomical-deface", "deface-root"],
-            hopla_cpus=njobs,
-            hopla_logfile=logfile,
-            hopla_use_subprocess=True,
-            hopla_verbose=1,
-            hopla_python_cmd=None,
-            **pbs_kwargs)
+        if batch_size > 1:
+            status, exitcodes = run_batches(
+                cmd, batch_size, os.path.join(logdir, f"{name}-qc_{date}"),
+                optional=["anatomical", "anatomical-deface", "deface-root"],
+                iterative={"anatomical": anat_files,
+                           "anatomical_deface": deface_anat_files,
+                           "deface_root": deface_roots},
+                constants={"thr_mask": 0.6},
+                hopla_cpus=njobs,
+                hopla_logfile=logfile,
+                **pbs_kwargs)
+        else:
+            status, exitcodes = hopla(
+                cmd,
+                anatomical=anat_files,
+                anatomical_deface=deface_anat_files,
+                deface_root=deface_roots,
+                thr_mask=0.6,
+                hopla_name_replace=True,
+                hopla_iterative_kwargs=["anatomical", "anatomical-deface",
+                                        "deface-root"],
+                hopla_optional=["anatomical", "anatomical-deface",
+                                "deface-root"],
+                hopla_cpus=njobs,
+                hopla_logfile=logfile,
+                hopla_use_subprocess=True,
+                hopla_verbose=1,
+                hopla_python_cmd=None,
+                **pbs_kwargs)
 
 
 if __name__ == "__main__":
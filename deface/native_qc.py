@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import glob
+import traceback
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.volumes import open_volume, scale  # noqa: E402
+from tools.preflight import select_valid  # noqa: E402
+from deface.utils import get_best_anat  # noqa: E402
+
+
+def load(path):
+    """ Load the voxels of a 3d image as float32.
+    """
+    data, _, scaling = open_volume(path)
+    data = scale(data, scaling)
+    if data.ndim > 3:
+        data = data[..., 0]
+    return data
+
+
+def deface_metrics(anat_file, deface_file, mask_file, thr_mask=0.6,
+                   min_removed=0.95, max_changed=0.01):
+    """ Compute the defacing overlap metrics of a session.
+
+    The voxels of the defacing mask above 'thr_mask' are the kept (head)
+    region: the other voxels are the face region expected to be removed.
+
+    Parameters
+    ----------
+    anat_file: str
+        path to the raw T1w image.
+    deface_file: str
+        path to the defaced T1w image.
+    mask_file: str
+        path to the defacing mask.
+    thr_mask: float, default 0.6
+        the threshold applied on the defacing mask.
+    min_removed: float, default 0.95
+        the minimum fraction of the face region that is removed.
+    max_changed: float, default 0.01
+        the maximum fraction of the kept region that is modified.
+
+    Returns
+    -------
+    record: dict
+        the session metrics and 'qc' flag.
+    """
+    anat = load(anat_file)
+    deface = load(deface_file)
+    kept = load(mask_file) > thr_mask
+    if not (anat.shape == deface.shape == kept.shape):
+        raise ValueError(f"shapes {anat.shape}, {deface.shape} and "
+                         f"{kept.shape} do not match")
+    head = anat != 0
+    removed = head & (deface == 0)
+    face = head & ~kept
+    n_head, n_face, n_kept = head.sum(), face.sum(), kept.sum()
+    n_removed = removed.sum()
+    n_overlap = (removed & face).sum()
+    record = {
+        "mask_fraction": float(n_kept / kept.size),
+        "removed_fraction": float(n_removed / max(n_head, 1)),
+        "face_removed_fraction": float(n_overlap / max(n_face, 1)),
+        "kept_changed_fraction": float(
+            (kept & (anat != deface)).sum() / max(n_kept, 1)),
+        "dice": float(2 * n_overlap / max(n_removed + n_face, 1))}
+    record["qc"] = int(
+        n_removed > 0 and
+        record["face_removed_fraction"] >= min_removed and
+        record["kept_changed_fraction"] <= max_changed)
+    return record
+
+
+def _metrics(args):
+    """ Compute the metrics of a session in a worker process.
+    """
+    anat_file, deface_file, mask_file, kwargs = args
+    record = {"anat": anat_file, "deface": deface_file, "error": None}
+    try:
+        record.update(deface_metrics(
+            anat_file, deface_file, mask_file, **kwargs))
+    except Exception:
+        record["error"] = traceback.format_exc().splitlines()[-1]
+        record["qc"] = 0
+    return record
+
+
+def run(datadir, outdir, name="deface", sessions=("ses-M00", "ses-M03"),
+        njobs=10, thr_mask=0.6, min_removed=0.95, max_changed=0.01,
+        test=False, preflight=True):
+    """ Compute the deface QC metrics of all the sessions in-process and
+    write a single cohort QC table.
+
+    The raw and defaced T1w images are compared with vectorized operations
+    on the defacing mask, in a pool of 'njobs' processes.
+
+    Parameters
+    ----------
+    datadir: str
+        path to the BIDS rawdata directory.
+    outdir: str
+        path to the BIDS derivatives directory.
+    name: str, default 'deface'
+        the name of the analysis: use 'deface_lianat' for the lithium
+        anatomical sessions.
+    sessions: list of str, default ('ses-M00', 'ses-M03')
+        the sessions to check: use ('ses-M03Li', 'ses-M03H') for the lithium
+        anatomical sessions.
+    njobs: int, default 10
+        the number of parallel processes.
+    thr_mask: float, default 0.6
+        the threshold applied on the defacing mask.
+    min_removed: float, default 0.95
+        the minimum fraction of the face region that is removed.
+    max_changed: float, default 0.01
+        the maximum fraction of the kept region that is modified.
+    test: bool, default False
+        optionnaly, select only one subject.
+    preflight: bool, default True
+        optionnaly, check the input images headers before processing and
+        exclude the runs with invalid inputs.
+    """
+    subjects, ses, anat_files, deface_anat_files, mask_files = (
+        [], [], [], [], [])
+    for subject in sorted(os.listdir(datadir)):
+        for session in sessions:
+            sesdir = os.path.join(datadir, subject, session)
+            _outdir = os.path.join(outdir, name, subject, session)
+            if not os.path.isdir(sesdir) or not os.path.isdir(_outdir):
+                continue
+            _anat_files = glob.glob(os.path.join(
+                sesdir, "anat", f"sub-*_{session}_*T1w.nii.gz"))
+            if len(_anat_files) == 0:
+                print(f"no anat in '{sesdir}'")
+                continue
+            best_anat = get_best_anat(_anat_files)
+            basename = os.path.basename(best_anat)
+            deface_anat = os.path.join(_outdir, basename)
+            mask_file = os.path.join(_outdir, basename.replace(
+                "_T1w.nii.gz", "_defacemask.nii.gz"))
+            if not os.path.isfile(deface_anat) or \
+                    not os.path.isfile(mask_file):
+                print(f"no '{deface_anat}' or '{mask_file}' file!")
+                continue
+            subjects.append(subject)
+            ses.append(session)
+            anat_files.append(best_anat)
+            deface_anat_files.append(deface_anat)
+            mask_files.append(mask_file)
+    items = (subjects, ses, anat_files, deface_anat_files, mask_files)
+    if preflight:
+        keep = select_valid(
+            [",".join(item) for item in zip(
+                anat_files, deface_anat_files, mask_files)],
+            outfile=os.path.join(outdir, f"{name}-qc_preflight.tsv"),
+            njobs=njobs)
+        items = [[item[idx] for idx in keep] for item in items]
+    if len(items[0]) == 0:
+        raise RuntimeError("No data to process!")
+    if test:
+        items = [item[:1] for item in items]
+    subjects, ses, anat_files, deface_anat_files, mask_files = items
+    print(f"number of runs: {len(anat_files)}")
+
+    kwargs = {"thr_mask": thr_mask, "min_removed": min_removed,
+              "max_changed": max_changed}
+    with ProcessPoolExecutor(max_workers=njobs) as executor:
+        records = list(executor.map(_metrics, [
+            (anat_file, deface_file, mask_file, kwargs)
+            for anat_file, deface_file, mask_file in zip(
+                anat_files, deface_anat_files, mask_files)]))
+    df = pd.DataFrame.from_records(records)
+    df.insert(0, "participant_id", subjects)
+    df.insert(1, "session", ses)
+    outfile = os.path.join(outdir, f"{name}-qc.tsv")
+    df.to_csv(outfile, sep="\t", index=False)
+    print(df[df["qc"] == 0])
+    print(outfile)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(run)
@@ -10,10 +10,16 @@
 
 # Imports
 import os
+import sys
 import fire
 import glob
 import datetime
 from hopla.converter import hopla
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.batch import run_batches  # noqa: E402
+from tools.job_queue import run_queue  # noqa: E402
+from tools.preflight import select_valid  # noqa: E402
+from tools.sharding import select_shard  # noqa: E402
 
 
 def get_best_anat(files):
@@ -30,7 +36,8 @@ def get_best_anat(files):
 
 
 def run(datadir, outdir, simg_file, cmd=None, name="deface", process=False,
-        njobs=10, use_pbs=False, test=False):
+        njobs=10, use_pbs=False, test=False, preflight=True, batch_size=1,
+        shard_index=0, shard_count=1, cost_file=None, queue_dir=None):
     """ Parse data and execute the processing with hopla.
 
     Parameters
@@ -53,7 +60,30 @@ def run(datadir, outdir, simg_file, cmd=None, name="deface", process=False,
         optionnaly use PBSPRO batch submission system.
     test: bool, default False
         optionnaly, select only one subject.
+    preflight: bool, default True
+        optionnaly, check the input images headers before processing and
+        exclude the runs with invalid inputs.
+    batch_size: int, default 1
+        optionnaly, group the subjects by batches that are processed in a
+        single container invocation, with per subject logs and exit status.
+    shard_index: int, default 0
+        optionnaly, the index of the shard of runs processed by this call
+        (see shard_count).
+    shard_count: int, default 1
+        optionnaly, split the runs in this number of disjoint shards
+        balanced by predicted cost (see tools.sharding.select_shard), so
+        that several machines can process the same cohort.
+    cost_file: str, default None
+        optionnaly, a .tsv table with the 'path' (the run input) and 'cost'
+        (e.g. a past runtime) columns used to balance the shards.
+    queue_dir: str, default None
+        optionnaly, run the subjects through a work-stealing queue in this
+        shared directory (see tools/job_queue.py): more workers can join
+        from any host that sees the directory (not compatible with use_pbs).
     """
+    if queue_dir is not None and use_pbs:
+        raise ValueError("the queue_dir and use_pbs options are not "
+                         "compatible: the queue workers run locally")
     anat_files, sub_outdirs = [], []
     for subject in os.listdir(datadir):
         for session in ("ses-M00", "ses-M03"):
@@ -68,6 +98,22 @@ def run(datadir, outdir, simg_file, cmd=None, name="deface", process=False,
                 sesdir, "anat", f"sub-*_{session}_*T1w.nii.gz"))
             anat_files.append(get_best_anat(_anat_files))
             sub_outdirs.append(_outdir)
+    if preflight:
+        keep = select_valid(
+            anat_files,
+            outfile=os.path.join(outdir, (
+                f"{name}_preflight.tsv" if shard_count == 1 else
+                f"{name}_preflight_shard-{shard_index:03d}.tsv")),
+            njobs=njobs)
+        anat_files, sub_outdirs = [
+            [item[idx] for idx in keep]
+            for item in (anat_files, sub_outdirs)]
+    if shard_count > 1:
+        keep = select_shard(anat_files, shard_index, shard_count,
+                            cost_file=cost_file)
+        anat_files, sub_outdirs = [
+            [item[idx] for idx in keep]
+            for item in (anat_files, sub_outdirs)]
     if len(anat_files) == 0:
         raise RuntimeError("No data to process!")
     if test:
@@ -102,19 +148,34 @@ def run(datadir, outdir, simg_file, cmd=None, name="deface", process=False,
         if cmd is None:
             cmd = (f"singularity run --bind {os.path.dirname(datadir)} "
                    f"--cleanenv {simg_file} brainprep deface")
-        status, exitcodes = hopla(
-            cmd,
-            anatomical=anat_files,
-            outdir=sub_outdirs,
-            hopla_name_replace=True,
-            hopla_iterative_kwargs=["anatomical", "outdir"],
-            hopla_optional=["anatomical", "outdir"],
-            hopla_cpus=njobs,
-            hopla_logfile=logfile,
-            hopla_use_subprocess=True,
-            hopla_verbose=1,
-            hopla_python_cmd=None,
-            **pbs_kwargs)
+        if queue_dir is not None:
+            status, exitcodes = run_queue(
+                cmd, queue_dir,
+                optional=["anatomical", "outdir"],
+                iterative={"anatomical": anat_files, "outdir": sub_outdirs},
+                njobs=njobs)
+        elif batch_size > 1:
+            status, exitcodes = run_batches(
+                cmd, batch_size, os.path.join(logdir, f"{name}_{date}"),
+                optional=["anatomical", "outdir"],
+                iterative={"anatomical": anat_files, "outdir": sub_outdirs},
+                hopla_cpus=njobs,
+                hopla_logfile=logfile,
+                **pbs_kwargs)
+        else:
+            status, exitcodes = hopla(
+                cmd,
+                anatomical=anat_files,
+                outdir=sub_outdirs,
+                hopla_name_replace=True,
+                hopla_iterative_kwargs=["anatomical", "outdir"],
+                hopla_optional=["anatomical", "outdir"],
+                hopla_cpus=njobs,
+                hopla_logfile=logfile,
+                hopla_use_subprocess=True,
+                hopla_verbose=1,
+                hopla_python_cmd=None,
+                **pbs_kwargs)
 
 
 if __name__ == "__main__":
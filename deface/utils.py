@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+def get_best_anat(files):
+    """ Select the best anat file.
+    """
+    if len(files) == 1:
+        return files[0]
+    elif len(files) > 1:
+        select = [path for path in files if "yGC" in path]
+        assert len(select) == 1, files
+        return select[0]
+    else:
+        raise ValueError("No anatomical file provided!")
@@ -9,11 +9,17 @@
 
 # Imports
 import os
+import sys
 import json
 import glob
 import datetime
 import traceback
 from hopla.converter import hopla
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.batch import run_batches  # noqa: E402
+from tools.job_queue import run_queue  # noqa: E402
+from tools.preflight import select_valid  # noqa: E402
+from tools.sharding import select_shard  # noqa: E402
 
 
 def get_best_anat(files):
@@ -30,7 +36,9 @@ def get_best_anat(files):
 
 
 def run(datadir, outdir, simg_file, name="dmriprep",
-        process=False, njobs=10, use_pbs=False, test=False):
+        process=False, njobs=10, use_pbs=False, test=False, preflight=True,
+        batch_size=1, shard_index=0, shard_count=1, cost_file=None,
+        queue_dir=None):
     """ Parse data and execute the processing with hopla.
 
     Parameters
@@ -51,7 +59,30 @@ def run(datadir, outdir, simg_file, name="dmriprep",
         optionnaly use PBSPRO batch submission system.
     test: bool, default False
         optionnaly, select only one subject.
+    preflight: bool, default True
+        optionnaly, check the input images headers before processing and
+        exclude the runs with invalid inputs.
+    batch_size: int, default 1
+        optionnaly, group the subjects by batches that are processed in a
+        single container invocation, with per subject logs and exit status.
+    shard_index: int, default 0
+        optionnaly, the index of the shard of runs processed by this call
+        (see shard_count).
+    shard_count: int, default 1
+        optionnaly, split the runs in this number of disjoint shards
+        balanced by predicted cost (see tools.sharding.select_shard), so
+        that several machines can process the same cohort.
+    cost_file: str, default None
+        optionnaly, a .tsv table with the 'path' (the run input) and 'cost'
+        (e.g. a past runtime) columns used to balance the shards.
+    queue_dir: str, default None
+        optionnaly, run the subjects through a work-stealing queue in this
+        shared directory (see tools/job_queue.py): more workers can join
+        from any host that sees the directory (not compatible with use_pbs).
     """
+    if queue_dir is not None and use_pbs:
+        raise ValueError("the queue_dir and use_pbs options are not "
+                         "compatible: the queue workers run locally")
     list_sub_ses = [
         path for path in glob.glob(os.path.join(datadir, "sub-*", "ses-*"))
         if os.path.isdir(path)]
@@ -133,6 +164,24 @@ def run(datadir, outdir, simg_file, name="dmriprep",
         list_bval.append(bval_files)
         list_pe.append(pe_extracted)
         list_readout.append(readout_extracted)
+    if preflight:
+        keep = select_valid(
+            list_dwi,
+            outfile=os.path.join(outdir, (
+                f"{name}_preflight.tsv" if shard_count == 1 else
+                f"{name}_preflight_shard-{shard_index:03d}.tsv")),
+            njobs=njobs)
+        list_dwi, list_bvec, list_bval, list_pe, list_readout, list_outdir = [
+            [item[idx] for idx in keep]
+            for item in (list_dwi, list_bvec, list_bval, list_pe,
+                         list_readout, list_outdir)]
+    if shard_count > 1:
+        keep = select_shard(list_dwi, shard_index, shard_count,
+                            cost_file=cost_file)
+        list_dwi, list_bvec, list_bval, list_pe, list_readout, list_outdir = [
+            [item[idx] for idx in keep]
+            for item in (list_dwi, list_bvec, list_bval, list_pe,
+                         list_readout, list_outdir)]
     if test:
         list_dwi = list_dwi[:1]
         list_bvec = list_bvec[:1]
@@ -171,24 +220,49 @@ def run(datadir, outdir, simg_file, name="dmriprep",
         logfile = os.path.join(logdir, f"{name}_{date}.log")
         cmd = (f"singularity run --bind {os.path.dirname(datadir)} "
                f"{simg_file} brainprep dmriprep")
-        status, exitcodes = hopla(
-            cmd,
-            dwi=list_dwi,
-            bvec=list_bvec,
-            bval=list_bval,
-            pe=list_pe,
-            readout_time=list_readout,
-            output_dir=list_outdir,
-            hopla_iterative_kwargs=["dwi", "bvec", "bval",
-                                    "pe", "readout_time", "output_dir"],
-            hopla_optional=["dwi", "bvec", "bval",
-                            "pe", "readout_time", "output_dir"],
-            hopla_cpus=njobs,
-            hopla_logfile=logfile,
-            hopla_use_subprocess=True,
-            hopla_verbose=1,
-            hopla_python_cmd=None,
-            **pbs_kwargs)
+        if queue_dir is not None:
+            status, exitcodes = run_queue(
+                cmd, queue_dir,
+                optional=["dwi", "bvec", "bval", "pe", "readout_time",
+                          "output_dir"],
+                iterative={"dwi": list_dwi, "bvec": list_bvec,
+                           "bval": list_bval, "pe": list_pe,
+                           "readout_time": list_readout,
+                           "output_dir": list_outdir},
+                name_replace=False,
+                njobs=njobs)
+        elif batch_size > 1:
+            status, exitcodes = run_batches(
+                cmd, batch_size, os.path.join(logdir, f"{name}_{date}"),
+                optional=["dwi", "bvec", "bval", "pe", "readout_time",
+                          "output_dir"],
+                iterative={"dwi": list_dwi, "bvec": list_bvec,
+                           "bval": list_bval, "pe": list_pe,
+                           "readout_time": list_readout,
+                           "output_dir": list_outdir},
+                name_replace=False,
+                hopla_cpus=njobs,
+                hopla_logfile=logfile,
+                **pbs_kwargs)
+        else:
+            status, exitcodes = hopla(
+                cmd,
+                dwi=list_dwi,
+                bvec=list_bvec,
+                bval=list_bval,
+                pe=list_pe,
+                readout_time=list_readout,
+                output_dir=list_outdir,
+                hopla_iterative_kwargs=["dwi", "bvec", "bval",
+                                        "pe", "readout_time", "output_dir"],
+                hopla_optional=["dwi", "bvec", "bval",
+                                "pe", "readout_time", "output_dir"],
+                hopla_cpus=njobs,
+                hopla_logfile=logfile,
+                hopla_use_subprocess=True,
+                hopla_verbose=1,
+                hopla_python_cmd=None,
+                **pbs_kwargs)
 
 
 if __name__ == "__main__":
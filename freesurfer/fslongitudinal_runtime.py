@@ -10,9 +10,14 @@
 
 # Imports
 import os
+import sys
 import fire
 import datetime
 from hopla.converter import hopla
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.batch import run_batches  # noqa: E402
+from tools.job_queue import run_queue  # noqa: E402
+from tools.sharding import select_shard  # noqa: E402
 
 
 def get_best_anat(files):
@@ -30,7 +35,8 @@ def get_best_anat(files):
 
 def run(datadir, outdir, template_dir, fs_license_file, simg_file,
         name="freesurfer_long", process=False, njobs=10, use_pbs=False,
-        test=False):
+        test=False, batch_size=1, shard_index=0, shard_count=1,
+        cost_file=None, queue_dir=None):
     """ Parse data and execute the processing with hopla.
 
     Parameters
@@ -55,7 +61,28 @@ def run(datadir, outdir, template_dir, fs_license_file, simg_file,
         optionnaly use PBSPRO batch submission system.
     test: bool, default False
         optionnaly, select only one subject.
+    batch_size: int, default 1
+        optionnaly, group the subjects by batches that are processed in a
+        single container invocation, with per subject logs and exit status.
+    shard_index: int, default 0
+        optionnaly, the index of the shard of runs processed by this call
+        (see shard_count).
+    shard_count: int, default 1
+        optionnaly, split the runs in this number of disjoint shards
+        balanced by predicted cost (see tools.sharding.select_shard), so
+        that several machines can process the same cohort.
+    cost_file: str, default None
+        optionnaly, a .tsv table with the 'path' (the comma separated
+        mri/orig.mgz of the timepoints of a subject) and 'cost' (e.g. a past
+        runtime) columns used to balance the shards.
+    queue_dir: str, default None
+        optionnaly, run the subjects through a work-stealing queue in this
+        shared directory (see tools/job_queue.py): more workers can join
+        from any host that sees the directory (not compatible with use_pbs).
     """
+    if queue_dir is not None and use_pbs:
+        raise ValueError("the queue_dir and use_pbs options are not "
+                         "compatible: the queue workers run locally")
     subjects, sub_outdirs = [], []
     timepoints = ["ses-M00", "ses-M03"]
     fsdirs = [os.path.join(outdir, "freesurfer", tp) for tp in timepoints]
@@ -70,6 +97,16 @@ def run(datadir, outdir, template_dir, fs_license_file, simg_file,
             os.makedirs(_outdir)
         subjects.append(subject)
         sub_outdirs.append(_outdir)
+    if shard_count > 1:
+        # the cost of a subject is predicted from the cross-sectional inputs
+        # of all its timepoints
+        keep = select_shard(
+            [",".join(os.path.join(fsdir, subject, "mri", "orig.mgz")
+                      for fsdir in fsdirs) for subject in subjects],
+            shard_index, shard_count, cost_file=cost_file)
+        subjects, sub_outdirs = [
+            [item[idx] for idx in keep]
+            for item in (subjects, sub_outdirs)]
     if test:
         subjects = subjects[:1]
         sub_outdirs = sub_outdirs[:1]
@@ -102,22 +139,43 @@ def run(datadir, outdir, template_dir, fs_license_file, simg_file,
         cmd = (f"singularity run --bind {fs_license_file}:/opt/freesurfer/"
                f".license --bind {os.path.dirname(datadir)} --cleanenv "
                f"{simg_file} brainprep fsreconall-longitudinal")
-        status, exitcodes = hopla(
-            cmd,
-            sid=subjects,
-            fsdirs=fsdirs,
-            outdir=sub_outdirs,
-            timepoints=",".join(timepoints),
-            template_dir=template_dir,
-            hopla_name_replace=True,
-            hopla_iterative_kwargs=["sid", "outdir"],
-            hopla_optional=["sid", "outdir"],
-            hopla_cpus=njobs,
-            hopla_logfile=logfile,
-            hopla_use_subprocess=True,
-            hopla_verbose=1,
-            hopla_python_cmd=None,
-            **pbs_kwargs)
+        if queue_dir is not None:
+            status, exitcodes = run_queue(
+                cmd, queue_dir,
+                optional=["sid", "outdir"],
+                iterative={"sid": subjects, "outdir": sub_outdirs},
+                constants={"fsdirs": fsdirs,
+                           "timepoints": ",".join(timepoints),
+                           "template_dir": template_dir},
+                njobs=njobs)
+        elif batch_size > 1:
+            status, exitcodes = run_batches(
+                cmd, batch_size, os.path.join(logdir, f"{name}_{date}"),
+                optional=["sid", "outdir"],
+                iterative={"sid": subjects, "outdir": sub_outdirs},
+                constants={"fsdirs": fsdirs,
+                           "timepoints": ",".join(timepoints),
+                           "template_dir": template_dir},
+                hopla_cpus=njobs,
+                hopla_logfile=logfile,
+                **pbs_kwargs)
+        else:
+            status, exitcodes = hopla(
+                cmd,
+                sid=subjects,
+                fsdirs=fsdirs,
+                outdir=sub_outdirs,
+                timepoints=",".join(timepoints),
+                template_dir=template_dir,
+                hopla_name_replace=True,
+                hopla_iterative_kwargs=["sid", "outdir"],
+                hopla_optional=["sid", "outdir"],
+                hopla_cpus=njobs,
+                hopla_logfile=logfile,
+                hopla_use_subprocess=True,
+                hopla_verbose=1,
+                hopla_python_cmd=None,
+                **pbs_kwargs)
 
 
 if __name__ == "__main__":
@@ -10,13 +10,17 @@
 
 # Imports
 import os
+import sys
 import fire
+import glob
 import datetime
 from hopla.converter import hopla
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.sharding import make_shards, merge_tsv  # noqa: E402
 
 
 def run(fsdir, outdir, simg_file, name="freesurfer_qc", process=False,
-        njobs=10, use_pbs=False, test=False):
+        njobs=10, use_pbs=False, test=False, nshards=1):
     """ Parse data and execute the processing with hopla.
     Parameters
     ----------
@@ -34,6 +38,10 @@ def run(fsdir, outdir, simg_file, name="freesurfer_qc", process=False,
         the number of parallel jobs.
     use_pbs: bool, default False
         optionnaly use PBSPRO batch submission system.
+    nshards: int, default 1
+        optionnaly, split the cohort in shards of subjects/sessions that are
+        processed in parallel, and merge the partial qc.tsv files (an error
+        is raised if a shard failed).
     """
 
     fs_regex = [f"{fsdir}/ses*/sub-*"]
@@ -42,6 +50,14 @@ def run(fsdir, outdir, simg_file, name="freesurfer_qc", process=False,
     if not os.path.isdir(outdir):
         os.makedirs(outdir)
 
+    shard_outdirs = [outdir]
+    if nshards > 1:
+        groups = [[path] for path in sorted(glob.glob(fs_regex[0]))]
+        shard_datadirs, shard_outdirs = make_shards(
+            groups, fsdir, os.path.join(outdir, "shards"), nshards)
+        fs_regex = [f"{_datadir}/ses*/sub-*" for _datadir in shard_datadirs]
+        print(f"number of shards: {len(fs_regex)}")
+
     if process:
         pbs_kwargs = {}
         if use_pbs:
@@ -62,15 +78,17 @@ def run(fsdir, outdir, simg_file, name="freesurfer_qc", process=False,
         status, exitcodes = hopla(
             cmd,
             fs_regex=fs_regex,
-            outdir=outdir,
-            hopla_iterative_kwargs=["fs_regex"],
-            hopla_optional=["fs_regex"],
+            outdir=shard_outdirs,
+            hopla_iterative_kwargs=["fs_regex", "outdir"],
+            hopla_optional=["fs_regex", "outdir"],
             hopla_cpus=njobs,
             hopla_logfile=logfile,
             hopla_use_subprocess=True,
             hopla_verbose=1,
             hopla_python_cmd=None,
             **pbs_kwargs)
+        if nshards > 1:
+            merge_tsv(shard_outdirs, outdir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import glob
+import pickle
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.nifti_cache import cache_key  # noqa: E402
+
+
+# Table columns that are identifiers and not measures.
+SKIP_COLUMNS = ("Index", "SegId", "StructName")
+
+
+def parse_stats(path):
+    """ Parse a FreeSurfer .stats file: the data lines that are empty or
+    whose number of fields differs from the header are skipped.
+
+    Parameters
+    ----------
+    path: str
+        path to an aseg.stats or ?h.<parcellation>.stats file.
+
+    Returns
+    -------
+    records: list of (str, str, float)
+        the (structure, measure, value) records: global measures are
+        reported with a 'global' structure.
+    """
+    records, header = [], None
+    with open(path, "rt") as of:
+        for line in of:
+            if line.startswith("# Measure "):
+                items = [item.strip() for item in line[10:].split(",")]
+                records.append(("global", items[1], float(items[3])))
+            elif line.startswith("# ColHeaders "):
+                header = line.split()[2:]
+            elif not line.startswith("#") and header is not None:
+                fields = line.split()
+                # skip the blank or truncated lines
+                if len(fields) != len(header):
+                    continue
+                values = dict(zip(header, fields))
+                structure = values["StructName"]
+                for measure in header:
+                    if measure in SKIP_COLUMNS:
+                        continue
+                    records.append(
+                        (structure, measure, float(values[measure])))
+    return records
+
+
+def stats_files(subdir, parcellations=("aparc", "aparc.a2009s")):
+    """ List the stats files of a FreeSurfer subject directory.
+    """
+    names = ["aseg"] + [f"{hemi}.{parc}" for parc in parcellations
+                        for hemi in ("lh", "rh")]
+    files = [os.path.join(subdir, "stats", f"{name}.stats") for name in names]
+    return [(name, path) for name, path in zip(names, files)
+            if os.path.isfile(path)]
+
+
+def parse_subject(subdir, parcellations=("aparc", "aparc.a2009s")):
+    """ Parse the stats files of a FreeSurfer subject directory.
+    """
+    records = []
+    for name, path in stats_files(subdir, parcellations=parcellations):
+        records.extend((name, ) + item for item in parse_stats(path))
+    return records
+
+
+def list_runs(fsdir, fslongdir=None):
+    """ List the cross-sectional 'ses-*/sub-*' and longitudinal
+    'sub-*/<session>.long.*' FreeSurfer subject directories.
+    """
+    runs = []
+    for subdir in sorted(glob.glob(os.path.join(fsdir, "ses-*", "sub-*"))):
+        session, subject = subdir.split(os.sep)[-2:]
+        runs.append((subject, session, False, subdir))
+    if fslongdir is not None:
+        for subdir in sorted(glob.glob(os.path.join(
+                fslongdir, "sub-*", "*.long.*"))):
+            subject, basename = subdir.split(os.sep)[-2:]
+            session = basename.split(".long.")[0]
+            runs.append((subject, session, True, subdir))
+    return runs
+
+
+def harvest(fsdir, outdir, fslongdir=None,
+            parcellations=("aparc", "aparc.a2009s"), njobs=10):
+    """ Gather the FreeSurfer aseg and aparc stats of all the subjects in a
+    long and a wide table.
+
+    The stats files are parsed in parallel, and the parsed records are
+    cached per subject/session with the path, mtime and size of its stats
+    files: only the new or modified subjects are parsed again.
+
+    Parameters
+    ----------
+    fsdir: str
+        path to the cross-sectional FreeSurfer directory (with the
+        'ses-*/sub-*' subject directories).
+    outdir: str
+        path to the output directory.
+    fslongdir: str, default None
+        optionnaly, path to the longitudinal FreeSurfer directory (with the
+        'sub-*/<session>.long.*' subject directories).
+    parcellations: list of str, default ('aparc', 'aparc.a2009s')
+        the cortical parcellations to gather.
+    njobs: int, default 10
+        the number of parallel parsers.
+    """
+    parcellations = tuple(parcellations)
+    runs = list_runs(fsdir, fslongdir=fslongdir)
+    if len(runs) == 0:
+        raise RuntimeError("No data to process!")
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    cache_file = os.path.join(outdir, "freesurfer_stats.pkl")
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file, "rb") as of:
+            cache = pickle.load(of)
+        if cache.get("parcellations") != parcellations:
+            cache = {}
+    records = cache.get("records", {})
+    keys = dict(
+        (subdir, tuple(cache_key(path) for _, path in stats_files(
+            subdir, parcellations=parcellations)))
+        for _, _, _, subdir in runs)
+    todo = [subdir for _, _, _, subdir in runs
+            if subdir not in records or records[subdir][0] != keys[subdir]]
+    print(f"number of runs: {len(runs)} ({len(todo)} to parse)")
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=njobs) as executor:
+            parsed = list(executor.map(
+                parse_subject, todo, [parcellations] * len(todo),
+                chunksize=max(1, len(todo) // (4 * njobs))))
+    else:
+        parsed = []
+    records = dict((subdir, records[subdir]) for _, _, _, subdir in runs
+                   if subdir in records)
+    records.update(
+        (subdir, (keys[subdir], items)) for subdir, items in zip(todo, parsed))
+    tmp = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as of:
+        pickle.dump({"parcellations": parcellations, "records": records}, of)
+    os.replace(tmp, cache_file)
+
+    columns = ["participant_id", "session", "longitudinal"]
+    long_df = pd.concat([
+        pd.DataFrame(records[subdir][1],
+                     columns=["file", "structure", "measure", "value"]).assign(
+            participant_id=subject, session=session, longitudinal=long)
+        for subject, session, long, subdir in runs])
+    long_df = long_df[columns + ["file", "structure", "measure", "value"]]
+    long_file = os.path.join(outdir, "freesurfer_stats_long.tsv")
+    long_df.to_csv(long_file, sep="\t", index=False)
+    long_df["feature"] = (long_df["file"] + "_" + long_df["structure"] + "_" +
+                          long_df["measure"])
+    wide_df = long_df.pivot_table(
+        index=columns, columns="feature", values="value", aggfunc="first",
+        sort=False).reset_index()
+    wide_df.columns.name = None
+    wide_file = os.path.join(outdir, "freesurfer_stats_wide.tsv")
+    wide_df.to_csv(wide_file, sep="\t", index=False)
+    print(wide_df.shape)
+    print(long_file)
+    print(wide_file)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(harvest)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import glob
+import nibabel
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.volumes import open_volume, scale, flat_indices  # noqa: E402
+from tools.participants import load_participants  # noqa: E402
+
+
+class RunningStats(object):
+    """ Voxelwise running mean and variance (Welford's algorithm).
+
+    Only the current accumulators are kept in memory: the subjects are
+    added one at a time, and the accumulators of several workers are merged
+    with the Chan et al. parallel update.
+    """
+    def __init__(self, size):
+        """ Init class.
+
+        Parameters
+        ----------
+        size: int
+            the number of voxels.
+        """
+        self.count = 0
+        self.mean = np.zeros(size, dtype=np.float64)
+        self.m2 = np.zeros(size, dtype=np.float64)
+
+    def update(self, values):
+        """ Add the voxels of one subject.
+        """
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+
+    def merge(self, other):
+        """ Merge the accumulators of another worker.
+        """
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / count)
+        self.m2 += other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    @property
+    def std(self):
+        """ The sample standard deviation.
+        """
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return np.sqrt(self.m2 / (self.count - 1))
+
+
+def load_masked(path, indices, shape):
+    """ Read the voxels of a subject in the brain mask.
+    """
+    data, _, scaling = open_volume(path)
+    if data.shape[:3] != shape:
+        raise ValueError(f"{path}: shape {data.shape} does not match the "
+                         f"mask shape {shape}")
+    flat = data.reshape(-1, order="F")
+    values = scale(flat[indices], scaling, dtype=np.float64)
+    return np.nan_to_num(values, copy=False)
+
+
+def accumulate(runs, indices, shape):
+    """ Accumulate the cohort and per site statistics of a chunk of runs.
+    """
+    cohort = RunningStats(len(indices))
+    sites = {}
+    for path, site in runs:
+        values = load_masked(path, indices, shape)
+        cohort.update(values)
+        sites.setdefault(site, RunningStats(len(indices))).update(values)
+    return cohort, sites
+
+
+def zscores(path, site, indices, shape, cohort, sites, zthr=3.):
+    """ Summarize the voxelwise z-scores of a subject with respect to the
+    cohort and to its site.
+    """
+    values = load_masked(path, indices, shape)
+    record = {"mean_value": float(values.mean())}
+    for prefix, stats in (("cohort", cohort), ("site", sites[site])):
+        std = stats.std
+        valid = std > 0
+        zmap = np.abs(values[valid] - stats.mean[valid]) / std[valid]
+        record[f"{prefix}_mean_abs_zscore"] = (
+            float(zmap.mean()) if zmap.size > 0 else 0.)
+        record[f"{prefix}_max_abs_zscore"] = float(zmap.max(initial=0.))
+        record[f"{prefix}_outlier_fraction"] = (
+            float((zmap > zthr).mean()) if zmap.size > 0 else 0.)
+    return record
+
+
+def save_map(values, indices, shape, affine, path):
+    """ Save masked voxels as a float32 NIfTI image.
+    """
+    arr = np.zeros(int(np.prod(shape)), dtype=np.float32)
+    arr[indices] = values
+    im = nibabel.Nifti1Image(arr.reshape(shape, order="F"), affine)
+    nibabel.save(im, path)
+
+
+def cohort_stats(datadir, outdir, participant_file, norm=False,
+                 mask_file=None, njobs=10, zthr=3., frac_thr=0.05):
+    """ Compute the cohort and per site voxelwise mean and standard deviation
+    maps of the lithium images in the MNI space, and a per subject z-score
+    outlier table.
+
+    The images are streamed one subject at a time: each worker accumulates
+    the statistics of a chunk of subjects and the workers are then merged, so
+    that the memory does not depend on the cohort size. A second pass
+    computes the z-scores of each subject.
+
+    Parameters
+    ----------
+    datadir: str
+        path to the li2mni BIDS derivatives directory.
+    outdir: str
+        path to the output directory.
+    participant_file: str
+        path to the participants.tsv file (in order to get the sites).
+    norm: bool, default False
+        optionnaly use the normalized li2mninorm.nii.gz images instead of
+        the li2mni.nii.gz images.
+    mask_file: str, default None
+        path to the brain mask, by default the limri MNI 2mm brain mask.
+    njobs: int, default 10
+        the number of parallel workers.
+    zthr: float, default 3
+        the absolute voxel z-score above which a voxel is an outlier.
+    frac_thr: float, default 0.05
+        the fraction of outlier voxels above which a subject is flagged.
+    """
+    name = "li2mninorm" if norm else "li2mni"
+    files = sorted(glob.glob(os.path.join(
+        datadir, "sub-*", "ses-M03Li", f"{name}.nii.gz")))
+    if len(files) == 0:
+        raise RuntimeError("No data to process!")
+    print(f"number of runs: {len(files)}")
+    info = load_participants(participant_file)
+    subjects = [path.split(os.sep)[-3] for path in files]
+    site_ids = [int(info.site(sid, "ses-M03Li", default=0))
+                for sid in subjects]
+    if mask_file is None:
+        import limri
+        mask_file = os.path.join(
+            os.path.dirname(limri.__file__), "resources",
+            "MNI152_T1_2mm_brain_mask.nii.gz")
+    mask_im = nibabel.load(mask_file)
+    shape = mask_im.shape[:3]
+    indices = flat_indices(np.asarray(mask_im.dataobj) > 0)
+    print(f"number of voxels: {len(indices)}")
+
+    runs = list(zip(files, site_ids))
+    chunks = [runs[idx::njobs] for idx in range(njobs)]
+    chunks = [chunk for chunk in chunks if len(chunk) > 0]
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        results = list(executor.map(
+            lambda chunk: accumulate(chunk, indices, shape), chunks))
+    cohort, sites = RunningStats(len(indices)), {}
+    for _cohort, _sites in results:
+        cohort.merge(_cohort)
+        for site, stats in _sites.items():
+            sites.setdefault(site, RunningStats(len(indices))).merge(stats)
+    del results
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    for prefix, stats in [("cohort", cohort)] + [
+            (f"site-{site}", sites[site]) for site in sorted(sites)]:
+        for key, values in (("mean", stats.mean), ("std", stats.std)):
+            save_map(values, indices, shape, mask_im.affine,
+                     os.path.join(outdir, f"{prefix}_{name}_{key}.nii.gz"))
+        print(f"{prefix}: {stats.count} runs")
+
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        records = list(executor.map(
+            lambda run: zscores(run[0], run[1], indices, shape, cohort, sites,
+                                zthr=zthr), runs))
+    df = pd.DataFrame.from_records(records)
+    df.insert(0, "participant_id", subjects)
+    df.insert(1, "site", site_ids)
+    df["qc"] = ((df["cohort_outlier_fraction"] <= frac_thr) &
+                (df["site_outlier_fraction"] <= frac_thr)).astype(int)
+    outfile = os.path.join(outdir, f"{name}_outliers.tsv")
+    df.to_csv(outfile, sep="\t", index=False)
+    print(df[df["qc"] == 0])
+    print(outfile)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(cohort_stats)
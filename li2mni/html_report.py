@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import json
+import string
+import pandas as pd
+from tqdm import tqdm
+from PIL import Image, features
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.participants import load_participants  # noqa: E402
+
+
+PAGE = string.Template("""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>$title</title>
+<style>
+body { font-family: sans-serif; margin: 1em; }
+#grid { display: flex; flex-wrap: wrap; gap: 1em; }
+.card { border: 1px solid #ccc; padding: .5em; width: ${width}px; }
+.card img { width: 100%; }
+.card.rejected { border-color: #d33; }
+.nav { margin: 1em 0; }
+</style>
+</head>
+<body>
+<h1>$title</h1>
+<div class="nav">
+  site <select id="site"></select>
+  <button id="prev">&lt;</button> <span id="page"></span>
+  <button id="next">&gt;</button>
+  <button id="export">export qc.csv</button>
+  <span id="count"></span>
+</div>
+<div id="grid"></div>
+<script>
+var ROWS = $rows;
+var TABLE = $table;
+var COLUMNS = $columns;
+var PER_PAGE = $per_page;
+var KEY = "rlink-qc:" + document.title;
+var scores = JSON.parse(localStorage.getItem(KEY) || "{}");
+var state = {site: "all", page: 0};
+
+function selected() {
+  return ROWS.filter(function(r) {
+    return state.site == "all" || String(r.site) == state.site;
+  });
+}
+
+function score(row, value) {
+  scores[row.key] = value;
+  localStorage.setItem(KEY, JSON.stringify(scores));
+  render();
+}
+
+function render() {
+  var rows = selected();
+  var npages = Math.max(1, Math.ceil(rows.length / PER_PAGE));
+  state.page = Math.min(state.page, npages - 1);
+  var grid = document.getElementById("grid");
+  grid.innerHTML = "";
+  rows.slice(state.page * PER_PAGE, (state.page + 1) * PER_PAGE).forEach(
+    function(row) {
+      var value = scores[row.key] || row.visual_qc_score || 0;
+      var card = document.createElement("div");
+      card.className = "card" + (value == 3 ? " rejected" : "");
+      card.innerHTML = '<a href="' + row.image + '" target="_blank">' +
+        '<img loading="lazy" src="' + row.thumbnail + '"></a>' +
+        '<div>' + row.name + ' (site ' + row.site + ')</div>';
+      [1, 2, 3].forEach(function(code) {
+        var label = document.createElement("label");
+        var input = document.createElement("input");
+        input.type = "radio";
+        input.name = row.key;
+        input.checked = (value == code);
+        input.onchange = function() { score(row, code); };
+        label.appendChild(input);
+        label.appendChild(document.createTextNode(code + " "));
+        card.appendChild(label);
+      });
+      grid.appendChild(card);
+    });
+  document.getElementById("page").textContent = (
+    (state.page + 1) + " / " + npages);
+  var done = rows.filter(function(r) { return scores[r.key]; }).length;
+  document.getElementById("count").textContent = (
+    done + " / " + rows.length + " scored");
+}
+
+function exportCsv() {
+  var lines = [COLUMNS.join("\\t")];
+  var records = TABLE.map(function(record) {
+    return Object.assign({}, record); });
+  ROWS.forEach(function(row) {
+    var record = records[row.index];
+    if (row.index === null) {
+      record = Object.assign({}, row.record);
+      records.push(record);
+    }
+    var value = scores[row.key];
+    if (value) {
+      record.visual_qc_score = value;
+      record.qc = (value == 3) ? 0 : 1;
+    }
+  });
+  records.forEach(function(record) {
+    lines.push(COLUMNS.map(function(c) {
+      return (record[c] === null || record[c] === undefined) ? "" : record[c];
+    }).join("\\t"));
+  });
+  var blob = new Blob([lines.join("\\n") + "\\n"],
+                      {type: "text/tab-separated-values"});
+  var link = document.createElement("a");
+  link.href = URL.createObjectURL(blob);
+  link.download = "qc.csv";
+  link.click();
+}
+
+var sites = ["all"].concat(Array.from(new Set(ROWS.map(function(r) {
+  return String(r.site); }))).sort());
+var select = document.getElementById("site");
+sites.forEach(function(s) {
+  var option = document.createElement("option");
+  option.value = option.textContent = s;
+  select.appendChild(option);
+});
+select.onchange = function() {
+  state.site = select.value; state.page = 0; render(); };
+document.getElementById("prev").onclick = function() {
+  state.page = Math.max(0, state.page - 1); render(); };
+document.getElementById("next").onclick = function() {
+  state.page += 1; render(); };
+document.getElementById("export").onclick = exportCsv;
+render();
+</script>
+</body>
+</html>
+""")
+
+
+def make_thumbnail(png_file, thumb_file, width=600):
+    """ Write a compressed thumbnail of a snapshot.
+    """
+    if os.path.isfile(thumb_file):
+        return thumb_file
+    with Image.open(png_file) as png:
+        png = png.convert("RGBA")
+        image = Image.new("RGB", png.size, (255, 255, 255))
+        image.paste(png, mask=png.split()[3])
+    image.thumbnail((width, width * image.size[1] // image.size[0]))
+    if thumb_file.endswith(".webp"):
+        image.save(thumb_file, "WEBP", quality=80, method=4)
+    else:
+        image.save(thumb_file, "PNG", optimize=True)
+    return thumb_file
+
+
+def report(png_dir, outdir, participants=None, qc_file=None,
+           site_column="ses-M03Li_center", per_page=24, width=600,
+           njobs=8, title="R-Link QC"):
+    """ Generate an offline html viewer to perform the visual quality check.
+
+    The viewer works from the local filesystem: thumbnails are lazily loaded
+    page by page, the full resolution snapshots are opened on click, and the
+    reviewer scores are exported in the qc.csv format.
+
+    Parameters
+    ----------
+    png_dir: str
+        path to the folder with the subjects png files generated by
+        qc1.all or make_mni_snapshot.cohorte.
+    outdir: str
+        path to the destination folder.
+    participants: str, default None
+        path to the participants.tsv file (in order to get site).
+    qc_file: str, default None
+        path to the qc.csv file generated by qc1.all or qc2.make_csv: the
+        exported file then contains all its rows, with the scores of the
+        reviewed snapshots updated.
+    site_column: str, default 'ses-M03Li_center'
+        the participants.tsv column that contains the site.
+    per_page: int, default 24
+        the number of snapshots per page.
+    width: int, default 600
+        the width of the thumbnails in pixels.
+    njobs: int, default 8
+        the number of parallel thumbnail writers.
+    title: str, default 'R-Link QC'
+        the title of the html page.
+    """
+    thumbdir = os.path.join(outdir, "thumbnails")
+    if not os.path.isdir(thumbdir):
+        os.makedirs(thumbdir)
+    ext = ".webp" if features.check("webp") else ".png"
+    pngs = sorted(name for name in os.listdir(png_dir)
+                  if name.startswith("sub-") and name.endswith(".png"))
+    index = None
+    if participants is not None:
+        index = load_participants(participants)
+    df_qc = None
+    table, table_index = [], {}
+    if qc_file is not None:
+        df_qc = pd.read_csv(qc_file, sep="\t", dtype={"rec": str})
+        table = df_qc.astype(object).where(df_qc.notna(), None).to_dict(
+            "records")
+        for idx, record in enumerate(table):
+            if isinstance(record.get("site"), float):
+                record["site"] = int(record["site"])
+            table_index.setdefault((record["participant_id"], None), idx)
+            if "rec" in df_qc:
+                table_index.setdefault(
+                    (record["participant_id"], str(record["rec"])), idx)
+
+    thumbs = [os.path.join(thumbdir, name.replace(".png", ext))
+              for name in pngs]
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        list(tqdm(executor.map(
+            lambda args: make_thumbnail(*args, width=width),
+            zip([os.path.join(png_dir, name) for name in pngs], thumbs)),
+            total=len(pngs)))
+
+    rows = []
+    for name, thumb in zip(pngs, thumbs):
+        sub = name.split("_")[0]
+        record = {"participant_id": sub, "ses": "M03Li",
+                  "site": (index.get(sub, site_column, default=0)
+                           if index is not None else 0),
+                  "visual_qc_score": 0, "qc": 1}
+        if "rec-" in name:
+            record["rec"] = name.split("rec-")[1].split("_")[0]
+        table_idx = None
+        if df_qc is not None:
+            table_idx = table_index.get((sub, (
+                record["rec"] if "rec" in record and "rec" in df_qc
+                else None)))
+            if table_idx is not None:
+                record = dict(table[table_idx])
+        if isinstance(record["site"], float):
+            record["site"] = int(record["site"])
+        rows.append({
+            "key": os.path.splitext(name)[0],
+            "name": os.path.splitext(name)[0],
+            "site": record["site"],
+            "visual_qc_score": record.get("visual_qc_score") or 0,
+            "image": os.path.relpath(os.path.join(png_dir, name), outdir),
+            "thumbnail": os.path.relpath(thumb, outdir),
+            "index": table_idx,
+            "record": record})
+    if df_qc is not None:
+        columns = list(df_qc.columns)
+    else:
+        columns = ["participant_id", "ses", "site", "visual_qc_score", "qc"]
+        if any("rec" in row["record"] for row in rows):
+            columns.insert(3, "rec")
+    html_file = os.path.join(outdir, "index.html")
+    with open(html_file, "wt") as of:
+        of.write(PAGE.substitute(
+            title=title, width=width, per_page=int(per_page),
+            rows=json.dumps(rows, default=str),
+            table=json.dumps(table, default=str),
+            columns=json.dumps(columns)))
+    print(html_file)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(report)
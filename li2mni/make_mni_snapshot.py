@@ -11,15 +11,22 @@
 # Imports
 import fire
 import os
+import sys
+import collections
 from nilearn import plotting
 from PIL import Image
 import shutil
-import pandas as pd
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.nifti_cache import warm  # noqa: E402
+from tools.participants import load_participants  # noqa: E402
 
 
 def overlay_nifti(template_file, overlay_file, output_file,
-                  cmap='jet', dpi=900):
+                  cmap='jet', dpi=900, paths=None):
     sub = template_file.split("sub-")[1].split("/ses")[0]
+    paths = paths or {}
+    template_file = paths.get(template_file, template_file)
+    overlay_file = paths.get(overlay_file, overlay_file)
     display = plotting.plot_anat(template_file, display_mode="ortho",
                                  cut_coords=(-35, -18, -38),
                                  title=f"sub-{sub}")
@@ -30,8 +37,69 @@ def overlay_nifti(template_file, overlay_file, output_file,
     display.close()
 
 
+def site_index(png_dir, participants):
+    """ Group the subjects png files by site.
+
+    The participants index is loaded once from the participants.tsv file
+    and the png files are left in place.
+
+    Parameters
+    ----------
+    png_dir: str
+        path to the folder containing the subjects png files.
+    participants: str
+        path to the participants.tsv file.
+
+    Returns
+    -------
+    sites: dict
+        the sorted png files of each site.
+    """
+    index = load_participants(participants)
+    sites = collections.defaultdict(list)
+    for png in sorted(os.listdir(png_dir)):
+        if not png.startswith("sub-") or not png.endswith(".png"):
+            continue
+        sub = png.split("_")[0]
+        site = str(int(index.site(sub, "ses-M00")))
+        sites[site].append(os.path.join(png_dir, png))
+    return sites
+
+
+def link_site_dirs(png_dir, sites):
+    """ Expose the site grouping as 'site-<n>' folders of hardlinks, and
+    fall back to a copy when the destination is on another device.
+    """
+    for site, pngs in sites.items():
+        site_dir = os.path.join(png_dir, f"site-{site}")
+        os.makedirs(site_dir, exist_ok=True)
+        for path in pngs:
+            basename = os.path.basename(path).replace(
+                "_over", f"_site-{site}_over")
+            dest = os.path.join(site_dir, basename)
+            if os.path.isfile(dest):
+                continue
+            try:
+                os.link(path, dest)
+            except OSError:
+                shutil.copy2(path, dest)
+
+
+def make_pdf(pngs, pdf_path):
+    """ Stream png files in a pdf: pages are appended one at a time so that
+    a single image is loaded in memory.
+    """
+    for idx, path in enumerate(pngs):
+        with Image.open(path) as png:
+            png = png.convert("RGBA")
+            page = Image.new("RGB", png.size, (255, 255, 255))
+            page.paste(png, mask=png.split()[3])
+        page.save(pdf_path, "PDF", resolution=100.0, append=(idx > 0))
+
+
 def cohorte(li2mni_path, output_path, norm=False, site=False,
-            participants=None, pdf=True, dpi=900):
+            participants=None, pdf=True, dpi=900, link=False,
+            cache_dir=None, njobs=8):
     """ Launch overlay_nifti on a all cohorte.
 
     Parameters
@@ -46,7 +114,7 @@ def cohorte(li2mni_path, output_path, norm=False, site=False,
     norm: bool default False
         take the li2mni output normalized or not.
     site: bool default False
-        Reorder the png to a site by site.
+        Group the png site by site.
     participants: Bool default None
         path to the participants.tsv file. WARNING this flags is mandatory if
         site=True
@@ -54,9 +122,18 @@ def cohorte(li2mni_path, output_path, norm=False, site=False,
         make a concatenation pdf of site by site png, work only if site=True
     dpi: int default=900
         dot per inch of the png created.
+    link: bool default False
+        also expose the site grouping as 'site-<n>' folders of hardlinks to
+        the png files, work only if site=True.
+    cache_dir: str default None
+        optionnaly, decompress the images once in this cache folder (by
+        default use the RLINK_NIFTI_CACHE environment variable if set).
+    njobs: int default 8
+        the number of parallel decompressions in the cache.
     """
     list_sub = [i for i in os.listdir(li2mni_path) if i.startswith('sub')]
     print(list_sub, len(list_sub))
+    runs = []
     for sub in list_sub:
         template = f"{li2mni_path}/{sub}/ses-M03Li/li2mnianat.nii.gz"
         if norm is False:
@@ -68,51 +145,25 @@ def cohorte(li2mni_path, output_path, norm=False, site=False,
 
         if os.path.isfile(template) and os.path.isfile(overlay)\
            and os.path.isfile(output + ".png") is False:
-            print("la")
-            print(os.path.isfile(output))
-            print(output)
-            overlay_nifti(template, overlay, output, dpi=dpi)
+            runs.append((template, overlay, output))
+    paths = warm([path for run in runs for path in run[:2]],
+                 cachedir=cache_dir, njobs=njobs)
+    for template, overlay, output in runs:
+        print(output)
+        overlay_nifti(template, overlay, output, dpi=dpi, paths=paths)
 
     if site is True and participants is not None:
-        participants = pd.read_csv(participants, sep="\t")
-        path = output_path
-        list_png = [f for f in os.listdir(path) if f.startswith("sub-")]
-        liste_site = []
-        for png in list_png:
-            sub = png.split("_")[0]
-            site = int(participants["ses-M00_center"]
-                       [participants["participant_id"] == sub].values[0])
-            site = str(site)
-            os.makedirs(os.path.join(path, f"site-{site}"), exist_ok=True)
-
-            file_to_check = os.path.join(path,
-                                         f"site-{site}",
-                                         png.replace("_over",
-                                                     f"_site-{site}_over"))
-            if os.path.isfile(file_to_check) is False:
-                shutil.copy2(os.path.join(path, png), file_to_check)
-            liste_site.append(site)
-        print('cp done')
+        sites = site_index(output_path, participants)
+        if link:
+            link_site_dirs(output_path, sites)
+            print("link done")
         if pdf:
-            for site in set(liste_site):
-                images = []
-                path_site = os.path.join(path, f"site-{site}")
-                for image in os.listdir(path_site):
-                    if image.startswith("sub"):
-                        png = Image.open(os.path.join(path_site, image))
-                        png.load()
-                        background = Image.new("RGB",
-                                               png.size,
-                                               (255, 255, 255))
-                        background.paste(png, mask=png.split()[3])
-                        images.append(background)
-
-                pdf_path = os.path.join(path,
-                                        f"site-{site}",
-                                        f"recap_site-{site}.pdf")
-                images[0].save(pdf_path, "PDF", resolution=100.0,
-                               save_all=True,
-                               append_images=images[1:])
+            for _site, pngs in sorted(sites.items()):
+                os.makedirs(os.path.join(output_path, f"site-{_site}"),
+                            exist_ok=True)
+                pdf_path = os.path.join(output_path, f"site-{_site}",
+                                        f"recap_site-{_site}.pdf")
+                make_pdf(pngs, pdf_path)
                 print(pdf_path)
 
 
@@ -10,6 +10,7 @@
 
 # Imports
 import os
+import sys
 import nibabel
 import tempfile
 import numpy as np
@@ -19,6 +20,9 @@ from nilearn import plotting
 import matplotlib.pyplot as plt
 from pdf2image import convert_from_path
 from PIL import Image, ImageDraw, ImageFont
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.nifti_cache import warm  # noqa: E402
+from tools.participants import load_participants  # noqa: E402
 
 
 def create_pdf(png_folder, pdf_output, pattern, font=None):
@@ -59,7 +63,6 @@ def create_pdf(png_folder, pdf_output, pattern, font=None):
 
 def make_png(anatomical, outdir, pattern="T1wli"):
     im = nibabel.load(anatomical)
-    arr = im.get_fdata()
     outfile = os.path.join(outdir, f"{pattern}.png")
     plotting.plot_anat(im, display_mode="z",
                        cut_coords=25, black_bg=True,
@@ -83,12 +86,12 @@ def get_anat(path):
     return lignes
 
 
-def psc2_to_site(psc2, ses, df):
-    return df[df["participant_id"] == psc2][f"{ses}_center"].values[0]
+def psc2_to_site(psc2, ses, index):
+    return index.site(psc2, ses, default=0)
 
 
 def all(list_nii, outdir, font=None, pattern="T1wLi", skip_png=False,
-        skip_pdf=False, participants=None):
+        skip_pdf=False, participants=None, cache_dir=None, njobs=8):
     """ Launch the lithium rawdata quality control workflow.
 
     Parameters
@@ -107,18 +110,24 @@ def all(list_nii, outdir, font=None, pattern="T1wLi", skip_png=False,
         skip pdf creation step.
     participants: str, default None
         path to the participants.tsv file (in order to get site in the qc.csv).
+    cache_dir: str, default None
+        optionnaly, decompress the images once in this cache folder (by
+        default use the RLINK_NIFTI_CACHE environment variable if set).
+    njobs: int, default 8
+        the number of parallel decompressions in the cache.
     """
     if not skip_png:
         path_images = get_anat(list_nii)
+        paths = warm(path_images, cachedir=cache_dir, njobs=njobs)
         for index, image in tqdm(enumerate(path_images)):
             pattern_png = os.path.basename(image).rstrip(".nii.gz")
-            make_png(image, outdir, pattern=pattern_png)
+            make_png(paths.get(image, image), outdir, pattern=pattern_png)
     outdir_png = os.path.join(outdir, f"concat_{pattern}.pdf")
     if not skip_pdf:
         create_pdf(outdir, outdir_png, pattern, font)
     csv = outdir_png.replace(".pdf", ".csv")
     if participants is not None:
-        df_participants = pd.read_csv(participants, sep="\t").fillna(0)
+        participants_index = load_participants(participants)
     df = pd.read_csv(csv, sep="\t")
     df["site"] = 0
     if pattern == "T1wLi":
@@ -127,7 +136,7 @@ def all(list_nii, outdir, font=None, pattern="T1wLi", skip_png=False,
         psc2 = row["sub"].split("_")[0]
         ses = row["sub"].split("_")[1]
         if participants is not None:
-            site = psc2_to_site(psc2, ses, df_participants)
+            site = psc2_to_site(psc2, ses, participants_index)
             df.loc[index, "site"] = site
         df.loc[index, "sub"] = f"sub-{psc2}"
         if pattern == "T1wLi":
@@ -10,12 +10,15 @@
 
 # Imports
 import os
+import sys
 import glob
 import pandas as pd
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.participants import load_participants  # noqa: E402
 
 
-def psc2_to_site(psc2, ses, df):
-    return df[df["participant_id"] == psc2][f"{ses}_center"].values[0]
+def psc2_to_site(psc2, ses, index):
+    return index.site(psc2, ses, default=float("nan"))
 
 
 def make_csv(hanat_regex, outdir, template_mni=None, participants=None):
@@ -52,11 +55,11 @@ def make_csv(hanat_regex, outdir, template_mni=None, participants=None):
     df_qc["ses"] = "M03Li"
     df_qc["qc"] = 1
     if participants is not None:
-        df_participants = pd.read_csv(participants, sep="\t")
+        participants_index = load_participants(participants)
     for index, row in df_qc.iterrows():
         psc2 = row["participant_id"]
         if participants is not None:
-            site = psc2_to_site(psc2, "ses-M03Li", df_participants)
+            site = psc2_to_site(psc2, "ses-M03Li", participants_index)
             df_qc.loc[index, "site"] = site
     df_qc = df_qc.reindex(columns=["participant_id", "ses", "site", "fsleyes",
                                    "visual_qc_score", "qc"])
@@ -10,11 +10,16 @@
 
 # Imports
 import os
+import sys
 import fire
 import glob
 import datetime
 import collections
 from hopla.converter import hopla
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.preflight import select_valid  # noqa: E402
+from tools.sharding import select_shard  # noqa: E402
+from tools.job_queue import run_queue  # noqa: E402
 
 
 def get_best_anat(files):
@@ -31,7 +36,8 @@ def get_best_anat(files):
 
 
 def run(datadir, outdir, name="li2mni", process=False, njobs=10,
-        use_pbs=False, cmd="limri", test=False):
+        use_pbs=False, cmd="limri", test=False, preflight=True,
+        shard_index=0, shard_count=1, cost_file=None, queue_dir=None):
     """ Parse data and execute the processing with hopla.
 
     Parameters
@@ -52,7 +58,27 @@ def run(datadir, outdir, name="li2mni", process=False, njobs=10,
         the command to execute.
     test: bool, default False
         optionnaly, select only one subject.
+    preflight: bool, default True
+        optionnaly, check the input images headers before processing and
+        exclude the runs with invalid inputs.
+    shard_index: int, default 0
+        optionnaly, the index of the shard of runs processed by this call
+        (see shard_count).
+    shard_count: int, default 1
+        optionnaly, split the runs in this number of disjoint shards
+        balanced by predicted cost (see tools.sharding.select_shard), so
+        that several machines can process the same cohort.
+    cost_file: str, default None
+        optionnaly, a .tsv table with the 'path' (the run input) and 'cost'
+        (e.g. a past runtime) columns used to balance the shards.
+    queue_dir: str, default None
+        optionnaly, run the subjects through a work-stealing queue in this
+        shared directory (see tools/job_queue.py): more workers can join
+        from any host that sees the directory (not compatible with use_pbs).
     """
+    if queue_dir is not None and use_pbs:
+        raise ValueError("the queue_dir and use_pbs options are not "
+                         "compatible: the queue workers run locally")
     files = glob.glob(os.path.join(
         datadir, "sub-*", "ses-M03Li", "lithium",
         "sub-*_ses-M03Li_*part-mag_limri.nii.gz"))
@@ -86,6 +112,23 @@ def run(datadir, outdir, name="li2mni", process=False, njobs=10,
         lianat_files.append(get_best_anat(_lianat_files))
         hanat_files.append(get_best_anat(_hanat_files))
         sub_outdirs.append(_outdir)
+    if preflight:
+        keep = select_valid(
+            [",".join(item)
+             for item in zip(li_files, lianat_files, hanat_files)],
+            outfile=os.path.join(outdir, (
+                f"{name}_preflight.tsv" if shard_count == 1 else
+                f"{name}_preflight_shard-{shard_index:03d}.tsv")),
+            njobs=njobs)
+        li_files, lianat_files, hanat_files, sub_outdirs = [
+            [item[idx] for idx in keep]
+            for item in (li_files, lianat_files, hanat_files, sub_outdirs)]
+    if shard_count > 1:
+        keep = select_shard(li_files, shard_index, shard_count,
+                            cost_file=cost_file)
+        li_files, lianat_files, hanat_files, sub_outdirs = [
+            [item[idx] for idx in keep]
+            for item in (li_files, lianat_files, hanat_files, sub_outdirs)]
     if len(li_files) == 0:
         raise RuntimeError("No data to process!")
     if test:
@@ -119,23 +162,32 @@ def run(datadir, outdir, name="li2mni", process=False, njobs=10,
         if not os.path.isdir(logdir):
             os.makedirs(logdir)
         logfile = os.path.join(logdir, f"{name}_{date}.log")
-        status, exitcodes = hopla(
-            "li2mni",
-            li_file=li_files,
-            lianat_file=lianat_files,
-            hanat_file=hanat_files,
-            outdir=sub_outdirs,
-            hopla_name_replace=True,
-            hopla_iterative_kwargs=["li-file", "lianat-file", "hanat-file",
-                                    "outdir"],
-            hopla_optional=["li-file", "lianat-file", "hanat-file",
-                            "outdir"],
-            hopla_cpus=njobs,
-            hopla_logfile=logfile,
-            hopla_use_subprocess=True,
-            hopla_verbose=1,
-            hopla_python_cmd=cmd if os.path.isfile(cmd) else "",
-            **pbs_kwargs)
+        if queue_dir is not None:
+            status, exitcodes = run_queue(
+                f"{cmd} li2mni" if os.path.isfile(cmd) else "li2mni",
+                queue_dir,
+                optional=["li-file", "lianat-file", "hanat-file", "outdir"],
+                iterative={"li_file": li_files, "lianat_file": lianat_files,
+                           "hanat_file": hanat_files, "outdir": sub_outdirs},
+                njobs=njobs)
+        else:
+            status, exitcodes = hopla(
+                "li2mni",
+                li_file=li_files,
+                lianat_file=lianat_files,
+                hanat_file=hanat_files,
+                outdir=sub_outdirs,
+                hopla_name_replace=True,
+                hopla_iterative_kwargs=["li-file", "lianat-file", "hanat-file",
+                                        "outdir"],
+                hopla_optional=["li-file", "lianat-file", "hanat-file",
+                                "outdir"],
+                hopla_cpus=njobs,
+                hopla_logfile=logfile,
+                hopla_use_subprocess=True,
+                hopla_verbose=1,
+                hopla_python_cmd=cmd if os.path.isfile(cmd) else "",
+                **pbs_kwargs)
 
 
 if __name__ == "__main__":
@@ -10,19 +10,104 @@
 
 # Imports
 import os
+import sys
 import fire
 import glob
+import json
+import time
 import datetime
 import collections
+import traceback
+import nibabel
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from hopla.converter import hopla
 import limri
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.preflight import select_valid  # noqa: E402
+from tools.participants import load_participants  # noqa: E402
+from tools.sharding import select_shard  # noqa: E402
+from tools.job_queue import run_queue  # noqa: E402
+
+
+def is_uptodate(li2mni_file, ref_value, outdir):
+    """ Check if the normalized image was computed from the current lithium
+    image with the current phantom reference value.
+    """
+    norm_file = os.path.join(outdir, "li2mninorm.nii.gz")
+    ref_file = os.path.join(outdir, "li2mninorm.json")
+    if not os.path.isfile(norm_file) or not os.path.isfile(ref_file):
+        return False
+    with open(ref_file, "rt") as of:
+        ref = json.load(of)
+    return (float(ref["ref_value"]) == float(ref_value) and
+            os.path.getmtime(li2mni_file) <= os.path.getmtime(norm_file))
+
+
+def record_reference(li2mni_file, ref_value, outdir):
+    """ Record the phantom reference value used to normalize an image.
+    """
+    ref_file = os.path.join(outdir, "li2mninorm.json")
+    with open(ref_file, "wt") as of:
+        json.dump({"li2mni_file": li2mni_file, "ref_value": str(ref_value)},
+                  of, indent=4)
+
+
+def li2mninorm(li2mni_file, mask, ref_value, outdir):
+    """ Divide the lithium image by the phantom reference value inside the
+    MNI brain mask.
+    """
+    im = nibabel.load(li2mni_file)
+    data = np.asarray(im.dataobj, dtype=np.float32)
+    assert data.shape == mask.shape, (li2mni_file, data.shape)
+    norm = np.zeros_like(data)
+    norm[mask] = data[mask] / np.float32(ref_value)
+    norm_im = nibabel.Nifti1Image(norm, im.affine, im.header)
+    norm_im.header.set_data_dtype(np.float32)
+    norm_file = os.path.join(outdir, "li2mninorm.nii.gz")
+    nibabel.save(norm_im, norm_file)
+    return norm_file
+
+
+def batch_li2mninorm(li_files, ref_values, outdirs, mask_file, njobs=10):
+    """ Normalize all the lithium images in-process: the mask is loaded once
+    and the images are read and written in a thread pool.
+
+    Returns
+    -------
+    exitcodes: dict
+        the exit code of each run: 0 on success, 1 otherwise.
+    """
+    mask = np.asarray(nibabel.load(mask_file).dataobj) > 0
+
+    def _run(li2mni_file, ref_value, outdir):
+        try:
+            li2mninorm(li2mni_file, mask, float(ref_value), outdir)
+            record_reference(li2mni_file, ref_value, outdir)
+            return 0
+        except Exception:
+            traceback.print_exc()
+            return 1
+
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        codes = list(executor.map(_run, li_files, ref_values, outdirs))
+    exitcodes = dict(zip(outdirs, codes))
+    print(f"failed runs: {sum(codes)} / {len(codes)}")
+    return exitcodes
 
 
 def run(datadir, outdir, phdir, participant_file, name="li2mninorm",
-        process=False, njobs=10, use_pbs=False, cmd="limri", test=False):
+        process=False, njobs=10, use_pbs=False, cmd="limri", test=False,
+        preflight=True, batch=False, shard_index=0, shard_count=1,
+        cost_file=None, queue_dir=None):
     """ Parse data and execute the processing with hopla.
 
+    The phantom reference value used for each subject is recorded in a
+    'li2mninorm.json' sidecar: only the subjects whose site reference value
+    changed or whose lithium image is newer than the normalized image are
+    processed.
+
     Parameters
     ----------
     datadir: str
@@ -45,10 +130,37 @@ def run(datadir, outdir, phdir, participant_file, name="li2mninorm",
         the command to execute.
     test: bool, default False
         optionnaly, select only one subject.
+    preflight: bool, default True
+        optionnaly, check the input images headers before processing and
+        exclude the runs with invalid inputs.
+    batch: bool, default False
+        optionnaly, normalize all the subjects in-process with a pool of
+        'njobs' threads instead of dispatching one process per subject.
+    shard_index: int, default 0
+        optionnaly, the index of the shard of runs processed by this call
+        (see shard_count).
+    shard_count: int, default 1
+        optionnaly, split the runs in this number of disjoint shards
+        balanced by predicted cost (see tools.sharding.select_shard), so
+        that several machines can process the same cohort.
+    cost_file: str, default None
+        optionnaly, a .tsv table with the 'path' (the run input) and 'cost'
+        (e.g. a past runtime) columns used to balance the shards.
+    queue_dir: str, default None
+        optionnaly, run the subjects through a work-stealing queue in this
+        shared directory (see tools/job_queue.py): more workers can join
+        from any host that sees the directory (not compatible with use_pbs).
     """
+    if queue_dir is not None and use_pbs:
+        raise ValueError("the queue_dir and use_pbs options are not "
+                         "compatible: the queue workers run locally")
     files = glob.glob(os.path.join(
         datadir, "sub-*", "ses-M03Li", "li2mni.nii.gz"))
-    info = pd.read_csv(participant_file, sep="\t")
+    if shard_count > 1:
+        keep = select_shard(files, shard_index, shard_count,
+                            cost_file=cost_file)
+        files = [files[idx] for idx in keep]
+    info = load_participants(participant_file)
     mask_file = os.path.join(
         os.path.dirname(limri.__file__), "resources",
         "MNI152_T1_2mm_brain_mask.nii.gz")
@@ -58,20 +170,30 @@ def run(datadir, outdir, phdir, participant_file, name="li2mninorm",
     ph_ref_vals = dict((_site, _mean) for _site, _mean in zip(
         ph_df.Site.values, ph_df.Mean._values))
     li_files, ph_vals, sub_outdirs = [], [], []
+    n_uptodate = 0
     for path in files:
         _outdir = os.path.dirname(path)
-        norm_file = os.path.join(_outdir, "li2mninorm.nii.gz")
-        if os.path.isfile(norm_file):
-            os.remove(norm_file)
-            continue
         _sid = path.split(os.sep)[-3]
-        _info = info.loc[info["participant_id"] == _sid]
-        _center = int(_info["ses-M03Li_center"].item())
+        _center = int(info.site(_sid, "ses-M03Li"))
         assert _center in [1, 2, 4, 5, 10, 11, 15], f"{_sid} - {_center}"
         _ph_val = ph_ref_vals[str(_center)]
+        if is_uptodate(path, _ph_val, _outdir):
+            n_uptodate += 1
+            continue
         li_files.append(path)
         ph_vals.append(_ph_val)
         sub_outdirs.append(_outdir)
+    print(f"number of up-to-date runs: {n_uptodate}")
+    if preflight:
+        keep = select_valid(
+            li_files,
+            outfile=os.path.join(outdir, (
+                f"{name}_preflight.tsv" if shard_count == 1 else
+                f"{name}_preflight_shard-{shard_index:03d}.tsv")),
+            njobs=njobs)
+        li_files, ph_vals, sub_outdirs = [
+            [item[idx] for idx in keep]
+            for item in (li_files, ph_vals, sub_outdirs)]
     if len(li_files) == 0:
         raise RuntimeError("No data to process!")
     if test:
@@ -90,6 +212,14 @@ def run(datadir, outdir, phdir, participant_file, name="li2mninorm",
     print("{:>8} {:>8} {:>8}".format(*last))
 
     if process:
+        for _outdir in sub_outdirs:
+            ref_file = os.path.join(_outdir, "li2mninorm.json")
+            if os.path.isfile(ref_file):
+                os.remove(ref_file)
+    if process and batch:
+        batch_li2mninorm(li_files, ph_vals, sub_outdirs, mask_file,
+                         njobs=njobs)
+    elif process:
         pbs_kwargs = {}
         if use_pbs:
             clusterdir = os.path.join(outdir, f"{name}_pbs")
@@ -104,23 +234,40 @@ def run(datadir, outdir, phdir, participant_file, name="li2mninorm",
         if not os.path.isdir(logdir):
             os.makedirs(logdir)
         logfile = os.path.join(logdir, f"{name}_{date}.log")
-        status, exitcodes = hopla(
-            "li2mninorm",
-            li2mni_file=li_files,
-            mask_file=mask_file,
-            outdir=sub_outdirs,
-            norm="norm",
-            ref_value=ph_vals,
-            hopla_name_replace=True,
-            hopla_iterative_kwargs=["li2mni-file", "ref-value", "outdir"],
-            hopla_optional=["li2mni-file", "ref_value", "mask_file",
-                            "outdir", "norm"],
-            hopla_cpus=njobs,
-            hopla_logfile=logfile,
-            hopla_use_subprocess=True,
-            hopla_verbose=1,
-            hopla_python_cmd=cmd if os.path.isfile(cmd) else "",
-            **pbs_kwargs)
+        start = time.time()
+        if queue_dir is not None:
+            status, exitcodes = run_queue(
+                f"{cmd} li2mninorm" if os.path.isfile(cmd) else "li2mninorm",
+                queue_dir,
+                optional=["li2mni-file", "ref_value", "mask_file", "outdir",
+                          "norm"],
+                iterative={"li2mni_file": li_files, "outdir": sub_outdirs,
+                           "ref_value": ph_vals},
+                constants={"mask_file": mask_file, "norm": "norm"},
+                njobs=njobs)
+        else:
+            status, exitcodes = hopla(
+                "li2mninorm",
+                li2mni_file=li_files,
+                mask_file=mask_file,
+                outdir=sub_outdirs,
+                norm="norm",
+                ref_value=ph_vals,
+                hopla_name_replace=True,
+                hopla_iterative_kwargs=["li2mni-file", "ref-value", "outdir"],
+                hopla_optional=["li2mni-file", "ref_value", "mask_file",
+                                "outdir", "norm"],
+                hopla_cpus=njobs,
+                hopla_logfile=logfile,
+                hopla_use_subprocess=True,
+                hopla_verbose=1,
+                hopla_python_cmd=cmd if os.path.isfile(cmd) else "",
+                **pbs_kwargs)
+        for path, _ph_val, _outdir in zip(li_files, ph_vals, sub_outdirs):
+            norm_file = os.path.join(_outdir, "li2mninorm.nii.gz")
+            if (os.path.isfile(norm_file) and
+                    os.path.getmtime(norm_file) >= start):
+                record_reference(path, _ph_val, _outdir)
 
 
 if __name__ == "__main__":
@@ -12,10 +12,11 @@
 import pandas as pd
 import os
 import fire
+from tools.participants import load_participants
 
 
-def psc2_to_psc1(psc1, df):
-    return df[df["psc2"] == int(psc1)]["psc1"].values[0]
+def psc2_to_psc1(psc2, index):
+    return index.psc1(psc2)
 
 
 def add_site(df, transcoding):
@@ -72,7 +73,7 @@ def run(derivatives, outdir, transcoding=None):
                       how='outer')
 
     if transcoding is not None:
-        transcoding = pd.read_csv(transcoding, sep="\t")
+        transcoding = load_participants(transcoding, key="psc2")
         df_all = add_site(df_all, transcoding)
     else:
         df_all["site"] = None
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import re
+import sys
+import glob
+import nibabel
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.volumes import (  # noqa: E402
+    masked_values, flat_indices, nonzero_counts)
+
+
+def parse_bids(path):
+    """ Get the subject, session and run of a quasiraw output.
+    """
+    sub, ses = path.split(os.sep)[-3: -1]
+    match = re.search(r"_run-([0-9]+)", os.path.basename(path))
+    return sub, ses, match.group(1) if match else None
+
+
+def qc_keys(path):
+    """ Get the 'participant_id', 'session' and 'run' of a quasiraw output as
+    in the brainprep QC tables (without the BIDS prefixes, the 'V1' session
+    and the '1' run by default), so that the tables can be merged.
+    """
+    sub, ses, run = parse_bids(path)
+    return {"participant_id": sub.replace("sub-", "", 1),
+            "session": ses.replace("ses-", "", 1) if ses else "V1",
+            "run": run or "1"}
+
+
+def standardize(values):
+    """ Center and scale the masked voxels of an image.
+    """
+    mean, std = values.mean(), values.std()
+    if std == 0:
+        return np.zeros_like(values), float(mean), 0.
+    return (values - mean) / std, float(mean), float(std)
+
+
+def sum_standardized(files, indices):
+    """ Accumulate the standardized masked images of a chunk.
+    """
+    total = np.zeros(len(indices), dtype=np.float64)
+    for path in files:
+        total += standardize(masked_values(path, indices, np.float64))[0]
+    return total
+
+
+def loo_scores(path, indices, total, n_images):
+    """ Compute the leave-one-out scores of an image from the sum of the
+    standardized images.
+
+    With z the standardized image (zero mean and squared norm M over the M
+    mask voxels) and S the sum of all standardized images, the sum of the
+    other images is S - z, so that:
+
+    - corr(z, S - z) = (z.S - M) / (sqrt(M) * |S - z|), with
+      |S - z|^2 = |S|^2 - 2 z.S + M.
+    - the mean correlation with the other images is
+      (z.S - M) / (M * (N - 1)).
+    """
+    zimg, mean, std = standardize(masked_values(path, indices, np.float64))
+    n_voxels = len(indices)
+    if std == 0:
+        return {"corr": 0., "corr_mean": 0., "mean": mean, "std": std}
+    dot = float(zimg @ total)
+    norm2 = float(total @ total) - 2 * dot + n_voxels
+    corr = (dot - n_voxels) / np.sqrt(n_voxels * max(norm2, 1e-12))
+    corr_mean = (dot - n_voxels) / (n_voxels * max(n_images - 1, 1))
+    return {"corr": float(corr), "corr_mean": float(corr_mean),
+            "mean": mean, "std": std}
+
+
+def qc(quasirawdir, outdir, name="quasiraw_qc", mask_file=None, njobs=10,
+       size=16, mask_frac=0.5, thr=0.5):
+    """ Rank the quasiraw images by their correlation with the mean of all
+    the other images in O(N).
+
+    The images are standardized in a common mask and summed once: the
+    leave-one-out correlation and the mean correlation with all the other
+    images are then derived for each image from this running sum, instead of
+    computing the N x N correlation matrix. The voxels are read chunk by
+    chunk (or in the mask only) from memory mapped images, or from the
+    decompression cache when it is enabled (see tools.nifti_cache).
+
+    The mean of the pairwise Pearson correlations is exact, but it replaces
+    the average of the Fisher's z-transformed correlations: both are very
+    close for highly correlated images.
+
+    The qc.tsv table has the same 'participant_id', 'session', 'run',
+    'corr_mean' and 'qc' columns as the brainprep QC (see qc_anat.py).
+
+    Parameters
+    ----------
+    quasirawdir: str
+        path to the BIDS quasiraw derivatives directory.
+    outdir: str
+        path to the output directory.
+    name: str, default 'quasiraw_qc'
+        the name of the current analysis.
+    mask_file: str, default None
+        path to the mask, by default the voxels that are non zero in at least
+        'mask_frac' of the images.
+    njobs: int, default 10
+        the number of parallel readers.
+    size: int, default 16
+        the number of slices read at a time when building the mask.
+    mask_frac: float, default 0.5
+        the fraction of non zero images to select a voxel in the mask.
+    thr: float, default 0.5
+        the mean correlation under which an image is rejected.
+    """
+    files = sorted(glob.glob(os.path.join(
+        quasirawdir, "sub-*", "ses-*", "sub-*-6apply_T1w.nii.gz")))
+    if len(files) == 0:
+        raise RuntimeError("No data to process!")
+    print(f"number of images: {len(files)}")
+    chunks = [files[idx::njobs] for idx in range(njobs)]
+    chunks = [chunk for chunk in chunks if len(chunk) > 0]
+
+    if mask_file is None:
+        with ThreadPoolExecutor(max_workers=njobs) as executor:
+            counts = list(executor.map(
+                lambda chunk: nonzero_counts(chunk, size=size), chunks))
+        mask = sum(counts) >= mask_frac * len(files)
+        del counts
+    else:
+        mask = np.asarray(nibabel.load(mask_file).dataobj) > 0
+    indices = flat_indices(mask)
+    print(f"number of voxels: {len(indices)}")
+
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        total = sum(executor.map(
+            lambda chunk: sum_standardized(chunk, indices), chunks))
+        records = list(executor.map(
+            lambda path: loo_scores(path, indices, total, len(files)),
+            files))
+
+    df = pd.DataFrame.from_records([qc_keys(path) for path in files])
+    df = pd.concat([df, pd.DataFrame.from_records(records)], axis=1)
+    df["qc"] = (df["corr_mean"] > thr).astype(int)
+    df = df.sort_values("corr_mean").reset_index(drop=True)
+    outdir = os.path.join(outdir, name)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    outfile = os.path.join(outdir, "qc.tsv")
+    df.to_csv(outfile, sep="\t", index=False)
+    print(df.head(10))
+    print(outfile)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(qc)
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import glob
+import json
+import zlib
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.volumes import open_volume, scale  # noqa: E402
+from tools.nifti_cache import cache_key  # noqa: E402
+from quasiraw.loo_qc import parse_bids  # noqa: E402
+
+
+LEVELS = (1, 2, 4)
+INDEX_FILE = "index.tsv"
+
+
+def downsample(arr, factor):
+    """ Average the blocks of factor^3 voxels of a volume: the volume is zero
+    padded to a multiple of the factor, and the block sums are divided by the
+    number of voxels of each block inside the volume (so that the edge
+    blocks are not biased toward zero).
+    """
+    if factor == 1:
+        return arr
+    counts = [np.minimum(size - np.arange(0, size, factor), factor)
+              for size in arr.shape]
+    padded = np.pad(arr, [(0, (-size) % factor) for size in arr.shape])
+    nx, ny, nz = (len(count) for count in counts)
+    sums = padded.reshape(nx, factor, ny, factor, nz, factor).sum(
+        axis=(1, 3, 5), dtype=np.float64)
+    sums /= (counts[0][:, None, None] * counts[1][None, :, None] *
+             counts[2][None, None, :])
+    return sums.astype(arr.dtype)
+
+
+def level_affine(affine, factor):
+    """ Get the affine of a downsampled level: the voxels are 'factor' times
+    larger and centered on the blocks they average.
+    """
+    affine = np.asarray(affine, dtype=float)
+    zoom = np.diag([factor, factor, factor, 1.])
+    zoom[:3, 3] = (factor - 1) / 2.
+    return affine @ zoom
+
+
+def chunk_slices(shape, chunk):
+    """ Iterate over the chunks of a volume in C order of the chunk grid.
+    """
+    grid = [range(0, size, chunk) for size in shape]
+    for corner in itertools.product(*grid):
+        yield tuple(slice(start, start + chunk) for start in corner)
+
+
+def build_image(path, storefile, chunk=64, dtype="float32", clevel=6):
+    """ Write the multi-resolution store of one image.
+
+    The store is a binary file with the zlib compressed chunks of all the
+    levels, and a .json header with the shape, affine and chunk offsets of
+    each level.
+
+    Parameters
+    ----------
+    path: str
+        path to the image.
+    storefile: str
+        path to the output binary store.
+    chunk: int, default 64
+        the chunk size in voxels (the same at each level).
+    dtype: str, default 'float32'
+        the stored voxels type.
+    clevel: int, default 6
+        the zlib compression level.
+
+    Returns
+    -------
+    header: dict
+        the store header.
+    """
+    data, affine, scaling = open_volume(path)
+    full = scale(data, scaling, dtype=np.dtype(dtype))
+    header = {"image": path, "dtype": dtype, "chunk": chunk, "levels": {}}
+    if not os.path.isdir(os.path.dirname(storefile)):
+        os.makedirs(os.path.dirname(storefile), exist_ok=True)
+    tmp = f"{storefile}.{os.getpid()}.tmp"
+    offset = 0
+    with open(tmp, "wb") as of:
+        for level in LEVELS:
+            # each level is averaged from the full resolution volume
+            arr = downsample(full, level)
+            offsets, lengths = [], []
+            for location in chunk_slices(arr.shape, chunk):
+                buffer = zlib.compress(
+                    np.ascontiguousarray(arr[location]).tobytes(), clevel)
+                of.write(buffer)
+                offsets.append(offset)
+                lengths.append(len(buffer))
+                offset += len(buffer)
+            header["levels"][str(level)] = {
+                "shape": list(arr.shape),
+                "affine": level_affine(affine, level).tolist(),
+                "offsets": offsets, "lengths": lengths}
+    os.replace(tmp, storefile)
+    with open(storefile + ".json.tmp", "wt") as of:
+        json.dump(header, of)
+    os.replace(storefile + ".json.tmp", storefile + ".json")
+    return header
+
+
+def read_header(storefile):
+    """ Read the header of an image store.
+    """
+    with open(storefile + ".json", "rt") as of:
+        return json.load(of)
+
+
+def read_chunk(storefile, level, position, header=None):
+    """ Read one chunk of an image store.
+
+    Parameters
+    ----------
+    storefile: str
+        path to the image store.
+    level: int
+        the resolution level in mm (1, 2 or 4).
+    position: tuple of int
+        the chunk position in the chunk grid.
+    header: dict, default None
+        optionnaly, the already loaded store header.
+
+    Returns
+    -------
+    arr: numpy.ndarray
+        the chunk voxels.
+    location: tuple of slice
+        the chunk location in the level volume.
+    """
+    header = header or read_header(storefile)
+    spec = header["levels"][str(level)]
+    chunk = header["chunk"]
+    grid = [int(np.ceil(size / chunk)) for size in spec["shape"]]
+    idx = int(np.ravel_multi_index(tuple(position), grid))
+    location = tuple(
+        slice(pos * chunk, min((pos + 1) * chunk, size))
+        for pos, size in zip(position, spec["shape"]))
+    with open(storefile, "rb") as of:
+        of.seek(spec["offsets"][idx])
+        buffer = zlib.decompress(of.read(spec["lengths"][idx]))
+    shape = [item.stop - item.start for item in location]
+    arr = np.frombuffer(buffer, dtype=header["dtype"]).reshape(shape)
+    return arr, location
+
+
+def read_level(storefile, level=4):
+    """ Read a whole level of an image store.
+
+    Returns
+    -------
+    arr: numpy.ndarray
+        the level volume.
+    affine: numpy.ndarray
+        the level affine.
+    """
+    header = read_header(storefile)
+    spec = header["levels"][str(level)]
+    arr = np.empty(spec["shape"], dtype=header["dtype"])
+    with open(storefile, "rb") as of:
+        for location, offset, length in zip(
+                chunk_slices(spec["shape"], header["chunk"]),
+                spec["offsets"], spec["lengths"]):
+            of.seek(offset)
+            block = np.frombuffer(zlib.decompress(of.read(length)),
+                                  dtype=header["dtype"])
+            arr[location] = block.reshape(arr[location].shape)
+    return arr, np.asarray(spec["affine"])
+
+
+def load_cohort(storedir, level=4, participant_ids=None, njobs=16):
+    """ Load a level of all the images of a store.
+
+    Parameters
+    ----------
+    storedir: str
+        the store folder generated by build.
+    level: int, default 4
+        the resolution level in mm (1, 2 or 4).
+    participant_ids: list of str, default None
+        optionnaly, the participants to load.
+    njobs: int, default 16
+        the number of parallel readers.
+
+    Returns
+    -------
+    data: numpy.ndarray
+        the (images, x, y, z) volumes.
+    index: pandas.DataFrame
+        the participant, session and run of each image.
+    affine: numpy.ndarray
+        the level affine.
+    """
+    index = pd.read_csv(os.path.join(storedir, INDEX_FILE), sep="\t",
+                        dtype={"run": str})
+    if participant_ids is not None:
+        index = index[index["participant_id"].isin(participant_ids)]
+    index = index.reset_index(drop=True)
+    if len(index) == 0:
+        raise RuntimeError("No data to process!")
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        levels = list(executor.map(
+            lambda name: read_level(os.path.join(storedir, name), level),
+            index["store"]))
+    shapes = set(arr.shape for arr, _ in levels)
+    if len(shapes) != 1:
+        raise ValueError(f"the images have different shapes: {shapes}")
+    return np.stack([arr for arr, _ in levels]), index, levels[0][1]
+
+
+def _build(args):
+    path, storefile, chunk, dtype, clevel = args
+    build_image(path, storefile, chunk=chunk, dtype=dtype, clevel=clevel)
+    return path
+
+
+def build(quasirawdir, storedir, chunk=64, dtype="float32", clevel=6,
+          njobs=10):
+    """ Write the quasiraw images in a chunked and compressed
+    multi-resolution (1, 2 and 4 mm) store.
+
+    Each image gets its own store (see build_image) and the index.tsv table
+    lists the participant, session and run of the stored images. Only the
+    new or modified images are written when the store already exists.
+
+    Parameters
+    ----------
+    quasirawdir: str
+        path to the BIDS quasiraw derivatives directory.
+    storedir: str
+        path to the store folder.
+    chunk: int, default 64
+        the chunk size in voxels (the same at each level).
+    dtype: str, default 'float32'
+        the stored voxels type.
+    clevel: int, default 6
+        the zlib compression level.
+    njobs: int, default 10
+        the number of parallel workers.
+    """
+    files = sorted(glob.glob(os.path.join(
+        quasirawdir, "sub-*", "ses-*", "sub-*-6apply_T1w.nii.gz")))
+    if len(files) == 0:
+        raise RuntimeError("No data to process!")
+    if not os.path.isdir(storedir):
+        os.makedirs(storedir)
+    index_file = os.path.join(storedir, INDEX_FILE)
+    keys = dict((path, cache_key(path)) for path in files)
+    done = {}
+    if os.path.isfile(index_file):
+        df = pd.read_csv(index_file, sep="\t", dtype={"run": str})
+        done = dict(zip(df["path"], df["key"]))
+    records, todo = [], []
+    for path in files:
+        sub, ses, run = parse_bids(path)
+        name = os.path.join(
+            sub, ses, os.path.basename(path).replace(".nii.gz", ".pyr"))
+        records.append({"participant_id": sub, "session": ses, "run": run,
+                        "path": path, "key": keys[path], "store": name})
+        if done.get(path) != keys[path] or not os.path.isfile(
+                os.path.join(storedir, name + ".json")):
+            todo.append((path, os.path.join(storedir, name), chunk, dtype,
+                         clevel))
+    print(f"number of images: {len(files)} ({len(todo)} to write)")
+    with ProcessPoolExecutor(max_workers=njobs) as executor:
+        for path in executor.map(_build, todo):
+            print(path)
+    df = pd.DataFrame.from_records(records)
+    df.to_csv(index_file + ".tmp", sep="\t", index=False)
+    os.replace(index_file + ".tmp", index_file)
+    print(index_file)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(build)
@@ -14,11 +14,17 @@ import glob
 import shutil
 import datetime
 from hopla.converter import hopla
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.preflight import select_valid  # noqa: E402
+from tools.sharding import select_shard  # noqa: E402
+from tools.job_queue import run_queue  # noqa: E402
+from tools.io_throttle import io_slot  # noqa: E402
 
 
 def run(datadir, outdir, simg_file=None, target=None, target_skel=None,
         name="tbss", process=False, njobs=10, use_pbs=False, cmd=None,
-        test=False):
+        test=False, preflight=True, shard_index=0, shard_count=1,
+        cost_file=None, queue_dir=None):
     """ Parse data and execute the processing with hopla.
 
     Parameters
@@ -46,13 +52,47 @@ def run(datadir, outdir, simg_file=None, target=None, target_skel=None,
         the command to execute.
     test: bool, default False
         optionnaly, select only one subject.
+    preflight: bool, default True
+        optionnaly, check the input images headers before processing and
+        exclude the runs with invalid inputs.
+    shard_index: int, default 0
+        optionnaly, the index of the shard of runs processed by this call
+        (see shard_count).
+    shard_count: int, default 1
+        optionnaly, split the runs in this number of disjoint shards
+        balanced by predicted cost (see tools.sharding.select_shard), so
+        that several machines can process the same cohort.
+    cost_file: str, default None
+        optionnaly, a .tsv table with the 'path' (the run input) and 'cost'
+        (e.g. a past runtime) columns used to balance the shards.
+    queue_dir: str, default None
+        optionnaly, run the subjects through a work-stealing queue in this
+        shared directory (see tools/job_queue.py): more workers can join
+        from any host that sees the directory (not compatible with use_pbs).
     """
+    if queue_dir is not None and use_pbs:
+        raise ValueError("the queue_dir and use_pbs options are not "
+                         "compatible: the queue workers run locally")
     files = glob.glob(os.path.join(
         datadir, "sub-*", "ses-*", "SCALARS", "dwmri_tensor_fa.nii.gz"))
     tbss_dir = os.path.join(outdir, name)
     tbss_md_dir = os.path.join(tbss_dir, "MD")
     if not os.path.isdir(tbss_md_dir):
         os.makedirs(tbss_md_dir)
+    if preflight:
+        keep = select_valid(
+            [",".join((path, os.path.join(os.path.dirname(path),
+                                          "dwmri_tensor_md.nii.gz")))
+             for path in files],
+            outfile=os.path.join(outdir, (
+                f"{name}_preflight.tsv" if shard_count == 1 else
+                f"{name}_preflight_shard-{shard_index:03d}.tsv")),
+            njobs=njobs)
+        files = [files[idx] for idx in keep]
+    if shard_count > 1:
+        keep = select_shard(files, shard_index, shard_count,
+                            cost_file=cost_file)
+        files = [files[idx] for idx in keep]
     fa_files, md_files = [], []
     for fa_file in files:
         sub, ses = fa_file.split(os.sep)[-4: -2]
@@ -65,11 +105,13 @@ def run(datadir, outdir, simg_file=None, target=None, target_skel=None,
         assert os.path.isfile(md_file), "No MD file."
         dest_fa_file = os.path.join(tbss_dir, f"{sub}_{ses}.nii.gz")
         if not os.path.isfile(dest_fa_file):
-            shutil.copy(fa_file, dest_fa_file)
+            with io_slot():
+                shutil.copy(fa_file, dest_fa_file)
         fa_files.append(dest_fa_file)
         dest_md_file = os.path.join(tbss_md_dir, f"{sub}_{ses}.nii.gz")
         if not os.path.isfile(dest_md_file):
-            shutil.copy(md_file, dest_md_file)
+            with io_slot():
+                shutil.copy(md_file, dest_md_file)
         md_files.append(dest_md_file)
     if len(fa_files) == 0:
         process = False
@@ -108,20 +150,28 @@ def run(datadir, outdir, simg_file=None, target=None, target_skel=None,
         if not os.path.isdir(logdir):
             os.makedirs(logdir)
         logfile = os.path.join(logdir, f"{name}_{date}.log")
-        status, exitcodes = hopla(
-            cmd,
-            outdir=tbss_dir,
-            fa_file=fa_files,
-            target=target,
-            hopla_name_replace=True,
-            hopla_iterative_kwargs=["fa-file"],
-            hopla_optional=["fa-file", "outdir"],
-            hopla_cpus=njobs,
-            hopla_logfile=logfile,
-            hopla_use_subprocess=True,
-            hopla_verbose=1,
-            hopla_python_cmd=None,
-            **pbs_kwargs)
+        if queue_dir is not None:
+            status, exitcodes = run_queue(
+                cmd, queue_dir,
+                optional=["fa-file", "outdir"],
+                iterative={"fa_file": fa_files},
+                constants={"outdir": tbss_dir, "target": target},
+                njobs=njobs)
+        else:
+            status, exitcodes = hopla(
+                cmd,
+                outdir=tbss_dir,
+                fa_file=fa_files,
+                target=target,
+                hopla_name_replace=True,
+                hopla_iterative_kwargs=["fa-file"],
+                hopla_optional=["fa-file", "outdir"],
+                hopla_cpus=njobs,
+                hopla_logfile=logfile,
+                hopla_use_subprocess=True,
+                hopla_verbose=1,
+                hopla_python_cmd=None,
+                **pbs_kwargs)
 
     cmd = [
         "python", cmd.replace("tbss-preproc", "tbss"),
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import glob
+import shlex
+import pandas as pd
+from hopla.converter import hopla
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.command_line import format_options  # noqa: E402
+
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+RUN_BATCH = os.path.join(TOOLS_DIR, "run_batch.sh")
+
+
+def make_jobs(batchdir, batch_size, iterative, constants=None, optional=None,
+              name_replace=True):
+    """ Write the job files of the batches of subjects.
+
+    Parameters
+    ----------
+    batchdir: str
+        the folder where the job files and the per subject logs are written.
+    batch_size: int
+        the number of subjects in a batch.
+    iterative: dict
+        the options that change for each subject (lists of the same length).
+    constants: dict, default None
+        the options shared by all the subjects.
+    optional: list of str, default None
+        the options prefixed by '--' (the hopla_optional list of the
+        runtime), see tools.command_line.
+    name_replace: bool, default True
+        optionnaly replace the underscores by dashes in the options names.
+
+    Returns
+    -------
+    jobfiles: list of str
+        the job file of each batch.
+    """
+    constants = constants or {}
+    sizes = set(len(values) for values in iterative.values())
+    if len(sizes) != 1:
+        raise ValueError("the iterative options must have the same length")
+    n_subjects = sizes.pop()
+    if not os.path.isdir(batchdir):
+        os.makedirs(batchdir)
+    jobfiles = []
+    for start in range(0, n_subjects, batch_size):
+        jobfile = os.path.join(batchdir, f"batch-{len(jobfiles):03d}.txt")
+        with open(jobfile, "wt") as of:
+            for idx in range(start, min(start + batch_size, n_subjects)):
+                options = dict(
+                    (key, values[idx]) for key, values in iterative.items())
+                logfile = os.path.join(batchdir, f"subject-{idx:05d}.log")
+                args = [str(idx), logfile] + format_options(
+                    options, constants, optional=optional,
+                    name_replace=name_replace)
+                of.write(" ".join(shlex.quote(arg) for arg in args) + "\n")
+        jobfiles.append(jobfile)
+    return jobfiles
+
+
+def batch_cmd(cmd):
+    """ Turn a 'singularity run ... brainprep <step>' command into a command
+    that loops over the subjects of a job file in a single container.
+
+    The container is still started with 'singularity run': the image
+    runscript sets up its environment and executes its arguments (this is
+    how 'brainprep <step>' is called in the per subject command), here the
+    run_batch.sh loop that calls 'brainprep <step>' for each subject.
+    """
+    prefix, sep, step = cmd.partition(" brainprep ")
+    if sep == "" or not prefix.startswith("singularity run "):
+        raise ValueError(
+            f"batch mode expects a 'singularity run ... brainprep <step>' "
+            f"command: '{cmd}'")
+    prefix = prefix.replace(
+        "singularity run ", f"singularity run --bind {TOOLS_DIR} ", 1)
+    return f"{prefix} bash {RUN_BATCH} brainprep {step}"
+
+
+def batch_status(batchdir, iterative):
+    """ Gather the per subject exit status of the batches.
+
+    Parameters
+    ----------
+    batchdir: str
+        the folder where the job files and the per subject logs are written.
+    iterative: dict
+        the options that change for each subject.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        the subjects options, exit code (None if not run) and log file.
+    """
+    df = pd.DataFrame(iterative)
+    df["exitcode"] = None
+    df["logfile"] = None
+    for path in sorted(glob.glob(os.path.join(batchdir, "*.txt.status"))):
+        with open(path, "rt") as of:
+            for line in of:
+                idx, exitcode, logfile = line.rstrip("\n").split("\t")
+                df.loc[int(idx), ["exitcode", "logfile"]] = [
+                    int(exitcode), logfile]
+    df.to_csv(os.path.join(batchdir, "status.tsv"), sep="\t", index=False)
+    return df
+
+
+def run_batches(cmd, batch_size, batchdir, iterative, constants=None,
+                optional=None, name_replace=True, **hopla_kwargs):
+    """ Execute a runtime with hopla by batches of subjects: the container is
+    started once per batch and loops over its subjects (see run_batch.sh).
+
+    Parameters
+    ----------
+    cmd: str
+        the 'singularity run ... brainprep <step>' command of the runtime.
+    batch_size: int
+        the number of subjects in a batch.
+    batchdir: str
+        the folder where the job files, the per subject logs and the
+        status.tsv table are written.
+    iterative: dict
+        the options that change for each subject (lists of the same length).
+    constants: dict, default None
+        the options shared by all the subjects.
+    optional: list of str, default None
+        the options prefixed by '--' (the hopla_optional list of the
+        runtime): the subjects get the same command line as with hopla.
+    name_replace: bool, default True
+        optionnaly replace the underscores by dashes in the options names.
+    hopla_kwargs: dict
+        the hopla execution parameters (hopla_cpus, hopla_logfile, ...).
+
+    Returns
+    -------
+    status, exitcodes: dict
+        the hopla status and exit codes of the batches.
+    """
+    jobfiles = make_jobs(batchdir, batch_size, iterative, constants=constants,
+                         optional=optional, name_replace=name_replace)
+    print(f"number of batches: {len(jobfiles)}")
+    status, exitcodes = hopla(
+        batch_cmd(cmd),
+        jobfile=jobfiles,
+        hopla_iterative_kwargs=["jobfile"],
+        hopla_optional=["jobfile"],
+        hopla_use_subprocess=True,
+        hopla_verbose=1,
+        hopla_python_cmd=None,
+        **hopla_kwargs)
+    df = batch_status(batchdir, iterative)
+    failed = df[df["exitcode"] != 0]
+    print(f"failed or not run subjects: {len(failed)} / {len(df)}")
+    if len(failed) > 0:
+        print(failed)
+    return status, exitcodes
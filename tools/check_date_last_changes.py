@@ -11,9 +11,175 @@
 # Imports
 import os
 import datetime
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
 
-def print_files_modified_on_date(path, date):
+def scan_dir(path):
+    """ List the files (path, size, mtime_ns) and the sub-directories of a
+    directory: symbolic links are not followed.
+    """
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    else:
+                        stat = entry.stat(follow_symlinks=False)
+                        files.append((entry.path, stat.st_size,
+                                      stat.st_mtime_ns))
+                except FileNotFoundError:
+                    continue
+    except (FileNotFoundError, PermissionError) as exc:
+        print(f"skip '{path}': {exc}")
+    return files, dirs
+
+
+def scan(path, njobs=16):
+    """ Recursively list the files of a directory with a pool of scanners.
+
+    The tree is traversed level by level: the directories of a level are
+    listed in parallel.
+
+    Parameters
+    ----------
+    path: str
+        the path to the directory to traverse.
+    njobs: int, default 16
+        the number of parallel scanners.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        the 'path', 'size' and 'mtime_ns' (timestamp in nanoseconds) of each
+        file.
+    """
+    records, frontier = [], [path]
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        while len(frontier) > 0:
+            next_frontier = []
+            for files, dirs in executor.map(scan_dir, frontier):
+                records.extend(files)
+                next_frontier.extend(dirs)
+            frontier = next_frontier
+    return pd.DataFrame(records, columns=["path", "size", "mtime_ns"])
+
+
+def to_timestamp(date, end=False):
+    """ Convert a 'YYYY-MM-DD' date to a timestamp in nanoseconds: the end of
+    the day if 'end' is set.
+    """
+    date = datetime.datetime.strptime(str(date), "%Y-%m-%d")
+    if end:
+        date += datetime.timedelta(days=1)
+    return int(date.timestamp()) * 10 ** 9
+
+
+def snapshot(path, outfile, njobs=16):
+    """ Store a snapshot (path, size, mtime_ns) of a tree.
+
+    Parameters
+    ----------
+    path: str
+        the path to the directory to traverse.
+    outfile: str
+        the output .tsv (or compressed .tsv.gz) snapshot.
+    njobs: int, default 16
+        the number of parallel scanners.
+    """
+    df = scan(path, njobs=njobs)
+    df.to_csv(outfile, sep="\t", index=False)
+    print(f"{len(df)} files: {outfile}")
+
+
+def load_snapshot(path, njobs=16):
+    """ Load a snapshot, or scan a directory.
+    """
+    if os.path.isdir(path):
+        return scan(path, njobs=njobs)
+    return pd.read_csv(path, sep="\t", dtype={"path": str})
+
+
+def compare(old, new, start=None, end=None, njobs=16):
+    """ List the created, modified and deleted files between two snapshots.
+
+    Parameters
+    ----------
+    old: str
+        the reference snapshot.
+    new: str
+        the new snapshot, or a directory to scan.
+    start: str, default None
+        optionnaly, keep only the created and modified files with a
+        modification date after this date, in the format "YYYY-MM-DD".
+    end: str, default None
+        optionnaly, keep only the created and modified files with a
+        modification date before this date (included), in the format
+        "YYYY-MM-DD".
+    njobs: int, default 16
+        the number of parallel scanners if a directory is scanned.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        the 'path', 'status' (created, modified or deleted), 'size' and
+        'mtime_ns' (of the new file if any) of each changed file.
+    """
+    df = load_snapshot(old, njobs=njobs).merge(
+        load_snapshot(new, njobs=njobs), on="path", how="outer",
+        suffixes=("_old", "_new"), indicator=True)
+    df["status"] = None
+    df.loc[df["_merge"] == "right_only", "status"] = "created"
+    df.loc[df["_merge"] == "left_only", "status"] = "deleted"
+    modified = (df["_merge"] == "both") & (
+        (df["size_old"] != df["size_new"]) |
+        (df["mtime_ns_old"] != df["mtime_ns_new"]))
+    df.loc[modified, "status"] = "modified"
+    df = df[df["status"].notnull()]
+    df["size"] = df["size_new"].fillna(df["size_old"]).astype("int64")
+    df["mtime_ns"] = df["mtime_ns_new"].fillna(
+        df["mtime_ns_old"]).astype("int64")
+    dated = df["status"] != "deleted"
+    if start is not None:
+        df = df[~dated | (df["mtime_ns"] >= to_timestamp(start))]
+        dated = df["status"] != "deleted"
+    if end is not None:
+        df = df[~dated | (df["mtime_ns"] < to_timestamp(end, end=True))]
+    return df[["path", "status", "size", "mtime_ns"]].sort_values("path")
+
+
+def diff(old, new, start=None, end=None, outfile=None, njobs=16):
+    """ Print the number of created, modified and deleted files between two
+    snapshots, and optionnaly save the list of changed files.
+
+    Parameters
+    ----------
+    old: str
+        the reference snapshot.
+    new: str
+        the new snapshot, or a directory to scan.
+    start: str, default None
+        optionnaly, keep only the created and modified files with a
+        modification date after this date, in the format "YYYY-MM-DD".
+    end: str, default None
+        optionnaly, keep only the created and modified files with a
+        modification date before this date (included), in the format
+        "YYYY-MM-DD".
+    outfile: str, default None
+        optionnaly, the output .tsv table.
+    njobs: int, default 16
+        the number of parallel scanners if a directory is scanned.
+    """
+    df = compare(old, new, start=start, end=end, njobs=njobs)
+    print(df["status"].value_counts().to_string())
+    if outfile is not None:
+        df.to_csv(outfile, sep="\t", index=False)
+        print(outfile)
+
+
+def print_files_modified_on_date(path, date, njobs=16):
     """ Recursively traverses a directory and prints information about each
     file that was modified on the specified date.
 
@@ -23,18 +189,25 @@ def print_files_modified_on_date(path, date):
         The path to the directory to traverse.
     date: str
         The date to filter files by, in the format "YYYY-MM-DD".
+    njobs: int, default 16
+        the number of parallel scanners.
     """
-    date_obj = datetime.datetime.strptime(date, "%Y-%m-%d").date()
-    for root, dirs, files in os.walk(path):
-        for basename in files:
-            full_path = os.path.join(root, basename)
-            last_modified_time = os.path.getmtime(full_path)
-            last_modified_date = datetime.datetimefromtimestamp(
-                last_modified_time).date()
-            if last_modified_date == date_obj:
-                print(f"{full_path} was last modified on {last_modified_date}")
+    df = scan(path, njobs=njobs)
+    df = df[(df["mtime_ns"] >= to_timestamp(date)) &
+            (df["mtime_ns"] < to_timestamp(date, end=True))]
+    for full_path in sorted(df["path"]):
+        print(f"{full_path} was last modified on {date}")
 
 
 if __name__ == "__main__":
+    import sys
     import fire
-    fire.Fire(print_files_modified_on_date)
+    commands = {
+        "modified": print_files_modified_on_date,
+        "snapshot": snapshot,
+        "diff": diff}
+    # without a command name, keep the original '<path> <date>' interface
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        fire.Fire(commands)
+    else:
+        fire.Fire(print_files_modified_on_date)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+def format_option(name, value, optional=None, name_replace=True):
+    """ Format a command line option as hopla does.
+
+    The option name is optionnaly replaced first, then prefixed by '--' if
+    it is in the 'optional' list, '-' otherwise. None and False values are
+    skipped, True values are passed as a flag and lists are passed as
+    multiple values.
+
+    Parameters
+    ----------
+    name: str
+        the option name.
+    value: object
+        the option value.
+    optional: list of str, default None
+        the options prefixed by '--' (hopla_optional).
+    name_replace: bool, default True
+        optionnaly replace the underscores by dashes in the option name
+        (hopla_name_replace).
+
+    Returns
+    -------
+    args: list of str
+        the command line arguments of the option.
+    """
+    if value is None or value is False:
+        return []
+    optional = optional or []
+    option = name.replace("_", "-") if name_replace else name
+    prefix = "--" if option in optional else "-"
+    args = [prefix + option]
+    if value is True:
+        return args
+    if isinstance(value, list):
+        return args + [str(item) for item in value]
+    return args + [str(value)]
+
+
+def format_options(iterative, constants=None, optional=None,
+                   name_replace=True):
+    """ Format the command line options of one subject as hopla does: the
+    iterative options then the constant options, each sorted by name.
+
+    Parameters
+    ----------
+    iterative: dict
+        the values of the iterative options for this subject.
+    constants: dict, default None
+        the options shared by all the subjects.
+    optional: list of str, default None
+        the options prefixed by '--' (hopla_optional).
+    name_replace: bool, default True
+        optionnaly replace the underscores by dashes in the options names
+        (hopla_name_replace).
+
+    Returns
+    -------
+    args: list of str
+        the command line arguments.
+    """
+    args = []
+    for options in (iterative, constants or {}):
+        for name in sorted(options):
+            args.extend(format_option(name, options[name], optional=optional,
+                                      name_replace=name_replace))
+    return args
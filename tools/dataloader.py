@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import collections
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.volumes import (  # noqa: E402
+    open_volume, scale, masked_values, flat_indices, list_images)
+from tools.participants import load_participants  # noqa: E402
+
+
+# For each pipeline: the glob pattern of the volumes in the derivatives
+# folder (without extension, see tools.volumes.list_images) and the position
+# of the subject folder from the end of a path.
+PIPELINES = {
+    "quasiraw": ("sub-*/ses-*/sub-*-6apply_T1w", 3),
+    "cat12vbm": ("sub-*/ses-*/mri/mwp1*usub*_T1w", 4),
+    "li2mni": ("sub-*/ses-*/li2mni", 3),
+    "li2mninorm": ("sub-*/ses-*/li2mninorm", 3),
+}
+
+
+def list_volumes(datadir, pipeline, subjects=None, sites=None,
+                 participant_file=None):
+    """ List the volumes of a pipeline.
+
+    Parameters
+    ----------
+    datadir: str
+        the pipeline BIDS derivatives folder.
+    pipeline: str
+        the pipeline name, see PIPELINES.
+    subjects: list of str, default None
+        optionnaly, the subjects to select.
+    sites: list of int, default None
+        optionnaly, the sites to select (requires the participants file).
+    participant_file: str, default None
+        optionnaly, path to the participants.tsv file (in order to get the
+        site of each session).
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        the 'participant_id', 'session', 'site' and 'path' of each volume.
+    """
+    pattern, depth = PIPELINES[pipeline]
+    files = list_images(os.path.join(datadir, pattern))
+    df = pd.DataFrame({
+        "participant_id": [path.split(os.sep)[-depth] for path in files],
+        "session": [path.split(os.sep)[-depth + 1] for path in files],
+        "path": files})
+    if subjects is not None:
+        df = df[df["participant_id"].isin(subjects)]
+    df["site"] = None
+    if participant_file is not None:
+        info = load_participants(participant_file)
+        df["site"] = [info.site(sub, ses, default=None)
+                      for sub, ses in zip(df["participant_id"],
+                                          df["session"])]
+    if sites is not None:
+        if participant_file is None:
+            raise ValueError("the site filter requires a participants file")
+        df = df[df["site"].isin(sites)]
+    df = df.reset_index(drop=True)
+    if len(df) == 0:
+        raise RuntimeError("No data to process!")
+    return df[["participant_id", "session", "site", "path"]]
+
+
+class DataLoader(object):
+    """ Iterate over batches of derivative volumes: a pool of threads reads
+    and decompresses the next batches in the background.
+
+    At most 'prefetch' batches are read ahead of the current batch, which
+    bounds the memory to (prefetch + 1) * batch_size volumes.
+
+    Parameters
+    ----------
+    datadir: str
+        the pipeline BIDS derivatives folder.
+    pipeline: str
+        the pipeline name, see PIPELINES.
+    subjects: list of str, default None
+        optionnaly, the subjects to select.
+    batch_size: int, default 8
+        the number of volumes in a batch.
+    shuffle: bool, default False
+        optionnaly, shuffle the volumes at each iteration.
+    seed: int, default None
+        the shuffling seed.
+    sites: list of int, default None
+        optionnaly, the sites to select (requires the participants file).
+    participant_file: str, default None
+        optionnaly, path to the participants.tsv file (in order to get the
+        site of each session).
+    mask_file: str, default None
+        optionnaly, only return the voxels in this mask (as flat vectors in
+        Fortran order, see tools.volumes).
+    njobs: int, default 4
+        the number of reading threads.
+    prefetch: int, default 2
+        the number of batches read ahead.
+    dtype: numpy.dtype, default float32
+        the type of the returned voxels.
+    drop_last: bool, default False
+        optionnaly, drop the last incomplete batch.
+    """
+    def __init__(self, datadir, pipeline, subjects=None, batch_size=8,
+                 shuffle=False, seed=None, sites=None, participant_file=None,
+                 mask_file=None, njobs=4, prefetch=2, dtype=np.float32,
+                 drop_last=False):
+        self.index = list_volumes(datadir, pipeline, subjects=subjects,
+                                  sites=sites,
+                                  participant_file=participant_file)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.njobs = njobs
+        self.prefetch = max(prefetch, 1)
+        self.dtype = dtype
+        self.drop_last = drop_last
+        self.indices = None
+        if mask_file is not None:
+            mask = np.asarray(open_volume(mask_file)[0]) > 0
+            self.indices = flat_indices(mask)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.index) // self.batch_size
+        return int(np.ceil(len(self.index) / self.batch_size))
+
+    def read(self, path):
+        """ Read one volume.
+        """
+        if self.indices is not None:
+            return masked_values(path, self.indices, dtype=self.dtype)
+        data, _, scaling = open_volume(path)
+        return scale(data, scaling, dtype=self.dtype)
+
+    def __iter__(self):
+        """ Yield the (batch_size, ...) volumes and the index of each batch.
+        """
+        order = np.arange(len(self.index))
+        if self.shuffle:
+            self.rng.shuffle(order)
+        batches = [order[start: start + self.batch_size]
+                   for start in range(0, len(order), self.batch_size)]
+        batches = batches[:len(self)]
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.njobs) as executor:
+            try:
+                for rows in batches:
+                    pending.append((rows, [
+                        executor.submit(self.read, path)
+                        for path in self.index["path"].values[rows]]))
+                    if len(pending) > self.prefetch:
+                        yield self._collect(*pending.popleft())
+                while len(pending) > 0:
+                    yield self._collect(*pending.popleft())
+            finally:
+                for _, futures in pending:
+                    for future in futures:
+                        future.cancel()
+
+    def _collect(self, rows, futures):
+        data = np.stack([future.result() for future in futures])
+        return data, self.index.iloc[rows].reset_index(drop=True)
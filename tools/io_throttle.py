@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import time
+import random
+import socket
+import threading
+import contextlib
+
+
+# The throttling is enabled by setting a lock directory shared by all the
+# hosts in this environment variable, and the number of concurrent I/O
+# heavy phases is capped (4 by default).
+LOCK_ENV = "RLINK_IO_LOCK_DIR"
+SLOTS_ENV = "RLINK_IO_SLOTS"
+
+
+class IOSlot(object):
+    """ A slot of a semaphore shared through a lock directory: the slot is
+    held by creating its lock file atomically (O_CREAT|O_EXCL).
+
+    The lock file is a lease that is renewed every lease / 4 seconds while
+    the slot is held: a lock that was not renewed for 'lease' seconds (as
+    measured with the shared filesystem clock) belongs to a dead process and
+    is reclaimed.
+
+    Parameters
+    ----------
+    lock_dir: str
+        the shared lock directory.
+    slots: int
+        the maximum number of slots held at the same time.
+    lease: float, default 300
+        the lease duration in seconds.
+    """
+    def __init__(self, lock_dir, slots, lease=300):
+        self.lock_dir = lock_dir
+        self.slots = max(int(slots), 1)
+        self.lease = lease
+        self.token = (f"{socket.gethostname()}-{os.getpid()}-"
+                      f"{threading.get_ident()}")
+        self.lock_file = None
+        self.stop = threading.Event()
+
+    def now(self):
+        """ Get the shared filesystem time.
+        """
+        clock_file = os.path.join(self.lock_dir, f".clock-{self.token}")
+        with open(clock_file, "at"):
+            pass
+        os.utime(clock_file)
+        now = os.stat(clock_file).st_mtime
+        os.remove(clock_file)
+        return now
+
+    def reclaim(self, lock_file):
+        """ Remove a lock whose lease expired.
+        """
+        try:
+            if self.now() - os.stat(lock_file).st_mtime < self.lease:
+                return
+            stale = f"{lock_file}.stale-{self.token}"
+            os.rename(lock_file, stale)
+        except FileNotFoundError:
+            return
+        if self.now() - os.stat(stale).st_mtime < self.lease:
+            # another process reclaimed the lock in the meantime
+            try:
+                os.link(stale, lock_file)
+            except FileExistsError:
+                pass
+        os.remove(stale)
+
+    def acquire(self, timeout=None):
+        """ Wait for a free slot.
+        """
+        os.makedirs(self.lock_dir, exist_ok=True)
+        start, delay = time.time(), 0.05
+        while True:
+            for idx in random.sample(range(self.slots), self.slots):
+                lock_file = os.path.join(self.lock_dir, f"slot-{idx:03d}.lock")
+                try:
+                    fd = os.open(lock_file,
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except FileExistsError:
+                    self.reclaim(lock_file)
+                    continue
+                with os.fdopen(fd, "wt") as of:
+                    of.write(self.token + "\n")
+                self.lock_file = lock_file
+                self.stop.clear()
+                threading.Thread(target=self.renew, daemon=True).start()
+                return
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError(f"no free I/O slot in '{self.lock_dir}'")
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 2.)
+
+    def renew(self):
+        """ Renew the lease until the slot is released.
+        """
+        lock_file = self.lock_file
+        while not self.stop.wait(self.lease / 4.):
+            try:
+                os.utime(lock_file)
+            except FileNotFoundError:
+                return
+
+    def release(self):
+        """ Release the slot if it is still owned by this process.
+        """
+        self.stop.set()
+        try:
+            with open(self.lock_file, "rt") as of:
+                owner = of.read().strip()
+            if owner == self.token:
+                os.remove(self.lock_file)
+        except FileNotFoundError:
+            pass
+        self.lock_file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def io_slot(lock_dir=None, slots=None):
+    """ Get a context that caps the number of concurrent I/O heavy phases
+    (copies, decompressions, moves) across all the hosts that share the
+    lock directory, independently of the CPU parallelism.
+
+    Parameters
+    ----------
+    lock_dir: str, default None
+        the shared lock directory, by default read from the RLINK_IO_LOCK_DIR
+        environment variable: the throttling is disabled if not set.
+    slots: int, default None
+        the maximum number of concurrent I/O heavy phases, by default read
+        from the RLINK_IO_SLOTS environment variable.
+
+    Returns
+    -------
+    context: IOSlot or contextlib.nullcontext
+        the context to enter around an I/O heavy phase.
+    """
+    lock_dir = lock_dir or os.environ.get(LOCK_ENV) or None
+    if lock_dir is None:
+        return contextlib.nullcontext()
+    slots = slots or int(os.environ.get(SLOTS_ENV, 4))
+    return IOSlot(lock_dir, slots)
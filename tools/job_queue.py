@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import glob
+import json
+import time
+import shlex
+import signal
+import socket
+import hashlib
+import threading
+import subprocess
+import pandas as pd
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.command_line import format_options  # noqa: E402
+
+
+# The queue directory layout: the command, one .json file per job, one lock
+# file per running job and one status file per finished job.
+QUEUE_FILE = "queue.json"
+JOBS_DIR = "jobs"
+LOCKS_DIR = "locks"
+STATUS_DIR = "status"
+LOGS_DIR = "logs"
+
+
+def job_name(args):
+    """ Get the name of a job from its options: a job submitted twice keeps
+    the same name.
+    """
+    key = "\0".join(args).encode("utf-8")
+    return "job-" + hashlib.sha1(key).hexdigest()[:16]
+
+
+def write_atomic(path, content):
+    """ Write a text file through a temporary file and a rename.
+    """
+    tmp = f"{path}.{socket.gethostname()}-{os.getpid()}.tmp"
+    with open(tmp, "wt") as of:
+        of.write(content)
+    os.replace(tmp, path)
+
+
+def submit(queue_dir, cmd, iterative, constants=None, optional=None,
+           name_replace=True):
+    """ Write the jobs of a runtime in a shared queue directory.
+
+    The jobs that are already in the queue are kept: the successful jobs
+    are not run again and the failed jobs are reset. A queue runs a single
+    command: an error is raised if the queue was created with another
+    command.
+
+    Parameters
+    ----------
+    queue_dir: str
+        the shared queue directory.
+    cmd: str
+        the command of the runtime.
+    iterative: dict
+        the options that change for each subject (lists of the same length).
+    constants: dict, default None
+        the options shared by all the subjects.
+    optional: list of str, default None
+        the options prefixed by '--' (the hopla_optional list of the
+        runtime), see tools.command_line.
+    name_replace: bool, default True
+        optionnaly replace the underscores by dashes in the options names.
+
+    Returns
+    -------
+    names: list of str
+        the name of each job.
+    """
+    constants = constants or {}
+    sizes = set(len(values) for values in iterative.values())
+    if len(sizes) != 1:
+        raise ValueError("the iterative options must have the same length")
+    queue_file = os.path.join(queue_dir, QUEUE_FILE)
+    if os.path.isfile(queue_file):
+        with open(queue_file, "rt") as of:
+            queue_cmd = json.load(of)["cmd"]
+        if queue_cmd != cmd:
+            raise ValueError(f"the queue '{queue_dir}' runs another command: "
+                             f"'{queue_cmd}'")
+    for dirname in (JOBS_DIR, LOCKS_DIR, STATUS_DIR, LOGS_DIR):
+        os.makedirs(os.path.join(queue_dir, dirname), exist_ok=True)
+    if not os.path.isfile(queue_file):
+        write_atomic(queue_file, json.dumps({"cmd": cmd}, indent=4))
+    names = []
+    for idx in range(sizes.pop()):
+        options = dict((key, values[idx]) for key, values in iterative.items())
+        args = format_options(options, constants, optional=optional,
+                              name_replace=name_replace)
+        name = job_name(args)
+        names.append(name)
+        status_file = os.path.join(queue_dir, STATUS_DIR, name + ".status")
+        if os.path.isfile(status_file):
+            if read_status(status_file)["exitcode"] == 0:
+                continue
+            os.remove(status_file)
+        job_file = os.path.join(queue_dir, JOBS_DIR, name + ".json")
+        if not os.path.isfile(job_file):
+            write_atomic(job_file, json.dumps({"args": args}, indent=4))
+    return names
+
+
+def read_status(status_file):
+    """ Read the exit code, host and log file of a finished job.
+    """
+    with open(status_file, "rt") as of:
+        exitcode, host, logfile = of.read().rstrip("\n").split("\t")
+    return {"exitcode": int(exitcode), "host": host, "logfile": logfile}
+
+
+class Worker(object):
+    """ Claim and run the jobs of a shared queue directory.
+
+    A job is claimed by creating its lock file atomically (O_CREAT|O_EXCL):
+    the lock is a lease that is renewed (its mtime is touched) every
+    'heartbeat' seconds while the job runs. A lock that was not renewed for
+    'lease' seconds belongs to a dead worker and is reclaimed. The lease
+    ages are measured with the shared filesystem clock.
+
+    Parameters
+    ----------
+    queue_dir: str
+        the shared queue directory.
+    njobs: int, default 1
+        the number of jobs run in parallel by this worker.
+    lease: float, default 600
+        the lease duration in seconds.
+    heartbeat: float, default 60
+        the lease renewal period in seconds.
+    wait: bool, default True
+        optionnaly, wait for the jobs running in other workers (in order to
+        reclaim them if their worker dies) before exiting.
+    """
+    def __init__(self, queue_dir, njobs=1, lease=600, heartbeat=60,
+                 wait=True):
+        if heartbeat >= lease:
+            raise ValueError("the heartbeat must be shorter than the lease")
+        self.queue_dir = queue_dir
+        self.njobs = njobs
+        self.lease = lease
+        self.heartbeat = heartbeat
+        self.wait = wait
+        self.host = socket.gethostname()
+        self.token = f"{self.host}\t{os.getpid()}"
+        with open(os.path.join(queue_dir, QUEUE_FILE), "rt") as of:
+            self.cmd = shlex.split(json.load(of)["cmd"])
+        self.locks = set()
+        self.processes = set()
+        self.mutex = threading.Lock()
+        self.stop = threading.Event()
+        self.clock_file = os.path.join(
+            queue_dir, LOCKS_DIR, f".clock-{self.host}-{os.getpid()}")
+
+    def path(self, dirname, name, ext):
+        return os.path.join(self.queue_dir, dirname, name + ext)
+
+    def now(self):
+        """ Get the shared filesystem time.
+        """
+        with open(self.clock_file, "at"):
+            pass
+        os.utime(self.clock_file)
+        return os.stat(self.clock_file).st_mtime
+
+    def claim(self, name):
+        """ Try to claim a job: reclaim its lock if the lease expired.
+        """
+        lock_file = self.path(LOCKS_DIR, name, ".lock")
+        for _ in range(2):
+            try:
+                fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    age = self.now() - os.stat(lock_file).st_mtime
+                except FileNotFoundError:
+                    continue
+                if age < self.lease:
+                    return False
+                stale = (f"{lock_file}.stale-{self.host}-{os.getpid()}-"
+                         f"{threading.get_ident()}")
+                try:
+                    os.rename(lock_file, stale)
+                except FileNotFoundError:
+                    continue
+                if self.now() - os.stat(stale).st_mtime < self.lease:
+                    # another worker reclaimed the lock in the meantime
+                    try:
+                        os.link(stale, lock_file)
+                    except FileExistsError:
+                        pass
+                    os.remove(stale)
+                    return False
+                os.remove(stale)
+                print(f"reclaim '{name}': lease expired since {age:.0f}s")
+                continue
+            with os.fdopen(fd, "wt") as of:
+                of.write(f"{self.token}\t{threading.get_ident()}\n")
+            if os.path.isfile(self.path(STATUS_DIR, name, ".status")):
+                os.remove(lock_file)
+                return False
+            with self.mutex:
+                self.locks.add(lock_file)
+            return True
+        return False
+
+    def release(self, name):
+        """ Remove the lock of a job if it is still owned by this worker.
+        """
+        lock_file = self.path(LOCKS_DIR, name, ".lock")
+        with self.mutex:
+            self.locks.discard(lock_file)
+        try:
+            with open(lock_file, "rt") as of:
+                owner = of.read()
+            if owner.startswith(self.token + "\t"):
+                os.remove(lock_file)
+        except FileNotFoundError:
+            pass
+
+    def renew(self):
+        """ Renew the leases of the running jobs until the worker stops.
+        """
+        while not self.stop.wait(self.heartbeat):
+            with self.mutex:
+                locks = list(self.locks)
+            for lock_file in locks:
+                try:
+                    os.utime(lock_file)
+                except FileNotFoundError:
+                    print(f"lost lease: '{lock_file}'")
+
+    def run_job(self, name):
+        """ Run a claimed job and record its exit status.
+        """
+        with open(self.path(JOBS_DIR, name, ".json"), "rt") as of:
+            args = json.load(of)["args"]
+        logfile = self.path(LOGS_DIR, name, ".log")
+        print(f"[{time.strftime('%Y%m%d-%H%M%S')}] {name}: "
+              f"{' '.join(self.cmd + args)}")
+        with open(logfile, "wt") as of:
+            try:
+                process = subprocess.Popen(self.cmd + args, stdout=of,
+                                           stderr=subprocess.STDOUT)
+            except OSError as exc:
+                of.write(f"{type(exc).__name__}: {exc}\n")
+                process = None
+                exitcode = 127
+            if process is not None:
+                with self.mutex:
+                    self.processes.add(process)
+                exitcode = process.wait()
+                with self.mutex:
+                    self.processes.discard(process)
+        if not self.stop.is_set():
+            write_atomic(self.path(STATUS_DIR, name, ".status"),
+                         f"{exitcode}\t{self.host}\t{logfile}\n")
+            if exitcode != 0:
+                print(f"[{time.strftime('%Y%m%d-%H%M%S')}] {name}: failed "
+                      f"({exitcode})")
+        return exitcode
+
+    def loop(self):
+        """ Claim and run jobs until the queue is empty.
+        """
+        while not self.stop.is_set():
+            names = self.pending()
+            claimed = None
+            for name in names:
+                if self.claim(name):
+                    claimed = name
+                    break
+            if claimed is None:
+                if len(names) == 0 or not self.wait:
+                    return
+                self.stop.wait(self.heartbeat)
+                continue
+            try:
+                self.run_job(claimed)
+            finally:
+                self.release(claimed)
+
+    def pending(self):
+        """ List the jobs without exit status, in a worker specific order to
+        limit the claim collisions.
+        """
+        names = [
+            os.path.basename(path)[:-len(".json")]
+            for path in glob.glob(os.path.join(
+                self.queue_dir, JOBS_DIR, "*.json"))]
+        names = [name for name in names if not os.path.isfile(
+            self.path(STATUS_DIR, name, ".status"))]
+        return sorted(names, key=lambda name: hashlib.sha1(
+            f"{self.token}{threading.get_ident()}{name}".encode(
+                "utf-8")).hexdigest())
+
+    def terminate(self, *args):
+        """ Stop the worker: the running jobs are killed and their locks are
+        released, so that they can be claimed again.
+        """
+        self.stop.set()
+        with self.mutex:
+            processes = list(self.processes)
+        for process in processes:
+            process.terminate()
+
+    def start(self):
+        """ Run 'njobs' loops and the lease renewal thread.
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.terminate)
+        renewer = threading.Thread(target=self.renew, daemon=True)
+        renewer.start()
+        loops = [threading.Thread(target=self.loop)
+                 for _ in range(self.njobs)]
+        try:
+            for thread in loops:
+                thread.start()
+            for thread in loops:
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            self.terminate()
+            for thread in loops:
+                thread.join()
+        finally:
+            self.stop.set()
+            if os.path.isfile(self.clock_file):
+                os.remove(self.clock_file)
+
+
+def worker(queue_dir, njobs=1, lease=600, heartbeat=60, wait=True):
+    """ Start a worker on a shared queue directory: any number of workers
+    can be started on any host that sees the queue directory.
+
+    Parameters
+    ----------
+    queue_dir: str
+        the shared queue directory.
+    njobs: int, default 1
+        the number of jobs run in parallel by this worker.
+    lease: float, default 600
+        the lease duration in seconds: the jobs of a worker that did not
+        renew its leases for this time are claimed again.
+    heartbeat: float, default 60
+        the lease renewal period in seconds.
+    wait: bool, default True
+        optionnaly, wait for the jobs running in other workers before
+        exiting.
+    """
+    Worker(queue_dir, njobs=njobs, lease=lease, heartbeat=heartbeat,
+           wait=wait).start()
+    status(queue_dir)
+
+
+def queue_status(queue_dir):
+    """ Get the state of the jobs of a queue.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        the 'job', 'state' (pending, running, done or failed), 'exitcode',
+        'host' and 'logfile' of each job.
+    """
+    records = []
+    for path in sorted(glob.glob(os.path.join(queue_dir, JOBS_DIR,
+                                              "*.json"))):
+        name = os.path.basename(path)[:-len(".json")]
+        record = {"job": name, "state": "pending", "exitcode": None,
+                  "host": None, "logfile": None}
+        status_file = os.path.join(queue_dir, STATUS_DIR, name + ".status")
+        lock_file = os.path.join(queue_dir, LOCKS_DIR, name + ".lock")
+        if os.path.isfile(status_file):
+            record.update(read_status(status_file))
+            record["state"] = "done" if record["exitcode"] == 0 else "failed"
+        elif os.path.isfile(lock_file):
+            record["state"] = "running"
+        records.append(record)
+    return pd.DataFrame.from_records(
+        records, columns=["job", "state", "exitcode", "host", "logfile"])
+
+
+def status(queue_dir):
+    """ Print the number of pending, running, done and failed jobs of a
+    queue, and write the queue status.tsv table.
+
+    Parameters
+    ----------
+    queue_dir: str
+        the shared queue directory.
+    """
+    df = queue_status(queue_dir)
+    print(df["state"].value_counts().to_string())
+    failed = df[df["state"] == "failed"]
+    if len(failed) > 0:
+        print(failed)
+    outfile = os.path.join(queue_dir, "status.tsv")
+    df.to_csv(outfile, sep="\t", index=False)
+    print(outfile)
+
+
+def run_queue(cmd, queue_dir, iterative, constants=None, optional=None,
+              name_replace=True, njobs=1, lease=600, heartbeat=60):
+    """ Execute a runtime through a shared queue directory: the jobs are
+    submitted and a local worker is started. More workers can join from
+    other hosts with 'python tools/job_queue.py worker --queue-dir <dir>'.
+
+    Parameters
+    ----------
+    cmd: str
+        the command of the runtime.
+    queue_dir: str
+        the shared queue directory.
+    iterative: dict
+        the options that change for each subject (lists of the same length).
+    constants: dict, default None
+        the options shared by all the subjects.
+    optional: list of str, default None
+        the options prefixed by '--' (the hopla_optional list of the
+        runtime): the jobs get the same command line as with hopla.
+    name_replace: bool, default True
+        optionnaly replace the underscores by dashes in the options names.
+    njobs: int, default 1
+        the number of jobs run in parallel by the local worker.
+    lease: float, default 600
+        the lease duration in seconds.
+    heartbeat: float, default 60
+        the lease renewal period in seconds.
+
+    Returns
+    -------
+    status, exitcodes: dict
+        the state and exit code of each job.
+    """
+    names = submit(queue_dir, cmd, iterative, constants=constants,
+                   optional=optional, name_replace=name_replace)
+    print(f"number of jobs: {len(names)}")
+    print(f"join with: python {os.path.abspath(__file__)} worker "
+          f"--queue-dir {queue_dir}")
+    Worker(queue_dir, njobs=njobs, lease=lease, heartbeat=heartbeat).start()
+    status(queue_dir)
+    df = queue_status(queue_dir).set_index("job")
+    return (dict((name, df.at[name, "state"]) for name in names),
+            dict((name, df.at[name, "exitcode"]) for name in names))
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire({
+        "worker": worker,
+        "status": status})
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import glob
+import gzip
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.io_throttle import io_slot  # noqa: E402
+
+
+# The cache is enabled by setting the cache directory in this environment
+# variable, and its size is capped in GB (50 by default).
+CACHE_ENV = "RLINK_NIFTI_CACHE"
+SIZE_ENV = "RLINK_NIFTI_CACHE_SIZE"
+
+
+def cache_dir(cachedir=None):
+    """ Get the cache directory, None if the cache is disabled.
+    """
+    return cachedir or os.environ.get(CACHE_ENV) or None
+
+
+def cache_key(path):
+    """ Build the cache key of an image from its path, mtime and size.
+    """
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def cache_cap(max_size=None):
+    """ Get the cache size cap in bytes.
+    """
+    if max_size is None:
+        max_size = os.environ.get(SIZE_ENV, 50)
+    return float(max_size) * 1024 ** 3
+
+
+def uncompressed_size(path):
+    """ Get the uncompressed size of a .nii.gz image from its gzip trailer
+    (modulo 4 GB and for the last gzip member only): it is only a hint.
+    """
+    with open(path, "rb") as of:
+        of.seek(-4, os.SEEK_END)
+        return int.from_bytes(of.read(4), "little")
+
+
+def cached(path, cachedir=None, max_size=None, evict=True):
+    """ Get an uncompressed (memory-mappable) copy of a .nii.gz image.
+
+    The image is decompressed once in the cache, after the least recently
+    used images have been evicted to make room for it. The input path is
+    returned unchanged if the cache is disabled or if the image is not
+    compressed.
+
+    Parameters
+    ----------
+    path: str
+        path to a NIfTI image.
+    cachedir: str, default None
+        the cache directory, by default read from the RLINK_NIFTI_CACHE
+        environment variable.
+    max_size: float, default None
+        the cache size cap in GB, by default read from the
+        RLINK_NIFTI_CACHE_SIZE environment variable.
+    evict: bool, default True
+        optionnaly, evict the least recently used images when the cache is
+        full.
+
+    Returns
+    -------
+    path: str
+        path to the image to read.
+    """
+    cachedir = cache_dir(cachedir)
+    if cachedir is None or not path.endswith(".nii.gz"):
+        return path
+    dest = os.path.join(cachedir, cache_key(path) + ".nii")
+    if os.path.isfile(dest):
+        os.utime(dest)
+        return dest
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir, exist_ok=True)
+    if evict:
+        evict_lru(cachedir, max_size=max_size,
+                  reserve=uncompressed_size(path))
+    tmp = f"{dest}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with io_slot():
+        with gzip.open(path, "rb") as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, length=2 ** 22)
+        os.replace(tmp, dest)
+    return dest
+
+
+def evict_lru(cachedir=None, max_size=None, reserve=0):
+    """ Remove the least recently used images until the cache size (plus the
+    reserved size) is below its cap.
+
+    Parameters
+    ----------
+    cachedir: str, default None
+        the cache directory, by default read from the RLINK_NIFTI_CACHE
+        environment variable.
+    max_size: float, default None
+        the cache size cap in GB, by default read from the
+        RLINK_NIFTI_CACHE_SIZE environment variable or 50.
+    reserve: int, default 0
+        the size in bytes to free for a new image.
+    """
+    cachedir = cache_dir(cachedir)
+    if cachedir is None or not os.path.isdir(cachedir):
+        return
+    max_size = cache_cap(max_size) - reserve
+    entries = []
+    for entry in os.scandir(cachedir):
+        if entry.name.endswith(".nii"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(item[1] for item in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def warm(paths, cachedir=None, max_size=None, njobs=8):
+    """ Decompress a set of images in the cache in parallel.
+
+    The cache cap is enforced as the images are decompressed: the images
+    that do not fit in the cap are not cached (their input path is
+    returned).
+
+    Parameters
+    ----------
+    paths: str or list of str
+        the images or a glob regex to the images.
+    cachedir: str, default None
+        the cache directory, by default read from the RLINK_NIFTI_CACHE
+        environment variable.
+    max_size: float, default None
+        the cache size cap in GB, by default read from the
+        RLINK_NIFTI_CACHE_SIZE environment variable.
+    njobs: int, default 8
+        the number of parallel decompressions.
+
+    Returns
+    -------
+    mapping: dict
+        the path to read for each input image.
+    """
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))
+    cap = cache_cap(max_size)
+    budget = {"size": 0, "skipped": 0}
+    lock = threading.Lock()
+
+    def _warm(path):
+        if cache_dir(cachedir) is None or not path.endswith(".nii.gz"):
+            return path
+        size = uncompressed_size(path)
+        with lock:
+            if budget["size"] + size > cap:
+                budget["skipped"] += 1
+                return path
+            budget["size"] += size
+        return cached(path, cachedir=cachedir, max_size=max_size)
+
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        cached_paths = list(executor.map(_warm, paths))
+    if budget["skipped"] > 0:
+        print(f"cache full: {budget['skipped']} images not cached")
+    return dict(zip(paths, cached_paths))
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(warm)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import pickle
+import pandas as pd
+from tools.nifti_cache import cache_key
+
+
+_INDEXES = {}
+_MISSING = object()
+
+
+class ParticipantsIndex(object):
+    """ Dict-style lookups in a participants.tsv or transcoding table.
+
+    The table is indexed once by a key column: each lookup is then O(1)
+    instead of a filter on the whole table.
+    """
+    def __init__(self, df, key="participant_id"):
+        """ Init class.
+
+        Parameters
+        ----------
+        df: pandas.DataFrame
+            the participants or transcoding table.
+        key: str, default 'participant_id'
+            the column used to index the table.
+        """
+        self.key = key
+        self.columns = dict(
+            (column, dict(zip(df[key].values, df[column].values)))
+            for column in df.columns if column != key)
+
+    def get(self, key_value, column, default=_MISSING):
+        """ Get the value of a column for one participant.
+
+        Parameters
+        ----------
+        key_value: object
+            the participant identifier in the key column.
+        column: str
+            the column name.
+        default: object, default no default
+            the value returned when the participant or the value is missing,
+            otherwise raise a KeyError.
+
+        Returns
+        -------
+        value: object
+            the requested value.
+        """
+        value = self.columns[column].get(key_value, _MISSING)
+        if value is _MISSING or pd.isnull(value):
+            if default is _MISSING:
+                raise KeyError(f"no '{column}' for '{key_value}'")
+            return default
+        return value
+
+    def site(self, participant_id, session, default=_MISSING):
+        """ Get the site (center) of a participant for one session.
+        """
+        return self.get(participant_id, f"{session}_center", default=default)
+
+    def psc1(self, psc2, default=_MISSING):
+        """ Get the psc1 code of a psc2 code in a transcoding table.
+        """
+        return self.get(int(psc2), "psc1", default=default)
+
+
+def load_participants(path, key="participant_id", cachedir=None):
+    """ Load a participants index, once per process.
+
+    The index can also be pickled in a cache folder, keyed by the table path,
+    mtime and size.
+
+    Parameters
+    ----------
+    path: str
+        path to the participants.tsv (or transcoding) file.
+    key: str, default 'participant_id'
+        the column used to index the table.
+    cachedir: str, default None
+        optionnaly, the folder where the pickled indexes are stored (e.g.
+        '~/.cache/rlink_mri'), by default the index is not written on disk.
+
+    Returns
+    -------
+    index: ParticipantsIndex
+        the participants index.
+    """
+    name = f"participants-{cache_key(path)}-{key}"
+    if name in _INDEXES:
+        return _INDEXES[name]
+    pkl_file = None
+    if cachedir is not None:
+        cachedir = os.path.expanduser(cachedir)
+        pkl_file = os.path.join(cachedir, f"{name}.pkl")
+    index = None
+    if pkl_file is not None and os.path.isfile(pkl_file):
+        try:
+            with open(pkl_file, "rb") as of:
+                index = pickle.load(of)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            index = None
+    if index is None:
+        index = ParticipantsIndex(pd.read_csv(path, sep="\t"), key=key)
+        if pkl_file is not None:
+            try:
+                os.makedirs(cachedir, exist_ok=True)
+                tmp = f"{pkl_file}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as of:
+                    pickle.dump(index, of)
+                os.replace(tmp, pkl_file)
+            except OSError:
+                pass
+    _INDEXES[name] = index
+    return index
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import glob
+import gzip
+import zlib
+import socket
+import struct
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+
+# NIfTI datatype code: (name, bits per voxel)
+DATATYPES = {
+    2: ("uint8", 8), 4: ("int16", 16), 8: ("int32", 32),
+    16: ("float32", 32), 32: ("complex64", 64), 64: ("float64", 64),
+    128: ("rgb24", 24), 256: ("int8", 8), 512: ("uint16", 16),
+    768: ("uint32", 32), 1024: ("int64", 64), 1280: ("uint64", 64),
+    1536: ("float128", 128), 1792: ("complex128", 128),
+    2048: ("complex256", 256), 2304: ("rgba32", 32)}
+
+
+def read_header(path):
+    """ Read the NIfTI-1 or NIfTI-2 header of an image: only the first bytes
+    of the (gzip) stream are decompressed.
+
+    Parameters
+    ----------
+    path: str
+        path to a .nii or .nii.gz image.
+
+    Returns
+    -------
+    header: dict
+        the image dimensions, voxel sizes, datatype, bitpix and data offset.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as of:
+        raw = of.read(540)
+    if len(raw) < 348:
+        raise ValueError("truncated header")
+    for endian in ("<", ">"):
+        sizeof_hdr = struct.unpack(endian + "i", raw[:4])[0]
+        if sizeof_hdr == 348:
+            dim = struct.unpack(endian + "8h", raw[40: 56])
+            datatype, bitpix = struct.unpack(endian + "2h", raw[70: 74])
+            pixdim = struct.unpack(endian + "8f", raw[76: 108])
+            vox_offset = struct.unpack(endian + "f", raw[108: 112])[0]
+            magic = raw[344: 348]
+            if magic not in (b"n+1\x00", b"ni1\x00"):
+                raise ValueError(f"invalid NIfTI-1 magic {magic}")
+            break
+        if sizeof_hdr == 540:
+            if len(raw) < 540:
+                raise ValueError("truncated header")
+            datatype, bitpix = struct.unpack(endian + "2h", raw[12: 16])
+            dim = struct.unpack(endian + "8q", raw[16: 80])
+            pixdim = struct.unpack(endian + "8d", raw[104: 168])
+            vox_offset = struct.unpack(endian + "q", raw[168: 176])[0]
+            break
+    else:
+        raise ValueError("not a NIfTI file")
+    ndim = dim[0]
+    if ndim < 1 or ndim > 7:
+        raise ValueError(f"invalid number of dimensions {ndim}")
+    return {
+        "ndim": ndim,
+        "shape": tuple(int(item) for item in dim[1: ndim + 1]),
+        "voxel_size": tuple(float(item) for item in pixdim[1: ndim + 1]),
+        "datatype": int(datatype),
+        "bitpix": int(bitpix),
+        "vox_offset": int(vox_offset)}
+
+
+def gzip_size(path):
+    """ Get the uncompressed size modulo 2**32 stored in the gzip trailer (of
+    the last member only for a multi-member stream).
+    """
+    with open(path, "rb") as of:
+        if of.read(2) != b"\x1f\x8b":
+            raise ValueError("not a gzip file")
+        of.seek(-4, os.SEEK_END)
+        return struct.unpack("<I", of.read(4))[0]
+
+
+def gzip_crc(path, chunk_size=2 ** 20):
+    """ Decompress the whole gzip stream to check its CRC, and return the
+    uncompressed size.
+    """
+    size = 0
+    with gzip.open(path, "rb") as of:
+        while True:
+            chunk = of.read(chunk_size)
+            if not chunk:
+                return size
+            size += len(chunk)
+
+
+def check_file(path, deep=False, min_ndim=3, max_voxel_size=20.):
+    """ Validate a NIfTI image from its header.
+
+    The dimensions, voxel sizes and datatype are checked, as well as the
+    expected file size: for compressed images the size stored in the gzip
+    trailer is used as a hint, and the stream is fully decompressed only
+    when it does not match (e.g. a truncated file or a multi-member
+    stream).
+
+    Parameters
+    ----------
+    path: str
+        path to a .nii or .nii.gz image.
+    deep: bool, default False
+        optionnaly decompress the whole file to check the gzip CRC.
+    min_ndim: int, default 3
+        the minimum number of dimensions.
+    max_voxel_size: float, default 20
+        the maximum voxel size in mm.
+
+    Returns
+    -------
+    record: dict
+        the inventory record of the image, with a 'valid' flag and an 'error'
+        message.
+    """
+    record = {"path": path, "valid": False, "error": None}
+    try:
+        record["file_size"] = os.path.getsize(path)
+        header = read_header(path)
+        record.update(header)
+        shape = header["shape"]
+        voxel_size = header["voxel_size"]
+        if header["datatype"] not in DATATYPES:
+            raise ValueError(f"unknown datatype {header['datatype']}")
+        dtype, bitpix = DATATYPES[header["datatype"]]
+        record["dtype"] = dtype
+        if header["bitpix"] != bitpix:
+            raise ValueError(f"bitpix {header['bitpix']} does not match "
+                             f"datatype {dtype}")
+        if len(shape) < min_ndim or min(shape) < 1:
+            raise ValueError(f"invalid shape {shape}")
+        spatial = voxel_size[:3]
+        if (not all(np.isfinite(spatial)) or min(spatial) <= 0 or
+                max(spatial) > max_voxel_size):
+            raise ValueError(f"invalid voxel size {spatial}")
+        expected = (max(header["vox_offset"], 352) +
+                    int(np.prod(shape, dtype=np.int64)) * bitpix // 8)
+        record["expected_size"] = expected
+        if path.endswith(".gz"):
+            if deep or gzip_size(path) != expected % 2 ** 32:
+                if gzip_crc(path) < expected:
+                    raise ValueError("truncated gzip stream")
+        elif record["file_size"] < expected:
+            raise ValueError("truncated file")
+        record["valid"] = True
+    except (OSError, EOFError, ValueError, struct.error, zlib.error) as exc:
+        record["error"] = f"{type(exc).__name__}: {exc}"
+    return record
+
+
+def inventory(files, outfile=None, njobs=16, deep=False):
+    """ Read the headers of a cohort of NIfTI images in parallel.
+
+    Parameters
+    ----------
+    files: str or list of str
+        the images or a glob regex to the images.
+    outfile: str, default None
+        optionnaly, path to the output .tsv inventory table (written
+        atomically).
+    njobs: int, default 16
+        the number of parallel readers.
+    deep: bool, default False
+        optionnaly decompress the whole files to check the gzip CRC.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        the inventory table with one row per image.
+    """
+    if isinstance(files, str):
+        files = sorted(glob.glob(files))
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        records = list(executor.map(
+            lambda path: check_file(path, deep=deep), files))
+    df = pd.DataFrame.from_records(records, columns=[
+        "path", "valid", "error", "file_size", "expected_size", "ndim",
+        "shape", "voxel_size", "datatype", "dtype", "bitpix", "vox_offset"])
+    if outfile is not None:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(outfile))):
+            os.makedirs(os.path.dirname(os.path.abspath(outfile)),
+                        exist_ok=True)
+        tmp = f"{outfile}.{socket.gethostname()}-{os.getpid()}.tmp"
+        df.to_csv(tmp, sep="\t", index=False)
+        os.replace(tmp, outfile)
+    return df
+
+
+def select_valid(runs, outfile=None, njobs=16, deep=False):
+    """ Pre-flight validation of the runtimes inputs.
+
+    Parameters
+    ----------
+    runs: list of str
+        the input images of each run (comma separated if multiple images
+        are used in a run): paths that are not NIfTI images are ignored.
+    outfile: str, default None
+        optionnaly, path to the output .tsv inventory table.
+    njobs: int, default 16
+        the number of parallel readers.
+    deep: bool, default False
+        optionnaly decompress the whole files to check the gzip CRC.
+
+    Returns
+    -------
+    indices: list of int
+        the indices of the runs with valid inputs only.
+    """
+    run_files = [[path for path in run.split(",")
+                  if path.endswith((".nii", ".nii.gz"))] for run in runs]
+    files = sorted(set(sum(run_files, [])))
+    df = inventory(files, outfile=outfile, njobs=njobs, deep=deep)
+    errors = dict(zip(df.path[~df.valid], df.error[~df.valid]))
+    indices = []
+    for idx, paths in enumerate(run_files):
+        bad = [path for path in paths if path in errors]
+        if len(bad) == 0:
+            indices.append(idx)
+            continue
+        for path in bad:
+            print(f"preflight: excluded '{path}' ({errors[path]})")
+    print(f"preflight: {len(runs) - len(indices)} / {len(runs)} runs "
+          "excluded")
+    return indices
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(inventory)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import sys
+import glob
+import gzip
+import shutil
+import threading
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.io_throttle import io_slot  # noqa: E402
+
+
+def compress_file(path, level=6, check=True):
+    """ Compress a .nii image to .nii.gz and remove the original image.
+
+    The image is read, compressed in memory and written in a temporary file
+    that is then atomically renamed: the original image is only removed once
+    the .nii.gz image is in place. Only the read, the write and the rename
+    hold an I/O slot (see tools.io_throttle), not the compression.
+
+    Parameters
+    ----------
+    path: str
+        path to a .nii image.
+    level: int, default 6
+        the deflate compression level.
+    check: bool, default True
+        optionnaly check that the compressed image decompresses to the
+        original image.
+
+    Returns
+    -------
+    record: dict
+        the original and compressed sizes, and an 'error' message if any.
+    """
+    dest = path + ".gz"
+    record = {"path": path, "size": os.path.getsize(path),
+              "compressed_size": None, "error": None}
+    if os.path.exists(dest):
+        record["error"] = f"'{dest}' already exists"
+        return record
+    tmp = f"{dest}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with io_slot():
+            with open(path, "rb") as of:
+                data = of.read()
+        compressed = gzip.compress(data, compresslevel=level)
+        if check and gzip.decompress(compressed) != data:
+            raise ValueError("round-trip check failed")
+        del data
+        with io_slot():
+            with open(tmp, "wb") as of:
+                of.write(compressed)
+            if os.path.getsize(tmp) != len(compressed):
+                raise ValueError("truncated write")
+            shutil.copystat(path, tmp)
+            os.replace(tmp, dest)
+            os.remove(path)
+        record["compressed_size"] = len(compressed)
+    except (OSError, ValueError) as exc:
+        record["error"] = f"{type(exc).__name__}: {exc}"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return record
+
+
+def recompress(files, outfile=None, level=6, check=True, njobs=8,
+               dry_run=False):
+    """ Compress uncompressed derivative volumes to .nii.gz in parallel.
+
+    Parameters
+    ----------
+    files: str or list of str
+        the .nii images or a glob regex to the images, for instance
+        '<cat12dir>/sub-*/ses-*/mri/mwp1*.nii'.
+    outfile: str, default None
+        optionnaly, the output .tsv table.
+    level: int, default 6
+        the deflate compression level.
+    check: bool, default True
+        optionnaly check that each compressed image decompresses to the
+        original image before removing it.
+    njobs: int, default 8
+        the number of parallel compressions (each one holds an image and its
+        compressed version in memory).
+    dry_run: bool, default False
+        only list the images to compress.
+    """
+    if isinstance(files, str):
+        files = sorted(glob.glob(files))
+    files = [path for path in files if path.endswith(".nii")]
+    if len(files) == 0:
+        raise RuntimeError("No data to process!")
+    size = sum(os.path.getsize(path) for path in files)
+    print(f"number of images: {len(files)} ({size / 1024 ** 3:.1f} GB)")
+    if dry_run:
+        return
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        records = list(executor.map(
+            lambda path: compress_file(path, level=level, check=check),
+            files))
+    df = pd.DataFrame.from_records(records)
+    failed = df[df["error"].notnull()]
+    if len(failed) > 0:
+        print(failed)
+    compressed = df["compressed_size"].sum()
+    print(f"compressed: {len(df) - len(failed)} / {len(df)} images, "
+          f"{df.loc[df['error'].isnull(), 'size'].sum() / 1024 ** 3:.1f} GB "
+          f"-> {compressed / 1024 ** 3:.1f} GB")
+    if outfile is not None:
+        df.to_csv(outfile, sep="\t", index=False)
+        print(outfile)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(recompress)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import re
+import sys
+import glob
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.volumes import open_volume, scale  # noqa: E402
+
+
+class LabelIndex(object):
+    """ The flat index of a label image, computed once for all the subjects.
+
+    Parameters
+    ----------
+    label_file: str
+        path to the label image (0 is the background).
+    names_file: str, default None
+        optionnaly, a .tsv table with the 'label' and 'name' columns of the
+        atlas ROIs.
+    """
+    def __init__(self, label_file, names_file=None):
+        data, affine, scaling = open_volume(label_file)
+        labels = np.rint(scale(data, scaling, dtype=np.float64)).astype(int)
+        self.shape = labels.shape[:3]
+        self.affine = np.asarray(affine, dtype=float)
+        self.voxel_volume = float(abs(np.linalg.det(affine[:3, :3])))
+        flat = labels.reshape(-1, order="F")
+        self.indices = np.flatnonzero(flat)
+        self.labels, self.inverse, self.counts = np.unique(
+            flat[self.indices], return_inverse=True, return_counts=True)
+        self.names = dict((label, str(label)) for label in self.labels)
+        if names_file is not None:
+            df = pd.read_csv(names_file, sep="\t")
+            self.names.update(zip(df["label"].astype(int), df["name"]))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def reduce(self, values):
+        """ Compute the ROI sums, means and volumes of the in-label voxels of
+        a volume with a single bincount pass.
+
+        Parameters
+        ----------
+        values: numpy.ndarray
+            the voxels at the label index flat indices.
+
+        Returns
+        -------
+        sums, means, volumes: numpy.ndarray
+            the ROI sums and means of the voxels, and the ROI sums scaled by
+            the voxel volume (e.g. the GM volume of a modulated GM map).
+        """
+        sums = np.bincount(self.inverse, weights=values,
+                           minlength=len(self.labels))
+        return sums, sums / self.counts, sums * self.voxel_volume
+
+
+def parse_bids(path):
+    """ Get the subject and session of an image from its path, None if not
+    available.
+    """
+    sub = re.search(r"(sub-[^_/]+)", path)
+    ses = re.search(r"(ses-[^_/]+)", path)
+    return sub and sub.group(1), ses and ses.group(1)
+
+
+def extract_file(path, index, atol=1e-3):
+    """ Compute the ROI statistics of an image: each volume of a 4d image
+    (e.g. a TBSS skeletonised cohort) is reduced independently. The image
+    must have the shape and affine (up to 'atol') of the label image.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        the statistics of each ROI and volume.
+    """
+    data, affine, scaling = open_volume(path)
+    if tuple(data.shape[:3]) != tuple(index.shape):
+        raise ValueError(f"{path}: shape {data.shape} does not match the "
+                         f"label image shape {index.shape}")
+    if not np.allclose(affine, index.affine, atol=atol):
+        raise ValueError(f"{path}: affine {affine.tolist()} does not match "
+                         f"the label image affine {index.affine.tolist()}")
+    n_volumes = data.shape[3] if data.ndim == 4 else 1
+    flat = data.reshape(-1, n_volumes, order="F")
+    sub, ses = parse_bids(path)
+    tables = []
+    for volume in range(n_volumes):
+        values = scale(flat[index.indices, volume], scaling,
+                       dtype=np.float64)
+        sums, means, volumes = index.reduce(values)
+        tables.append(pd.DataFrame({
+            "participant_id": sub, "session": ses, "path": path,
+            "volume": volume if data.ndim == 4 else None,
+            "label": index.labels,
+            "roi": [index.names[label] for label in index.labels],
+            "n_voxels": index.counts, "sum": sums, "mean": means,
+            "roi_volume": volumes}))
+    return pd.concat(tables, ignore_index=True)
+
+
+def roi_table(files, label_file, names_file=None, njobs=16):
+    """ Compute the ROI sums, means and volumes of a cohort for a label
+    image (e.g. Neuromorphometrics in CAT12 space, JHU on the TBSS skeleton
+    or an MNI atlas for li2mni).
+
+    The label image is indexed once, and each image is then reduced with a
+    single bincount pass over its in-label voxels. The images are read in
+    parallel from memory mapped images, or from the decompression cache when
+    it is enabled (see tools.nifti_cache).
+
+    Parameters
+    ----------
+    files: str or list of str
+        the images (in the label image space), or a glob regex to the
+        images, for instance '<cat12dir>/sub-*/ses-*/mri/mwp1*_T1w.nii.gz'.
+    label_file: str
+        path to the label image (0 is the background).
+    names_file: str, default None
+        optionnaly, a .tsv table with the 'label' and 'name' columns of the
+        atlas ROIs.
+    njobs: int, default 16
+        the number of parallel readers.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        the 'participant_id', 'session', 'path', 'volume' (the index of the
+        volume in a 4d image), 'label', 'roi', 'n_voxels', 'sum', 'mean' and
+        'roi_volume' of each ROI and image.
+    """
+    if isinstance(files, str):
+        files = sorted(glob.glob(files))
+    if len(files) == 0:
+        raise RuntimeError("No data to process!")
+    index = LabelIndex(label_file, names_file=names_file)
+    print(f"number of images: {len(files)}")
+    print(f"number of ROIs: {len(index)}")
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        tables = list(executor.map(
+            lambda path: extract_file(path, index), files))
+    return pd.concat(tables, ignore_index=True)
+
+
+def extract(files, label_file, outfile, names_file=None, njobs=16):
+    """ Write the ROI sums, means and volumes of a cohort for a label image
+    in a tidy .tsv table (see roi_table).
+
+    Parameters
+    ----------
+    files: str or list of str
+        the images (in the label image space), or a glob regex to the
+        images.
+    label_file: str
+        path to the label image (0 is the background).
+    outfile: str
+        the output .tsv table.
+    names_file: str, default None
+        optionnaly, a .tsv table with the 'label' and 'name' columns of the
+        atlas ROIs.
+    njobs: int, default 16
+        the number of parallel readers.
+    """
+    df = roi_table(files, label_file, names_file=names_file, njobs=njobs)
+    df.to_csv(outfile, sep="\t", index=False)
+    print(outfile)
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire(extract)
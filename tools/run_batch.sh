@@ -0,0 +1,45 @@
+#!/bin/bash
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# Run a batch of subjects in a single container invocation.
+#
+# Usage: run_batch.sh <command> [<args>...] --jobfile <jobfile>
+#
+# Each line of the job file is a shell-quoted '<index> <logfile> <options>'
+# record (see tools/batch.py): the command is called once per line with
+# its options, its outputs are redirected in <logfile>, and the
+# '<index> <exitcode> <logfile>' status is appended to <jobfile>.status.
+# The script exits with 1 if any subject failed.
+
+if [ "$#" -lt 3 ] || [ "${@: -2:1}" != "--jobfile" ]; then
+    echo "Usage: $0 <command> [<args>...] --jobfile <jobfile>" >&2
+    exit 2
+fi
+jobfile="${@: -1}"
+command=("${@:1:$#-2}")
+statusfile="${jobfile}.status"
+: > "${statusfile}"
+
+failed=0
+while IFS= read -r line || [ -n "${line}" ]; do
+    [ -z "${line}" ] && continue
+    eval "job=(${line})"
+    index="${job[0]}"
+    logfile="${job[1]}"
+    echo "[$(date +%Y%m%d-%H%M%S)] ${index}: ${command[*]} ${job[*]:2}"
+    "${command[@]}" "${job[@]:2}" > "${logfile}" 2>&1
+    exitcode=$?
+    printf "%s\t%s\t%s\n" "${index}" "${exitcode}" "${logfile}" \
+        >> "${statusfile}"
+    if [ "${exitcode}" -ne 0 ]; then
+        echo "[$(date +%Y%m%d-%H%M%S)] ${index}: failed (${exitcode})"
+        failed=1
+    fi
+done < "${jobfile}"
+exit ${failed}
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import glob
+import shutil
+import heapq
+import pandas as pd
+
+
+def split(items, nshards):
+    """ Split a list in at most 'nshards' non empty round-robin shards.
+    """
+    shards = [items[idx::nshards] for idx in range(max(nshards, 1))]
+    return [shard for shard in shards if len(shard) > 0]
+
+
+def input_costs(items, cost_file=None):
+    """ Predict the cost of each run from its inputs.
+
+    Parameters
+    ----------
+    items: list of str
+        the input of each run: a path or comma separated paths.
+    cost_file: str, default None
+        optionnaly, a .tsv table with the 'path' (the run input) and 'cost'
+        (e.g. a past runtime) columns. The runs that are not in this table
+        get the cost predicted from their input size with the median cost
+        per byte of the known runs.
+
+    Returns
+    -------
+    costs: list of float
+        the predicted cost of each run: the total size of its input files,
+        1 for a run without input files.
+    """
+    sizes = []
+    for item in items:
+        paths = [path for path in str(item).split(",") if os.path.isfile(path)]
+        sizes.append(float(sum(os.path.getsize(path) for path in paths)) or 1.)
+    if cost_file is None:
+        return sizes
+    df = pd.read_csv(cost_file, sep="\t")
+    known = dict(zip(df["path"].astype(str), df["cost"].astype(float)))
+    ratios = [known[str(item)] / size for item, size in zip(items, sizes)
+              if str(item) in known]
+    ratio = float(pd.Series(ratios).median()) if len(ratios) > 0 else 1.
+    return [known.get(str(item), size * ratio)
+            for item, size in zip(items, sizes)]
+
+
+def balance(items, costs, nshards):
+    """ Assign the runs to shards with the longest processing time first
+    rule: the runs sorted by decreasing cost are assigned in turn to the
+    least loaded shard. The assignment only depends on the runs inputs and
+    costs, not on their order.
+
+    Returns
+    -------
+    assignments: list of int
+        the shard of each run.
+    loads: list of float
+        the predicted cost of each shard.
+    """
+    order = sorted(range(len(items)),
+                   key=lambda idx: (-costs[idx], str(items[idx])))
+    heap = [(0., shard) for shard in range(nshards)]
+    assignments = [None] * len(items)
+    loads = [0.] * nshards
+    for idx in order:
+        load, shard = heapq.heappop(heap)
+        assignments[idx] = shard
+        loads[shard] = load + costs[idx]
+        heapq.heappush(heap, (loads[shard], shard))
+    return assignments, loads
+
+
+def select_shard(items, shard_index, shard_count, cost_file=None):
+    """ Select the runs of one static shard, so that several machines can
+    process disjoint subsets of the same cohort on a shared filesystem.
+
+    Parameters
+    ----------
+    items: list of str
+        the input of each run: a path or comma separated paths.
+    shard_index: int
+        the index of the selected shard.
+    shard_count: int
+        the number of shards.
+    cost_file: str, default None
+        optionnaly, a .tsv table with the 'path' and 'cost' columns used to
+        balance the shards (see input_costs).
+
+    Returns
+    -------
+    keep: list of int
+        the indices of the runs in the selected shard.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"invalid shard {shard_index} / {shard_count}")
+    costs = input_costs(items, cost_file=cost_file)
+    assignments, loads = balance(items, costs, shard_count)
+    keep = [idx for idx, shard in enumerate(assignments)
+            if shard == shard_index]
+    print(f"shard {shard_index} / {shard_count}: {len(keep)} / {len(items)} "
+          f"runs, predicted cost {loads[shard_index]:.3g} / {sum(costs):.3g}")
+    return keep
+
+
+def link_files(files, datadir, linkdir):
+    """ Mirror a set of input files in a directory of symbolic links with the
+    input directory layout, so that a glob regex on the input directory can
+    be applied on the selected files only.
+
+    Parameters
+    ----------
+    files: list of str
+        the input files or directories.
+    datadir: str
+        the input root directory of the files.
+    linkdir: str
+        the directory where the links are generated: previous links are
+        removed.
+
+    Returns
+    -------
+    linkdir: str
+        the input root directory of the links.
+    """
+    if os.path.isdir(linkdir):
+        shutil.rmtree(linkdir)
+    os.makedirs(linkdir)
+    for path in files:
+        link = os.path.join(linkdir, os.path.relpath(path, datadir))
+        if not os.path.isdir(os.path.dirname(link)):
+            os.makedirs(os.path.dirname(link))
+        os.symlink(os.path.abspath(path), link)
+    return linkdir
+
+
+def make_shards(groups, datadir, sharddir, nshards):
+    """ Split the inputs of a cohort job in shards of symbolic links that
+    mirror the input directory layout, so that the same glob regex can be
+    applied on each shard.
+
+    Parameters
+    ----------
+    groups: list of list of str
+        the input files or directories of each subject/session: a group is
+        never split across shards.
+    datadir: str
+        the input root directory of the groups.
+    sharddir: str
+        the directory where the shards are generated: previous shards are
+        removed.
+    nshards: int
+        the number of shards.
+
+    Returns
+    -------
+    shard_datadirs: list of str
+        the input root directory of each shard.
+    shard_outdirs: list of str
+        the output directory of each shard.
+    """
+    for path in glob.glob(os.path.join(sharddir, "shard-*")):
+        shutil.rmtree(path)
+    shard_datadirs, shard_outdirs = [], []
+    for idx, shard in enumerate(split(groups, nshards)):
+        _datadir = link_files(
+            sum(shard, []), datadir,
+            os.path.join(sharddir, f"shard-{idx:03d}", "data"))
+        _outdir = os.path.join(sharddir, f"shard-{idx:03d}", "qc")
+        os.makedirs(_outdir)
+        shard_datadirs.append(_datadir)
+        shard_outdirs.append(_outdir)
+    return shard_datadirs, shard_outdirs
+
+
+def merge_tsv(shard_outdirs, outdir):
+    """ Concatenate the .tsv tables generated in each shard in the final
+    output directory: an error is raised if a shard has no table or misses
+    a table generated by the other shards (e.g. a failed shard job).
+
+    Parameters
+    ----------
+    shard_outdirs: list of str
+        the output directory of each shard.
+    outdir: str
+        the final output directory.
+
+    Returns
+    -------
+    outfiles: list of str
+        the merged tables.
+    """
+    tables = {}
+    for _outdir in shard_outdirs:
+        for path in sorted(glob.glob(os.path.join(_outdir, "*.tsv"))):
+            tables.setdefault(os.path.basename(path), {})[_outdir] = (
+                pd.read_csv(path, sep="\t"))
+    missing = [_outdir for _outdir in shard_outdirs
+               if len(tables) == 0 or
+               any(_outdir not in dfs for dfs in tables.values())]
+    if len(missing) > 0:
+        raise RuntimeError(f"missing tables in {len(missing)} / "
+                           f"{len(shard_outdirs)} shards: {missing}")
+    outfiles = []
+    for basename, dfs in tables.items():
+        outfile = os.path.join(outdir, basename)
+        pd.concat(dfs.values(), ignore_index=True).to_csv(
+            outfile, sep="\t", index=False)
+        print(f"merged {len(dfs)} / {len(shard_outdirs)} shards: {outfile}")
+        outfiles.append(outfile)
+    return outfiles
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import os
+import re
+import sys
+import glob
+import shutil
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools.check_date_last_changes import scan  # noqa: E402
+from tools.io_throttle import io_slot  # noqa: E402
+
+
+# For each pipeline of the derivatives folder: the glob pattern of the
+# processed units (subject/session folders), the completion marker of a unit
+# and the files to keep in a unit ('*' matches inside a folder and '**'
+# matches across folders).
+PIPELINES = {
+    # the cross-sectional runs are the inputs of the longitudinal stream
+    # (recon-all -base/-long, see freesurfer/fslongitudinal_runtime.py):
+    # all the volumes it reads are kept.
+    "freesurfer": {
+        "units": "ses-*/sub-*",
+        "marker": "scripts/recon-all.done",
+        "keep": ["stats/**", "label/**", "surf/**", "scripts/**", "xhemi/**",
+                 "touch/**", "mri/transforms/**", "mri/orig/**",
+                 "mri/rawavg.mgz", "mri/orig.mgz", "mri/nu.mgz", "mri/T1.mgz",
+                 "mri/brain.mgz", "mri/brainmask.mgz", "mri/norm.mgz",
+                 "mri/wm.mgz", "mri/wm.seg.mgz", "mri/wm.asegedit.mgz",
+                 "mri/filled.mgz", "mri/brain.finalsurfs.mgz",
+                 "mri/aseg.mgz", "mri/aseg.presurf.mgz",
+                 "mri/aseg.auto.mgz", "mri/aseg.auto_noCCseg.mgz",
+                 "mri/aparc*+aseg.mgz"]},
+    "cat12vbm": {
+        "units": "sub-*/ses-*",
+        "marker": "report/cat_*.xml",
+        "keep": ["mri/mwp1*", "report/*.xml", "report/*.pdf",
+                 "label/*.xml"]},
+    "dmriprep": {
+        "units": "sub-*/ses-*",
+        "marker": "SCALARS/dwmri_tensor_fa.nii.gz",
+        "keep": ["SCALARS/**", "PREPROCESSED/**", "PDF/**"]},
+    "tbss": {
+        "units": ".",
+        "marker": "stats/all_FA_skeletonised.nii.gz",
+        "keep": ["stats/**", "origdata/**", "MD/**", "*.nii.gz", "FA/*.msf",
+                 "FA/*_FA.nii.gz", "FA/*_FA_mask.nii.gz", "FA/target*"]},
+}
+
+
+def to_regex(pattern):
+    """ Convert a keep pattern to a regex: '*' and '?' do not match the
+    folder separator and '**' matches any number of folders.
+    """
+    regex = ""
+    for item in re.split(r"(\*\*|\*|\?)", pattern):
+        if item == "**":
+            regex += ".*"
+        elif item == "*":
+            regex += "[^/]*"
+        elif item == "?":
+            regex += "[^/]"
+        else:
+            regex += re.escape(item)
+    return re.compile(regex + "$")
+
+
+def inventory(pipedir, spec, keep=None, njobs=16):
+    """ List the files of a pipeline by unit with their keep status.
+
+    Parameters
+    ----------
+    pipedir: str
+        the pipeline derivatives folder.
+    spec: dict
+        the pipeline 'units', 'marker' and 'keep' patterns.
+    keep: list of str, default None
+        optionnaly, overload the pipeline keep patterns.
+    njobs: int, default 16
+        the number of parallel scanners.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        the 'unit', 'relpath', 'category', 'size', 'complete' and 'keep'
+        status of each file in a unit.
+    """
+    units = sorted(
+        os.path.relpath(path, pipedir)
+        for path in glob.glob(os.path.join(pipedir, spec["units"]))
+        if os.path.isdir(path))
+    complete = dict(
+        (unit, len(glob.glob(os.path.join(pipedir, unit, spec["marker"]))) > 0)
+        for unit in units)
+    depth = 0 if spec["units"] == "." else len(spec["units"].split("/"))
+    regexes = [to_regex(pattern) for pattern in (keep or spec["keep"])]
+    df = scan(pipedir, njobs=njobs)
+    parts = df["path"].map(
+        lambda path: os.path.relpath(path, pipedir).split(os.sep))
+    df["unit"] = parts.map(
+        lambda items: "/".join(items[:depth]) if depth > 0 else ".")
+    df["relpath"] = parts.map(lambda items: "/".join(items[depth:]))
+    df = df[df["unit"].isin(units) & (df["relpath"].map(len) > 0)].copy()
+    df["category"] = df["relpath"].map(
+        lambda path: path.split("/")[0] if "/" in path else ".")
+    df["complete"] = df["unit"].map(complete)
+    df["keep"] = df["relpath"].map(
+        lambda path: any(regex.match(path) for regex in regexes))
+    return df
+
+
+def audit(derivatives_dir, outfile=None, pipelines=None, njobs=16):
+    """ Compute the disk usage of the derivatives by pipeline, unit
+    (subject/session) and file category (first sub-folder).
+
+    Parameters
+    ----------
+    derivatives_dir: str
+        the BIDS derivatives folder.
+    outfile: str, default None
+        optionnaly, the output .tsv table.
+    pipelines: list of str, default None
+        the pipelines to audit, by default all the known pipelines.
+    njobs: int, default 16
+        the number of parallel scanners.
+    """
+    tables = []
+    for name in pipelines or sorted(PIPELINES):
+        pipedir = os.path.join(derivatives_dir, name)
+        if not os.path.isdir(pipedir):
+            print(f"no '{pipedir}' folder!")
+            continue
+        df = inventory(pipedir, PIPELINES[name], njobs=njobs)
+        df["prunable_size"] = df["size"].where(~df["keep"], 0)
+        df = df.groupby(["unit", "category", "complete"]).agg(
+            n_files=("size", "size"), size=("size", "sum"),
+            prunable_files=("keep", lambda keep: int((~keep).sum())),
+            prunable_size=("prunable_size", "sum")).reset_index()
+        df.insert(0, "pipeline", name)
+        tables.append(df)
+        print(f"{name}: {df['size'].sum() / 1024 ** 3:.1f} GB, "
+              f"{df['prunable_size'].sum() / 1024 ** 3:.1f} GB prunable")
+    if len(tables) == 0:
+        raise RuntimeError("No data to process!")
+    df = pd.concat(tables, ignore_index=True)
+    if outfile is not None:
+        df.to_csv(outfile, sep="\t", index=False)
+        print(outfile)
+
+
+def prune(derivatives_dir, pipeline, outfile=None, archive_dir=None,
+          keep=None, dry_run=True, njobs=16):
+    """ Delete (or archive) the files of the completed units of a pipeline
+    that are not in its keep-list.
+
+    Units without a completion marker are skipped. By default nothing is
+    removed: the files that would be pruned are only listed.
+
+    Parameters
+    ----------
+    derivatives_dir: str
+        the BIDS derivatives folder.
+    pipeline: str
+        the pipeline to prune.
+    outfile: str, default None
+        optionnaly, the output .tsv table of the pruned files.
+    archive_dir: str, default None
+        optionnaly, move the pruned files in this folder (with the same
+        layout) instead of deleting them.
+    keep: list of str, default None
+        optionnaly, overload the pipeline keep patterns.
+    dry_run: bool, default True
+        only list the files to prune.
+    njobs: int, default 16
+        the number of parallel scanners and removals.
+    """
+    pipedir = os.path.join(derivatives_dir, pipeline)
+    df = inventory(pipedir, PIPELINES[pipeline], keep=keep, njobs=njobs)
+    incomplete = sorted(df.loc[~df["complete"], "unit"].unique())
+    for unit in incomplete:
+        print(f"skip '{unit}': no completion marker")
+    df = df[df["complete"] & ~df["keep"]]
+    print(f"{pipeline}: {len(df)} files to prune in {df['unit'].nunique()} "
+          f"units ({df['size'].sum() / 1024 ** 3:.1f} GB), "
+          f"{len(incomplete)} incomplete units skipped")
+    if outfile is not None:
+        df[["path", "unit", "category", "size"]].to_csv(
+            outfile, sep="\t", index=False)
+        print(outfile)
+    if dry_run:
+        print("dry run: nothing removed")
+        return
+
+    def _prune(path):
+        if archive_dir is None:
+            os.remove(path)
+            return
+        dest = os.path.join(archive_dir, pipeline,
+                            os.path.relpath(path, pipedir))
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with io_slot():
+            shutil.move(path, dest)
+
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        list(executor.map(_prune, df["path"]))
+    print(f"{'archived' if archive_dir else 'deleted'} {len(df)} files")
+
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire({
+        "audit": audit,
+        "prune": prune})
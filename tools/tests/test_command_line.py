@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Check that the batch and queue jobs of each runtime run the command lines
+that its hopla call builds.
+"""
+
+# Imports
+import os
+import sys
+import json
+import types
+import shlex
+import importlib
+import pytest
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+sys.path.append(ROOT_DIR)
+try:
+    import hopla.converter  # noqa: F401
+except ImportError:
+    # the hopla calls are captured below: only the import must succeed
+    for _name in ("hopla", "hopla.converter"):
+        sys.modules[_name] = types.ModuleType(_name)
+    sys.modules["hopla.converter"].hopla = None
+from tools.batch import make_jobs  # noqa: E402
+from tools.job_queue import JOBS_DIR, submit  # noqa: E402
+from tools.command_line import format_option  # noqa: E402
+
+
+def hopla_commands(script, hopla_iterative_kwargs=None, hopla_optional=None,
+                   hopla_name_replace=False, hopla_python_cmd=None,
+                   **kwargs):
+    """ Build the command lines as hopla.converter.hopla does.
+    """
+    iterative_kwargs = hopla_iterative_kwargs or []
+    hopla_optional = hopla_optional or []
+    kwargs = dict((key, value) for key, value in kwargs.items()
+                  if not key.startswith("hopla_"))
+    kwargs = sorted(kwargs.items())
+    if hopla_name_replace:
+        kwargs = [(name.replace("_", "-"), value) for name, value in kwargs]
+
+    def option(name, value):
+        if value is None or value is False:
+            return []
+        args = [("--" if name in hopla_optional else "-") + name]
+        if isinstance(value, list):
+            args.extend([str(item) for item in value])
+        elif not isinstance(value, bool):
+            args.append(str(value))
+        return args
+
+    commands = []
+    for name, values in kwargs:
+        if name in iterative_kwargs:
+            for idx, value in enumerate(values):
+                if len(commands) <= idx:
+                    commands.append([])
+                commands[idx].extend(option(name, value))
+    for command in commands:
+        for name, value in kwargs:
+            if name not in iterative_kwargs:
+                command.extend(option(name, value))
+    prefix = [hopla_python_cmd] if hopla_python_cmd else []
+    return prefix + shlex.split(script), commands
+
+
+def touch(*parts):
+    """ Create an empty file.
+    """
+    path = os.path.join(*parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wt").close()
+    return path
+
+
+def anat_tree(root, sessions=("ses-M00", "ses-M03")):
+    """ Two subjects with all the sessions, one with the first session only.
+    """
+    datadir = os.path.join(root, "rawdata")
+    for subject, _sessions in (("sub-01", sessions), ("sub-02", sessions),
+                               ("sub-03", sessions[:1])):
+        for session in _sessions:
+            touch(datadir, subject, session, "anat",
+                  f"{subject}_{session}_run-1_T1w.nii.gz")
+    return datadir
+
+
+def deface_tree(root, sessions=("ses-M00", "ses-M03"), name="deface"):
+    """ The anatomical images and their defaced version.
+    """
+    datadir = anat_tree(root, sessions)
+    for subject in os.listdir(datadir):
+        for session in os.listdir(os.path.join(datadir, subject)):
+            touch(root, "derivatives", name, subject, session,
+                  f"{subject}_{session}_run-1_T1w.nii.gz")
+    return datadir
+
+
+def dwi_tree(root):
+    """ Two sessions with the two TOPUP DWI runs and their sidecars.
+    """
+    datadir = os.path.join(root, "rawdata")
+    for subject in ("sub-01", "sub-02"):
+        for session in ("ses-M00", "ses-M03"):
+            for run, pe in (("1", "j"), ("2", "j-")):
+                basename = f"{subject}_{session}_acq-DWI_run-{run}_dwi"
+                for ext in (".nii.gz", ".bvec", ".bval"):
+                    touch(datadir, subject, session, "dwi", basename + ext)
+                with open(touch(datadir, subject, session, "dwi",
+                                basename + ".json"), "wt") as of:
+                    json.dump({"PhaseEncodingDirection": pe,
+                               "TotalReadoutTime": 0.05}, of)
+    return datadir
+
+
+def lithium_tree(root):
+    """ The lithium images with the lithium and hydrogen anatomical images.
+    """
+    datadir = os.path.join(root, "rawdata")
+    for subject in ("sub-01", "sub-02"):
+        touch(datadir, subject, "ses-M03Li", "lithium",
+              f"{subject}_ses-M03Li_acq-1_part-mag_limri.nii.gz")
+        touch(datadir, subject, "ses-M03Li", "anat",
+              f"{subject}_ses-M03Li_run-1_T1w.nii.gz")
+        touch(datadir, subject, "ses-M03", "anat",
+              f"{subject}_ses-M03_run-1_T1w.nii.gz")
+    return datadir
+
+
+def li2mni_tree(root):
+    """ The lithium images in the MNI space, the participants and phantom
+    tables.
+    """
+    datadir = os.path.join(root, "derivatives", "li2mni")
+    for subject in ("sub-01", "sub-02"):
+        touch(datadir, subject, "ses-M03Li", "li2mni.nii.gz")
+    with open(os.path.join(root, "participants.tsv"), "wt") as of:
+        of.write("participant_id\tses-M03Li_center\n")
+        of.write("sub-01\t1\nsub-02\t2\n")
+    with open(touch(root, "phantom", "phantom_mean_value.tsv"), "wt") as of:
+        of.write("Site\tMean\n1\t10.5\n2\t11.5\n")
+    return datadir
+
+
+def fa_tree(root):
+    """ The FA and MD maps of two sessions.
+    """
+    datadir = os.path.join(root, "derivatives", "dmriprep")
+    for subject in ("sub-01", "sub-02"):
+        for session in ("ses-M00", "ses-M03"):
+            for scalar in ("fa", "md"):
+                touch(datadir, subject, session, "SCALARS",
+                      f"dwmri_tensor_{scalar}.nii.gz")
+    return datadir
+
+
+def quasiraw_args(root):
+    return [anat_tree(root), os.path.join(root, "derivatives"),
+            "brainprep.simg"], {"preflight": False}
+
+
+def cat12vbm_args(root):
+    return [anat_tree(root), os.path.join(root, "derivatives"),
+            "brainprep.simg"], {"preflight": False}
+
+
+def freesurfer_args(root):
+    return [anat_tree(root), os.path.join(root, "derivatives"),
+            os.path.join(root, "templates"), "license.txt",
+            "brainprep.simg"], {"preflight": False}
+
+
+def fslongitudinal_args(root):
+    return [anat_tree(root), os.path.join(root, "derivatives"),
+            os.path.join(root, "templates"), "license.txt",
+            "brainprep.simg"], {}
+
+
+def deface_args(root):
+    return [anat_tree(root), os.path.join(root, "derivatives"),
+            "brainprep.simg"], {"preflight": False}
+
+
+def deface_lianat_args(root):
+    return [anat_tree(root, ("ses-M03Li", "ses-M03H")),
+            os.path.join(root, "derivatives"), "brainprep.simg"], {
+                "preflight": False}
+
+
+def deface_qc_args(root):
+    return [deface_tree(root), os.path.join(root, "derivatives"),
+            "brainprep.simg"], {"preflight": False}
+
+
+def deface_lianat_qc_args(root):
+    return [deface_tree(root, ("ses-M03Li", "ses-M03H")),
+            os.path.join(root, "derivatives"), "brainprep.simg"], {
+                "preflight": False}
+
+
+def dmriprep_args(root):
+    return [dwi_tree(root), os.path.join(root, "derivatives"),
+            "brainprep.simg"], {"preflight": False}
+
+
+def li2mni_args(root):
+    return [lithium_tree(root), os.path.join(root, "derivatives")], {
+        "preflight": False}
+
+
+def li2mninorm_args(root):
+    return [li2mni_tree(root), os.path.join(root, "derivatives"),
+            os.path.join(root, "phantom"),
+            os.path.join(root, "participants.tsv")], {"preflight": False}
+
+
+def tbss_args(root):
+    return [fa_tree(root), os.path.join(root, "derivatives")], {
+        "simg_file": "brainprep.simg", "target": "target.nii.gz",
+        "target_skel": "target_skel.nii.gz", "preflight": False}
+
+
+RUNTIMES = [
+    ("quasiraw.runtime", quasiraw_args, ("batch", "queue")),
+    ("cat12vbm.runtime", cat12vbm_args, ("batch", "queue")),
+    ("freesurfer.runtime", freesurfer_args, ("batch", "queue")),
+    ("freesurfer.fslongitudinal_runtime", fslongitudinal_args,
+     ("batch", "queue")),
+    ("deface.runtime", deface_args, ("batch", "queue")),
+    ("deface.deface_lianat_runtime", deface_lianat_args, ("batch", "queue")),
+    ("deface.qc", deface_qc_args, ("batch", )),
+    ("deface.deface_lianat_qc", deface_lianat_qc_args, ("batch", )),
+    ("dmriprep.runtime", dmriprep_args, ("batch", "queue")),
+    ("li2mni.runtime1", li2mni_args, ("queue", )),
+    ("li2mni.runtime2", li2mninorm_args, ("queue", )),
+    ("tbss.runtime", tbss_args, ("queue", ))]
+
+
+def load_runtime(name):
+    """ Import a runtime, skip the test if one of its dependencies is
+    missing.
+    """
+    if name == "li2mni.runtime2":
+        pytest.importorskip("limri")
+    return importlib.import_module(name)
+
+
+def run_commands(monkeypatch, tmp_path, name, make_args, mode):
+    """ Run a runtime and capture the command lines of its jobs.
+    """
+    module = load_runtime(name)
+    calls = []
+
+    def fake_hopla(script, **kwargs):
+        calls.append(hopla_commands(script, **kwargs))
+        return {}, {}
+
+    def fake_run_batches(cmd, batch_size, batchdir, iterative,
+                         constants=None, optional=None, name_replace=True,
+                         **hopla_kwargs):
+        commands = []
+        for jobfile in make_jobs(batchdir, batch_size, iterative,
+                                 constants=constants, optional=optional,
+                                 name_replace=name_replace):
+            with open(jobfile, "rt") as of:
+                commands.extend([shlex.split(line)[2:] for line in of])
+        calls.append((shlex.split(cmd), commands))
+        return {}, {}
+
+    def fake_run_queue(cmd, queue_dir, iterative, constants=None,
+                       optional=None, name_replace=True, **kwargs):
+        commands = []
+        for job in submit(queue_dir, cmd, iterative, constants=constants,
+                          optional=optional, name_replace=name_replace):
+            with open(os.path.join(queue_dir, JOBS_DIR, job + ".json"),
+                      "rt") as of:
+                commands.append(json.load(of)["args"])
+        calls.append((shlex.split(cmd), commands))
+        return {}, {}
+
+    monkeypatch.setattr(module, "hopla", fake_hopla)
+    if hasattr(module, "run_batches"):
+        monkeypatch.setattr(module, "run_batches", fake_run_batches)
+    if hasattr(module, "run_queue"):
+        monkeypatch.setattr(module, "run_queue", fake_run_queue)
+    args, kwargs = make_args(str(tmp_path))
+    kwargs.update(process=True, njobs=1)
+    if mode == "batch":
+        kwargs["batch_size"] = 2
+    elif mode == "queue":
+        kwargs["queue_dir"] = str(tmp_path / "queue")
+    module.run(*args, **kwargs)
+    assert len(calls) == 1
+    return calls[0]
+
+
+@pytest.mark.parametrize("name,make_args,mode", [
+    (name, make_args, mode) for name, make_args, modes in RUNTIMES
+    for mode in modes])
+def test_runtime_commands(monkeypatch, tmp_path, name, make_args, mode):
+    """ The batch and queue jobs run the command lines of the hopla jobs.
+    """
+    cmd, commands = run_commands(
+        monkeypatch, tmp_path, name, make_args, None)
+    assert len(commands) > 1
+    assert run_commands(
+        monkeypatch, tmp_path, name, make_args, mode) == (cmd, commands)
+
+
+@pytest.mark.parametrize("name,value,optional,name_replace,args", [
+    ("outdir", "/out", ["outdir"], True, ["--outdir", "/out"]),
+    ("thr_mask", 0.6, [], True, ["-thr-mask", "0.6"]),
+    ("ref_value", 1.5, ["ref_value"], True, ["-ref-value", "1.5"]),
+    ("readout_time", "0.05", ["readout_time"], False,
+     ["--readout_time", "0.05"]),
+    ("longitudinal", True, ["longitudinal"], True, ["--longitudinal"]),
+    ("longitudinal", False, ["longitudinal"], True, []),
+    ("mask", None, [], True, []),
+    ("fsdirs", ["/a", "/b"], [], True, ["-fsdirs", "/a", "/b"])])
+def test_format_option(name, value, optional, name_replace, args):
+    """ The options follow the hopla rules.
+    """
+    assert format_option(name, value, optional=optional,
+                         name_replace=name_replace) == args
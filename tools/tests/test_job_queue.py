@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Check the submission of the jobs in a queue directory.
+"""
+
+# Imports
+import os
+import sys
+import json
+import pytest
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+sys.path.append(ROOT_DIR)
+from tools.job_queue import QUEUE_FILE, submit  # noqa: E402
+
+
+def test_submit_same_command(tmp_path):
+    """ The jobs of a command can be submitted again.
+    """
+    queue_dir = str(tmp_path)
+    names = submit(queue_dir, "brainprep quasiraw", {"outdir": ["a", "b"]})
+    assert submit(queue_dir, "brainprep quasiraw",
+                  {"outdir": ["b", "c"]})[0] == names[1]
+
+
+def test_submit_other_command(tmp_path):
+    """ A queue runs a single command.
+    """
+    queue_dir = str(tmp_path)
+    submit(queue_dir, "brainprep quasiraw", {"outdir": ["a"]})
+    with pytest.raises(ValueError):
+        submit(queue_dir, "brainprep cat12vbm", {"outdir": ["a"]})
+    with open(os.path.join(queue_dir, QUEUE_FILE), "rt") as of:
+        assert json.load(of)["cmd"] == "brainprep quasiraw"
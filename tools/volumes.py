@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+##########################################################################
+# NSAp - Copyright (C) CEA, 2023
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+
+# Imports
+import glob
+import nibabel
+import numpy as np
+from tools.nifti_cache import cached
+
+
+def list_images(pattern):
+    """ List the NIfTI images that match a glob pattern without extension
+    (e.g. '<dir>/sub-*/ses-*/mri/mwp1usub*_T1w').
+
+    The .nii and .nii.gz extensions are matched exactly (so that temporary
+    files are ignored) and a single image is returned by stem: the
+    compressed one when both exist (e.g. during a recompression).
+
+    Parameters
+    ----------
+    pattern: str
+        the glob pattern of the images without extension.
+
+    Returns
+    -------
+    files: list of str
+        the sorted images.
+    """
+    images = {}
+    for ext in (".nii", ".nii.gz"):
+        for path in glob.glob(pattern + ext):
+            images[path[:-len(ext)]] = path
+    return sorted(images.values())
+
+
+def open_volume(path):
+    """ Open a NIfTI image without loading nor casting its data.
+
+    Uncompressed images are memory mapped: only the voxels that are accessed
+    are read from disk. Compressed images are read from the decompression
+    cache when it is enabled (see tools.nifti_cache).
+
+    Parameters
+    ----------
+    path: str
+        path to a .nii or .nii.gz image.
+
+    Returns
+    -------
+    data: numpy.memmap or numpy.ndarray
+        the unscaled voxels in the image native dtype (Fortran ordered).
+    affine: numpy.ndarray
+        the image affine.
+    scaling: (float, float)
+        the slope and intercept to apply to the unscaled voxels.
+    """
+    im = nibabel.load(cached(path), mmap=True)
+    data = im.dataobj.get_unscaled()
+    slope = getattr(im.dataobj, "slope", 1.)
+    inter = getattr(im.dataobj, "inter", 0.)
+    return data, im.affine, (float(slope), float(inter))
+
+
+def scale(data, scaling, dtype=np.float32):
+    """ Apply the image scaling to a block of unscaled voxels.
+    """
+    slope, inter = scaling
+    data = np.asarray(data, dtype=dtype)
+    if slope == 1 and inter == 0:
+        return data
+    slope = np.asarray(slope, dtype=dtype)
+    inter = np.asarray(inter, dtype=dtype)
+    return data * slope + inter
+
+
+def iter_slabs(path, size=16, dtype=np.float32):
+    """ Iterate over slabs of consecutive slices along the last spatial axis:
+    a single slab is in memory at a time.
+
+    Parameters
+    ----------
+    path: str
+        path to a .nii or .nii.gz image.
+    size: int, default 16
+        the number of slices in a slab.
+    dtype: numpy.dtype, default float32
+        the type of the returned scaled voxels.
+
+    Returns
+    -------
+    slabs: iterator of (slice, numpy.ndarray)
+        the location of each slab on the last spatial axis and its voxels.
+    """
+    data, _, scaling = open_volume(path)
+    for start in range(0, data.shape[2], size):
+        location = slice(start, min(start + size, data.shape[2]))
+        yield location, scale(data[:, :, location], scaling, dtype=dtype)
+
+
+def nonzero_counts(files, size=16):
+    """ Count, for each voxel, the images with a non zero value: the images
+    are read slab by slab.
+    """
+    total = None
+    for path in files:
+        if total is None:
+            total = np.zeros(open_volume(path)[0].shape[:3], dtype=np.int32)
+        for location, slab in iter_slabs(path, size=size):
+            total[:, :, location] += (slab != 0)
+    return total
+
+
+def flat_indices(mask):
+    """ Get the flat (Fortran ordered) indices of the voxels in a mask.
+    """
+    return np.flatnonzero(np.asarray(mask).ravel(order="F"))
+
+
+def masked_values(path, indices, dtype=np.float32):
+    """ Read the voxels of an image at the given flat indices.
+
+    Parameters
+    ----------
+    path: str
+        path to a .nii or .nii.gz image.
+    indices: numpy.ndarray
+        the flat (Fortran ordered) indices of the voxels to read, as
+        returned by flat_indices.
+    dtype: numpy.dtype, default float32
+        the type of the returned scaled voxels.
+
+    Returns
+    -------
+    values: numpy.ndarray
+        the voxels values (in Fortran order).
+    """
+    data, _, scaling = open_volume(path)
+    flat = data.reshape(-1, order="F")
+    return scale(flat[indices], scaling, dtype=dtype)